@@ -0,0 +1,373 @@
+"""
+Shared cache daemon for all OtakuVerse workers on one host
+
+Run it once per host:
+
+    python -m agents.cache_daemon --socket /tmp/otakuverse-cache.sock
+
+and point the workers at it with CACHE_DAEMON_SOCKET. The protocol is one
+JSON object per line in each direction over a Unix socket.
+"""
+
+import argparse
+import asyncio
+import json
+import os
+import socket
+import sys
+import threading
+import time
+from typing import Any, Dict, Iterable, List, Optional, Tuple
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from agents.ttl_cache import (
+    CACHE_EXPIRY_SLICE, TTLCache, _MISSING, expiry_loop, register_cache, unregister_cache
+)
+
+# Empty leaves every worker with its own in-process caches.
+CACHE_DAEMON_SOCKET = os.getenv("CACHE_DAEMON_SOCKET", "")
+CACHE_DAEMON_TIMEOUT = float(os.getenv("CACHE_DAEMON_TIMEOUT", "0.25"))
+# Seconds to stay on the local fallback after the daemon fails.
+CACHE_DAEMON_RETRY_SECONDS = float(os.getenv("CACHE_DAEMON_RETRY_SECONDS", "5"))
+# Largest request or response line, in bytes.
+MAX_LINE_BYTES = 16 * 1024 * 1024
+
+
+# ==================== Daemon ====================
+
+class CacheDaemon:
+    """Serves get/set/mget/delete/clear/stats requests from one shared TTLCache."""
+
+    def __init__(self, max_entries: int = 100000, max_bytes: Optional[int] = None):
+        """Create the shared store; entries are keyed by (namespace, key)."""
+        self.cache = TTLCache("daemon", max_entries=max_entries, ttl=None, max_bytes=max_bytes)
+
+    def handle(self, request: Dict[str, Any]) -> Dict[str, Any]:
+        """Apply one request to the store and build its response."""
+        op = request.get("op")
+        ns = request.get("ns", "")
+        if op == "get":
+            value = self.cache.get((ns, request["key"]), _MISSING)
+            if value is _MISSING:
+                return {"ok": True, "found": False}
+            return {"ok": True, "found": True, "value": value}
+        if op == "mget":
+            values = {}
+            for key in request["keys"]:
+                value = self.cache.get((ns, key), _MISSING)
+                if value is not _MISSING:
+                    values[key] = value
+            return {"ok": True, "values": values}
+        if op == "set":
+            self.cache.set((ns, request["key"]), request["value"], request.get("ttl"))
+            return {"ok": True}
+        if op == "delete":
+            return {"ok": True, "deleted": self.cache.delete((ns, request["key"]))}
+        if op == "clear":
+            keys = [key for key in self.cache.keys() if key[0] == ns]
+            for key in keys:
+                self.cache.delete(key)
+            return {"ok": True, "cleared": len(keys)}
+        if op == "stats":
+            return {"ok": True, "stats": self.cache.stats()}
+        if op == "ping":
+            return {"ok": True}
+        return {"ok": False, "error": f"unknown op {op!r}"}
+
+    async def serve_client(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        """Answer requests from one connection until it closes."""
+        try:
+            while True:
+                line = await reader.readline()
+                if not line:
+                    break
+                try:
+                    response = self.handle(json.loads(line))
+                except Exception as e:
+                    response = {"ok": False, "error": str(e)}
+                writer.write(json.dumps(response).encode("utf-8") + b"\n")
+                await writer.drain()
+        except (ConnectionError, asyncio.IncompleteReadError, asyncio.LimitOverrunError, ValueError):
+            pass
+        finally:
+            writer.close()
+
+    async def serve(self, socket_path: str):
+        """Listen on `socket_path` until cancelled."""
+        if os.path.exists(socket_path):
+            os.unlink(socket_path)
+        server = await asyncio.start_unix_server(self.serve_client, path=socket_path, limit=MAX_LINE_BYTES)
+        os.chmod(socket_path, 0o660)
+        expiry_task = asyncio.create_task(expiry_loop([self.cache]))
+        print(f"[CACHE DAEMON] Listening on {socket_path}")
+        try:
+            async with server:
+                await server.serve_forever()
+        finally:
+            expiry_task.cancel()
+            if os.path.exists(socket_path):
+                os.unlink(socket_path)
+
+
+# ==================== Client ====================
+
+class RemoteCache:
+    """TTLCache-compatible client for the cache daemon with a local fallback.
+
+    Reads and writes go to the daemon so every worker shares one cache.
+    Writes are mirrored into `local`, which answers daemon misses (e.g. after
+    a daemon restart, via its disk tier) and serves all reads while the
+    daemon is unreachable; the daemon is retried after
+    CACHE_DAEMON_RETRY_SECONDS. Values must be JSON-serializable.
+
+    Async code should use aget()/aset()/aget_many()/adelete(), which talk
+    to the daemon over asyncio streams; get()/set() block on a socket and
+    are meant for threads and scripts.
+    """
+
+    def __init__(self, local: TTLCache, socket_path: str = CACHE_DAEMON_SOCKET,
+                 timeout: float = CACHE_DAEMON_TIMEOUT):
+        """Wrap `local`; its name is the namespace on the daemon."""
+        self.local = local
+        self.name = local.name
+        self.ttl = local.ttl
+        self.socket_path = socket_path
+        self.timeout = timeout
+        self._conn = threading.local()
+        # Idle asyncio connections as (loop, reader, writer); one request in flight per connection
+        self._idle: List[Tuple[asyncio.AbstractEventLoop, asyncio.StreamReader, asyncio.StreamWriter]] = []
+        self._down_until = 0.0
+        self.remote_hits = 0
+        self.remote_misses = 0
+        self.remote_errors = 0
+        # Report once, as the remote cache, instead of also listing the fallback
+        unregister_cache(local)
+        register_cache(self)
+
+    def _connection(self) -> Tuple[socket.socket, Any]:
+        """This thread's socket and reader, connecting on first use."""
+        conn = getattr(self._conn, "value", None)
+        if conn is None:
+            sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            sock.settimeout(self.timeout)
+            sock.connect(self.socket_path)
+            conn = (sock, sock.makefile("rb"))
+            self._conn.value = conn
+        return conn
+
+    def _disconnect(self):
+        """Drop this thread's connection after an error."""
+        conn = getattr(self._conn, "value", None)
+        self._conn.value = None
+        if conn is not None:
+            try:
+                conn[1].close()
+                conn[0].close()
+            except OSError:
+                pass
+
+    def _request(self, payload: Dict[str, Any]) -> Optional[Dict[str, Any]]:
+        """Send one request. Returns None when the daemon is unavailable."""
+        if time.monotonic() < self._down_until:
+            return None
+        payload["ns"] = self.name
+        try:
+            sock, reader = self._connection()
+            sock.sendall(json.dumps(payload, default=str).encode("utf-8") + b"\n")
+            line = reader.readline(MAX_LINE_BYTES)
+            if not line:
+                raise ConnectionError("cache daemon closed the connection")
+            response = json.loads(line)
+            if not response.get("ok"):
+                raise RuntimeError(response.get("error"))
+            return response
+        except Exception as e:
+            self._disconnect()
+            self._mark_down(e)
+            return None
+
+    def _mark_down(self, error: Exception):
+        """Count a failed request and use the local cache until the retry time."""
+        self.remote_errors += 1
+        self._down_until = time.monotonic() + CACHE_DAEMON_RETRY_SECONDS
+        print(f"[CACHE] Daemon unavailable for {self.name}, using local cache: {error!r}")
+
+    async def _acquire(self) -> Tuple[asyncio.StreamReader, asyncio.StreamWriter]:
+        """An idle connection opened on the running loop, or a new one."""
+        loop = asyncio.get_running_loop()
+        while self._idle:
+            conn_loop, reader, writer = self._idle.pop()
+            if conn_loop is loop and not writer.is_closing():
+                return reader, writer
+            writer.close()
+        return await asyncio.open_unix_connection(self.socket_path, limit=MAX_LINE_BYTES)
+
+    async def _arequest(self, payload: Dict[str, Any]) -> Optional[Dict[str, Any]]:
+        """Send one request without blocking the event loop. Returns None when the daemon is unavailable."""
+        if time.monotonic() < self._down_until:
+            return None
+        payload["ns"] = self.name
+        conn = None
+        reusable = False
+        try:
+            conn = await asyncio.wait_for(self._acquire(), self.timeout)
+            reader, writer = conn
+            writer.write(json.dumps(payload, default=str).encode("utf-8") + b"\n")
+            await asyncio.wait_for(writer.drain(), self.timeout)
+            line = await asyncio.wait_for(reader.readline(), self.timeout)
+            if not line:
+                raise ConnectionError("cache daemon closed the connection")
+            reusable = True
+            response = json.loads(line)
+            if not response.get("ok"):
+                raise RuntimeError(response.get("error"))
+            return response
+        except Exception as e:
+            self._mark_down(e)
+            return None
+        finally:
+            # A connection interrupted mid-exchange may still receive a stale reply
+            if conn is not None:
+                if reusable:
+                    self._idle.append((asyncio.get_running_loop(),) + conn)
+                else:
+                    conn[1].close()
+
+    def get(self, key: Any, default: Any = None) -> Any:
+        """Return a value from the daemon, or from the local cache if it is down."""
+        response = self._request({"op": "get", "key": str(key)})
+        if response is None:
+            return self.local.get(key, default)
+        if not response["found"]:
+            self.remote_misses += 1
+            return self.local.get(key, default)
+        self.remote_hits += 1
+        return response["value"]
+
+    def get_many(self, keys: Iterable[Any]) -> Dict[Any, Any]:
+        """Fetch several keys in one round trip. Missing keys are left out."""
+        keys = list(keys)
+        response = self._request({"op": "mget", "keys": [str(key) for key in keys]})
+        if response is None:
+            return self.local.get_many(keys)
+        found = response["values"]
+        self.remote_hits += len(found)
+        self.remote_misses += len(keys) - len(found)
+        values = {key: found[str(key)] for key in keys if str(key) in found}
+        values.update(self.local.get_many(key for key in keys if key not in values))
+        return values
+
+    def set(self, key: Any, value: Any, ttl: Optional[float] = _MISSING):
+        """Store a value on the daemon and in the local fallback."""
+        ttl = self.ttl if ttl is _MISSING else ttl
+        self.local.set(key, value, ttl)
+        self._request({"op": "set", "key": str(key), "value": value, "ttl": ttl})
+
+    async def aget(self, key: Any, default: Any = None) -> Any:
+        """Async get()."""
+        response = await self._arequest({"op": "get", "key": str(key)})
+        if response is None:
+            return self.local.get(key, default)
+        if not response["found"]:
+            self.remote_misses += 1
+            return self.local.get(key, default)
+        self.remote_hits += 1
+        return response["value"]
+
+    async def aget_many(self, keys: Iterable[Any]) -> Dict[Any, Any]:
+        """Async get_many()."""
+        keys = list(keys)
+        response = await self._arequest({"op": "mget", "keys": [str(key) for key in keys]})
+        if response is None:
+            return self.local.get_many(keys)
+        found = response["values"]
+        self.remote_hits += len(found)
+        self.remote_misses += len(keys) - len(found)
+        values = {key: found[str(key)] for key in keys if str(key) in found}
+        values.update(self.local.get_many(key for key in keys if key not in values))
+        return values
+
+    async def aset(self, key: Any, value: Any, ttl: Optional[float] = _MISSING):
+        """Async set()."""
+        ttl = self.ttl if ttl is _MISSING else ttl
+        self.local.set(key, value, ttl)
+        await self._arequest({"op": "set", "key": str(key), "value": value, "ttl": ttl})
+
+    async def adelete(self, key: Any) -> bool:
+        """Async delete()."""
+        response = await self._arequest({"op": "delete", "key": str(key)})
+        deleted = self.local.delete(key)
+        return bool(response and response["deleted"]) or deleted
+
+    def delete(self, key: Any) -> bool:
+        """Remove a key everywhere. Returns True if the daemon or local cache had it."""
+        response = self._request({"op": "delete", "key": str(key)})
+        deleted = self.local.delete(key)
+        return bool(response and response["deleted"]) or deleted
+
+    def clear(self):
+        """Drop this namespace on the daemon and locally."""
+        self._request({"op": "clear"})
+        self.local.clear()
+
+    def expire_some(self, limit: int = CACHE_EXPIRY_SLICE) -> Tuple[int, bool]:
+        """Expire the local fallback; the daemon expires its own entries."""
+        return self.local.expire_some(limit)
+
+    def purge_expired(self) -> int:
+        return self.local.purge_expired()
+
+    def __contains__(self, key: Any) -> bool:
+        return self.get(key, _MISSING) is not _MISSING
+
+    def __len__(self) -> int:
+        return len(self.local)
+
+    def items(self) -> List[Tuple[Any, Any]]:
+        """Entries held in the local fallback; the daemon is not enumerated."""
+        return self.local.items()
+
+    def keys(self):
+        return self.local.keys()
+
+    def values(self):
+        return self.local.values()
+
+    def stats(self) -> Dict[str, Any]:
+        """Local fallback stats plus daemon hit/miss/error counters."""
+        stats = self.local.stats()
+        stats.update({
+            "backend": f"daemon:{self.socket_path}",
+            "remote_hits": self.remote_hits,
+            "remote_misses": self.remote_misses,
+            "remote_errors": self.remote_errors,
+        })
+        return stats
+
+
+def create_cache(name: str, **kwargs) -> Any:
+    """Build a TTLCache, shared through the daemon when CACHE_DAEMON_SOCKET is set."""
+    local = TTLCache(name, **kwargs)
+    if CACHE_DAEMON_SOCKET:
+        return RemoteCache(local, CACHE_DAEMON_SOCKET)
+    return local
+
+
+def main():
+    """Run the cache daemon."""
+    parser = argparse.ArgumentParser(description="Shared OtakuVerse cache daemon")
+    parser.add_argument("--socket", default=CACHE_DAEMON_SOCKET or "/tmp/otakuverse-cache.sock")
+    parser.add_argument("--max-entries", type=int, default=100000)
+    parser.add_argument("--max-bytes", type=int, default=None)
+    args = parser.parse_args()
+
+    daemon = CacheDaemon(args.max_entries, args.max_bytes)
+    try:
+        asyncio.run(daemon.serve(args.socket))
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,307 @@
+"""
+Persistent SQLite second tier for the in-memory caches
+"""
+
+import atexit
+import json
+import os
+import sqlite3
+import threading
+import time
+from typing import Any, Dict, List, Optional, Tuple
+
+# Empty CACHE_DB_PATH disables the disk tier.
+CACHE_DB_PATH = os.getenv("CACHE_DB_PATH", "otakuverse_cache.db")
+CACHE_DB_MAX_BYTES = int(os.getenv("CACHE_DB_MAX_BYTES", str(256 * 1024 * 1024)))
+# Once over the limit, evict down to this fraction of it so eviction runs rarely.
+EVICT_TARGET_RATIO = 0.9
+# Oldest rows deleted per eviction transaction.
+EVICT_BATCH_ROWS = 500
+# Seconds between write-behind flushes; writes are committed in one transaction per flush.
+CACHE_DB_FLUSH_INTERVAL = float(os.getenv("CACHE_DB_FLUSH_INTERVAL", "0.5"))
+# Pending writes that trigger a flush before the interval is up.
+CACHE_DB_FLUSH_BATCH = int(os.getenv("CACHE_DB_FLUSH_BATCH", "500"))
+
+_UPSERT_SQL = """
+    INSERT INTO cache_entries (namespace, key, payload, size, stored_at, expires_at)
+    VALUES (?, ?, ?, ?, ?, ?)
+    ON CONFLICT (namespace, key) DO UPDATE SET
+        payload = excluded.payload,
+        size = excluded.size,
+        stored_at = excluded.stored_at,
+        expires_at = excluded.expires_at
+"""
+
+# Payload bytes are totalled in cache_size by triggers, so every process
+# sharing the file reads the same running total without scanning the table.
+_SCHEMA_SQL = [
+    """
+    CREATE TABLE IF NOT EXISTS cache_entries (
+        namespace TEXT NOT NULL,
+        key TEXT NOT NULL,
+        payload TEXT NOT NULL,
+        size INTEGER NOT NULL,
+        stored_at REAL NOT NULL,
+        expires_at REAL,
+        PRIMARY KEY (namespace, key)
+    )
+    """,
+    "CREATE INDEX IF NOT EXISTS idx_cache_entries_stored ON cache_entries(stored_at)",
+    "CREATE INDEX IF NOT EXISTS idx_cache_entries_expires ON cache_entries(expires_at)",
+    """
+    CREATE TABLE IF NOT EXISTS cache_size (
+        id INTEGER PRIMARY KEY CHECK (id = 1),
+        bytes INTEGER NOT NULL
+    )
+    """,
+    """
+    CREATE TRIGGER IF NOT EXISTS cache_entries_size_insert AFTER INSERT ON cache_entries
+    BEGIN
+        UPDATE cache_size SET bytes = bytes + NEW.size WHERE id = 1;
+    END
+    """,
+    """
+    CREATE TRIGGER IF NOT EXISTS cache_entries_size_update AFTER UPDATE OF size ON cache_entries
+    BEGIN
+        UPDATE cache_size SET bytes = bytes + NEW.size - OLD.size WHERE id = 1;
+    END
+    """,
+    """
+    CREATE TRIGGER IF NOT EXISTS cache_entries_size_delete AFTER DELETE ON cache_entries
+    BEGIN
+        UPDATE cache_size SET bytes = bytes - OLD.size WHERE id = 1;
+    END
+    """,
+    # Seeds the total for databases created before the triggers existed
+    "INSERT OR IGNORE INTO cache_size (id, bytes) SELECT 1, COALESCE(SUM(size), 0) FROM cache_entries",
+]
+
+
+class DiskCache:
+    """Namespaced key/value store in SQLite with wall-clock expiry.
+
+    Survives restarts, so a new worker starts with the previous worker's
+    enrichment and search results. Values must be JSON-serializable.
+
+    Writes are buffered and committed in batches by a background thread, so
+    callers on the event loop never wait on a commit; reads see buffered
+    writes. Reads use per-thread connections of their own, which WAL lets
+    proceed while the writer commits or evicts; async callers should still
+    read from an executor (TTLCache.aget does). Past `max_bytes` of payload,
+    expired rows and then the oldest written rows are deleted in batches.
+    """
+
+    def __init__(self, db_path: str = CACHE_DB_PATH, max_bytes: int = CACHE_DB_MAX_BYTES,
+                 flush_interval: float = CACHE_DB_FLUSH_INTERVAL):
+        """Open the database, create the cache tables if needed and start the writer."""
+        self.db_path = db_path
+        self.max_bytes = max_bytes
+        self.flush_interval = flush_interval
+        # Guards the writer connection; readers never take it
+        self._lock = threading.Lock()
+        self.connection = sqlite3.connect(db_path, check_same_thread=False)
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.execute("PRAGMA synchronous=NORMAL")
+        self.connection.execute("BEGIN IMMEDIATE")
+        for statement in _SCHEMA_SQL:
+            self.connection.execute(statement)
+        self.connection.commit()
+        self._readers = threading.local()
+        self._reader_connections: List[sqlite3.Connection] = []
+        # (namespace, key) -> row to upsert, or None to delete; guarded by _pending_lock.
+        # _flushing holds the batch being committed so reads still see it meanwhile.
+        self._pending: Dict[Tuple[str, str], Optional[Tuple[str, float, Optional[float]]]] = {}
+        self._flushing: Dict[Tuple[str, str], Optional[Tuple[str, float, Optional[float]]]] = {}
+        self._pending_lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._closed = False
+        self._writer = threading.Thread(target=self._write_loop, name="disk-cache-writer", daemon=True)
+        self._writer.start()
+        atexit.register(self.close)
+
+    def _reader(self) -> sqlite3.Connection:
+        """This thread's read-only connection, opened on first use."""
+        connection = getattr(self._readers, "connection", None)
+        if connection is None:
+            connection = sqlite3.connect(self.db_path, check_same_thread=False)
+            connection.execute("PRAGMA query_only=ON")
+            self._readers.connection = connection
+            with self._pending_lock:
+                self._reader_connections.append(connection)
+        return connection
+
+    @staticmethod
+    def _total_bytes(connection: sqlite3.Connection) -> int:
+        """Payload bytes stored, from the trigger-maintained running total."""
+        row = connection.execute("SELECT bytes FROM cache_size WHERE id = 1").fetchone()
+        return row[0] if row else 0
+
+    def size_bytes(self) -> int:
+        """Payload bytes stored across every namespace."""
+        return self._total_bytes(self._reader())
+
+    def get(self, namespace: str, key: str) -> Optional[Tuple[Any, Optional[float]]]:
+        """Return (value, expires_at wall-clock or None) for a live entry, or None. Blocking."""
+        with self._pending_lock:
+            buffered = self._pending.get((namespace, key), False)
+            if buffered is False:
+                buffered = self._flushing.get((namespace, key), False)
+        if buffered is None:
+            return None
+        if buffered is not False:
+            row = (buffered[0], buffered[2])
+        else:
+            row = self._reader().execute(
+                "SELECT payload, expires_at FROM cache_entries WHERE namespace = ? AND key = ?",
+                (namespace, key)
+            ).fetchone()
+        if row is None or (row[1] is not None and row[1] <= time.time()):
+            return None
+        return json.loads(row[0]), row[1]
+
+    def set(self, namespace: str, key: str, value: Any, ttl: Optional[float] = None):
+        """Buffer a value, expiring `ttl` seconds from now (never if None)."""
+        payload = json.dumps(value, default=str)
+        now = time.time()
+        expires_at = None if ttl is None else now + ttl
+        self._buffer((namespace, key), (payload, now, expires_at))
+
+    def delete(self, namespace: str, key: str):
+        """Remove one entry."""
+        self._buffer((namespace, key), None)
+
+    def _buffer(self, key: Tuple[str, str], row: Optional[Tuple[str, float, Optional[float]]]):
+        """Queue a write for the writer thread, waking it early when the batch is full."""
+        with self._pending_lock:
+            self._pending[key] = row
+            full = len(self._pending) >= CACHE_DB_FLUSH_BATCH
+        if full:
+            self._wakeup.set()
+
+    def _write_loop(self):
+        """Flush buffered writes every `flush_interval` seconds until closed."""
+        while not self._closed:
+            self._wakeup.wait(self.flush_interval)
+            self._wakeup.clear()
+            try:
+                self.flush()
+            except Exception as e:
+                print(f"[CACHE] Disk flush failed: {e}")
+
+    def flush(self):
+        """Commit buffered writes in one transaction, then evict if over the size limit."""
+        with self._lock:
+            with self._pending_lock:
+                pending, self._pending = self._pending, {}
+                self._flushing = pending
+            if not pending:
+                return
+            upserts = [
+                (namespace, key, row[0], len(row[0]), row[1], row[2])
+                for (namespace, key), row in pending.items() if row is not None
+            ]
+            deletes = [key for key, row in pending.items() if row is None]
+            try:
+                with self.connection:
+                    if upserts:
+                        self.connection.executemany(_UPSERT_SQL, upserts)
+                    if deletes:
+                        self.connection.executemany(
+                            "DELETE FROM cache_entries WHERE namespace = ? AND key = ?", deletes
+                        )
+            finally:
+                with self._pending_lock:
+                    self._flushing = {}
+            if upserts and self._total_bytes(self.connection) > self.max_bytes:
+                self._evict()
+
+    def _evict(self):
+        """Delete expired rows, then the oldest rows in batches, until under the target size.
+
+        Caller holds the writer lock. Both deletes walk an index, and each
+        batch is its own short transaction so other processes can write between them.
+        """
+        connection = self.connection
+        with connection:
+            connection.execute(
+                "DELETE FROM cache_entries WHERE expires_at IS NOT NULL AND expires_at <= ?",
+                (time.time(),)
+            )
+        target = self.max_bytes * EVICT_TARGET_RATIO
+        while self._total_bytes(connection) > target:
+            with connection:
+                deleted = connection.execute("""
+                    DELETE FROM cache_entries WHERE rowid IN (
+                        SELECT rowid FROM cache_entries ORDER BY stored_at LIMIT ?
+                    )
+                """, (EVICT_BATCH_ROWS,)).rowcount
+            if not deleted:
+                break
+
+    def clear(self, namespace: str):
+        """Remove every entry in a namespace."""
+        self.flush()
+        with self._lock:
+            with self._pending_lock:
+                for key in [key for key in self._pending if key[0] == namespace]:
+                    del self._pending[key]
+            self.connection.execute("DELETE FROM cache_entries WHERE namespace = ?", (namespace,))
+            self.connection.commit()
+
+    def recent(self, namespace: str, limit: int) -> List[Tuple[str, Any, Optional[float]]]:
+        """Newest live entries of a namespace as (key, value, expires_at), oldest first."""
+        self.flush()
+        rows = self._reader().execute("""
+            SELECT key, payload, expires_at FROM cache_entries
+            WHERE namespace = ? AND (expires_at IS NULL OR expires_at > ?)
+            ORDER BY stored_at DESC LIMIT ?
+        """, (namespace, time.time(), limit)).fetchall()
+        return [(key, json.loads(payload), expires_at) for key, payload, expires_at in reversed(rows)]
+
+    def stats(self) -> Dict[str, Any]:
+        """Entries and payload bytes per namespace, and the total payload bytes."""
+        reader = self._reader()
+        rows = reader.execute("""
+            SELECT namespace, COUNT(*), COALESCE(SUM(size), 0) FROM cache_entries
+            GROUP BY namespace
+        """).fetchall()
+        with self._pending_lock:
+            pending = len(self._pending)
+        return {
+            "path": self.db_path,
+            "bytes": self._total_bytes(reader),
+            "max_bytes": self.max_bytes,
+            "pending_writes": pending,
+            "namespaces": {ns: {"entries": count, "bytes": size} for ns, count, size in rows},
+        }
+
+    def close(self):
+        """Flush buffered writes, stop the writer and close every connection."""
+        if self._closed:
+            return
+        self.flush()
+        self._closed = True
+        self._wakeup.set()
+        self._writer.join()
+        with self._lock:
+            self.connection.close()
+        with self._pending_lock:
+            readers, self._reader_connections = self._reader_connections, []
+        for connection in readers:
+            connection.close()
+
+
+_disk_caches: Dict[str, DiskCache] = {}
+_disk_caches_lock = threading.Lock()
+
+
+def get_disk_cache(db_path: str = CACHE_DB_PATH) -> Optional[DiskCache]:
+    """Return the process-wide disk cache for `db_path`, or None when disabled."""
+    if not db_path:
+        return None
+    with _disk_caches_lock:
+        cache = _disk_caches.get(db_path)
+        if cache is None:
+            cache = DiskCache(db_path)
+            _disk_caches[db_path] = cache
+        return cache
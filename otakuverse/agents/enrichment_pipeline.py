@@ -0,0 +1,203 @@
+"""
+Offline enrichment of the whole catalog
+
+    python -m agents.enrichment_pipeline [--types anime movies] [--concurrency 4] [--gemini]
+
+Walks every catalog item, fetches its MAL (Jikan) or OMDb data, and optionally
+Gemini data, and writes it to the enrichment store the servers read. Each
+finished item is committed as it completes, so an interrupted run picks up
+where it stopped when started again.
+"""
+
+import argparse
+import asyncio
+import os
+import sys
+import time
+from typing import Any, Dict, List, Optional, Tuple
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from agents.enrichment_store import EMPTY, FAILED, OK, EnrichmentStore, get_enrichment_store
+from api.circuit_breaker import CIRCUIT_RESET_TIMEOUT, CircuitOpenError
+from api.http_clients import close_http_clients
+from api.image_rating_handler import ImageAndRatingHandler, image_rating_handler
+from api.rate_limiter import QuotaExceededError, TokenBucketLimiter, background_priority
+from catalog_agent.agent import CatalogManager
+
+ENRICHMENT_CONCURRENCY = int(os.getenv("ENRICHMENT_CONCURRENCY", "4"))
+# Items older than this are fetched again on the next run.
+ENRICHMENT_MAX_AGE_DAYS = float(os.getenv("ENRICHMENT_MAX_AGE_DAYS", "7"))
+ENRICHMENT_MAX_ATTEMPTS = int(os.getenv("ENRICHMENT_MAX_ATTEMPTS", "3"))
+# Gemini's free tier allows 15 requests per minute.
+GEMINI_PER_SECOND = float(os.getenv("RATE_LIMIT_GEMINI_PER_SECOND", "0.25"))
+PROGRESS_EVERY = 50
+
+
+def catalog_items(content_types: Optional[List[str]] = None) -> List[Tuple[str, str]]:
+    """(title, content_type) for every catalog item, optionally limited to some types."""
+    catalog_manager = CatalogManager()
+    items = []
+    for catalog_type, catalog in catalog_manager.catalogs.items():
+        if content_types and catalog_type not in content_types:
+            continue
+        for item in catalog:
+            title = item.get("title")
+            if title:
+                items.append((title, item.get("content_type") or catalog_type))
+    return items
+
+
+class EnrichmentPipeline:
+    """Enriches items with a fixed number of workers, at background rate-limit priority.
+
+    Upstream calls go through the shared rate limiters and circuit breakers.
+    While a circuit is open, workers wait for it to half-open instead of
+    burning attempts; a spent daily quota stops the run.
+    """
+
+    def __init__(self, store: EnrichmentStore, handler: ImageAndRatingHandler = image_rating_handler,
+                 concurrency: int = ENRICHMENT_CONCURRENCY, gemini: Any = None):
+        """`gemini` is a GeminiEnrichmentAgent, or None to skip Gemini data."""
+        self.store = store
+        self.handler = handler
+        self.concurrency = concurrency
+        self.gemini = gemini
+        self.gemini_limiter = TokenBucketLimiter("gemini", GEMINI_PER_SECOND, 1)
+        self.counts = {OK: 0, EMPTY: 0, FAILED: 0}
+        self.total = 0
+        self.started = 0.0
+
+    async def enrich_item(self, title: str, content_type: str) -> str:
+        """Fetch and store one item. Returns its status.
+
+        Upstream errors propagate so the worker records the item as FAILED
+        and a later run retries it; EMPTY means upstream answered "not found".
+        """
+        data = await self.handler.fetch_enriched_item(title, content_type, raise_errors=True)
+        if self.gemini is not None:
+            await self.gemini_limiter.acquire()
+            result = await self.gemini.get_content_enrichment(title, content_type)
+            if result.get("status") == "success":
+                data["gemini"] = result["data"]
+
+        found = (any(data["images"].values()) or any(data["ratings"].values())
+                 or "gemini" in data)
+        if not found:
+            self.store.put(title, content_type, None, EMPTY)
+            return EMPTY
+        data["enriched_at"] = time.time()
+        self.store.put(title, content_type, data, OK)
+        return OK
+
+    async def _worker(self, queue: asyncio.Queue):
+        """Take items off the queue until it is empty."""
+        while True:
+            try:
+                title, content_type = queue.get_nowait()
+            except asyncio.QueueEmpty:
+                return
+            while True:
+                try:
+                    status = await self.enrich_item(title, content_type)
+                    break
+                except CircuitOpenError:
+                    await asyncio.sleep(CIRCUIT_RESET_TIMEOUT)
+                except QuotaExceededError:
+                    raise
+                except Exception as e:
+                    print(f"[ENRICH] Failed {content_type} '{title}': {e}")
+                    self.store.record_failure(title, content_type, str(e))
+                    status = FAILED
+                    break
+            self.counts[status] += 1
+            finished = sum(self.counts.values())
+            if finished % PROGRESS_EVERY == 0 or finished == self.total:
+                elapsed = time.monotonic() - self.started
+                print(f"[ENRICH] {finished}/{self.total} items "
+                      f"({self.counts[OK]} ok, {self.counts[EMPTY]} empty, {self.counts[FAILED]} failed) "
+                      f"in {elapsed:.0f}s")
+
+    async def run(self, items: List[Tuple[str, str]]) -> Dict[str, int]:
+        """Enrich `items` and return counts per status."""
+        queue: asyncio.Queue = asyncio.Queue()
+        for item in items:
+            queue.put_nowait(item)
+        self.total = len(items)
+        self.started = time.monotonic()
+
+        # Workers inherit background priority, so a server sharing the
+        # limiters would still serve its interactive requests first
+        with background_priority():
+            workers = [asyncio.create_task(self._worker(queue))
+                       for _ in range(min(self.concurrency, len(items)))]
+        try:
+            await asyncio.gather(*workers)
+        except QuotaExceededError as e:
+            print(f"[ENRICH] Stopping: {e}. Run again later to resume.")
+        finally:
+            for worker in workers:
+                worker.cancel()
+            await asyncio.gather(*workers, return_exceptions=True)
+        return dict(self.counts)
+
+
+async def run_pipeline(content_types: Optional[List[str]] = None,
+                       concurrency: int = ENRICHMENT_CONCURRENCY,
+                       max_age_days: float = ENRICHMENT_MAX_AGE_DAYS,
+                       retry_empty: bool = False, use_gemini: bool = False,
+                       limit: Optional[int] = None) -> Dict[str, int]:
+    """Enrich every catalog item that is missing, stale or due a retry."""
+    store = get_enrichment_store()
+    if store is None:
+        raise RuntimeError("ENRICHMENT_DB_PATH is empty; nothing to write to")
+
+    gemini = None
+    if use_gemini:
+        try:
+            from agents.gemini_enrichment_agent import gemini_agent
+            if gemini_agent.model is not None:
+                gemini = gemini_agent
+        except Exception as e:
+            print(f"[WARNING] Gemini not available: {e}")
+
+    items = catalog_items(content_types)
+    todo = store.pending(items, max_age=max_age_days * 86400 if max_age_days else None,
+                         retry_empty=retry_empty, max_attempts=ENRICHMENT_MAX_ATTEMPTS)
+    if limit:
+        todo = todo[:limit]
+    print(f"[ENRICH] {len(todo)} of {len(items)} catalog items need enriching "
+          f"(concurrency={concurrency}, gemini={gemini is not None})")
+    if not todo:
+        return {}
+
+    try:
+        return await EnrichmentPipeline(store, concurrency=concurrency, gemini=gemini).run(todo)
+    finally:
+        await close_http_clients()
+
+
+def main():
+    """Run the enrichment pipeline from the command line."""
+    parser = argparse.ArgumentParser(description="Enrich the OtakuVerse catalog into the enrichment store")
+    parser.add_argument("--types", nargs="*", help="Content types to enrich (default: all)")
+    parser.add_argument("--concurrency", type=int, default=ENRICHMENT_CONCURRENCY)
+    parser.add_argument("--max-age-days", type=float, default=ENRICHMENT_MAX_AGE_DAYS,
+                        help="Re-fetch items older than this; 0 never re-fetches")
+    parser.add_argument("--retry-empty", action="store_true", help="Retry items upstream had nothing for")
+    parser.add_argument("--gemini", action="store_true", help="Also store Gemini themes and summaries")
+    parser.add_argument("--limit", type=int, default=None, help="Enrich at most this many items")
+    args = parser.parse_args()
+
+    try:
+        counts = asyncio.run(run_pipeline(args.types, args.concurrency, args.max_age_days,
+                                          args.retry_empty, args.gemini, args.limit))
+    except KeyboardInterrupt:
+        print("[ENRICH] Interrupted; finished items are saved and will be skipped next run")
+        return
+    print(f"[ENRICH] Done: {counts}")
+    print(f"[ENRICH] Store: {get_enrichment_store().stats()}")
+
+
+if __name__ == "__main__":
+    main()
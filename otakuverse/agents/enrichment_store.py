@@ -0,0 +1,186 @@
+"""
+Persistent store of catalog enrichment (posters, ratings, metadata, Gemini data)
+
+Filled offline by agents.enrichment_pipeline and read by the servers, so
+request-time enrichment is a lookup. Each item's row doubles as the
+pipeline's checkpoint: finished items are skipped when a run resumes.
+"""
+
+import asyncio
+import json
+import os
+import sqlite3
+import threading
+import time
+from typing import Any, Dict, Iterable, List, Optional, Tuple
+
+# Empty ENRICHMENT_DB_PATH disables the store; servers then enrich lazily.
+ENRICHMENT_DB_PATH = os.getenv("ENRICHMENT_DB_PATH", "otakuverse_enrichment.db")
+
+# (content_type, title) pairs per get_many query, within SQLite's bound-parameter limit.
+GET_MANY_CHUNK = 400
+
+OK = "ok"            # upstream returned data
+EMPTY = "empty"      # upstream answered "not found"; no payload, servers fetch live
+FAILED = "failed"    # the last attempt raised; retried on the next run
+
+
+class EnrichmentStore:
+    """Enrichment records keyed by (content_type, normalized title) in SQLite."""
+
+    def __init__(self, db_path: str = ENRICHMENT_DB_PATH):
+        """Open the database and create the enrichment table if needed."""
+        self.db_path = db_path
+        self._lock = threading.Lock()
+        self.connection = sqlite3.connect(db_path, check_same_thread=False)
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.execute("PRAGMA synchronous=NORMAL")
+        self.connection.execute("""
+            CREATE TABLE IF NOT EXISTS enrichment (
+                content_type TEXT NOT NULL,
+                title_key TEXT NOT NULL,
+                status TEXT NOT NULL,
+                payload TEXT,
+                attempts INTEGER NOT NULL DEFAULT 0,
+                error TEXT,
+                updated_at REAL NOT NULL,
+                PRIMARY KEY (content_type, title_key)
+            )
+        """)
+        self.connection.commit()
+
+    @staticmethod
+    def _key(title: str) -> str:
+        """Normalize a title so lookups ignore case and surrounding whitespace."""
+        return title.strip().lower()
+
+    def get(self, title: str, content_type: str) -> Optional[Dict[str, Any]]:
+        """Return the stored enrichment for an item, or None if it has none yet or it is EMPTY."""
+        with self._lock:
+            row = self.connection.execute(
+                "SELECT payload FROM enrichment WHERE content_type = ? AND title_key = ? "
+                "AND payload IS NOT NULL AND status != ?",
+                (content_type, self._key(title), EMPTY)
+            ).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def get_many(self, items: Iterable[Tuple[str, str]]) -> Dict[Tuple[str, str], Dict[str, Any]]:
+        """Look up many (title, content_type) pairs at once; pairs with no usable enrichment are omitted."""
+        by_key: Dict[Tuple[str, str], List[Tuple[str, str]]] = {}
+        for title, content_type in items:
+            by_key.setdefault((content_type, self._key(title)), []).append((title, content_type))
+        keys = list(by_key)
+        found = {}
+        for start in range(0, len(keys), GET_MANY_CHUNK):
+            chunk = keys[start:start + GET_MANY_CHUNK]
+            values = ", ".join(["(?, ?)"] * len(chunk))
+            params = [value for key in chunk for value in key]
+            with self._lock:
+                rows = self.connection.execute(
+                    f"SELECT content_type, title_key, payload FROM enrichment "
+                    f"WHERE (content_type, title_key) IN (VALUES {values}) "
+                    f"AND payload IS NOT NULL AND status != ?",
+                    params + [EMPTY]
+                ).fetchall()
+            for content_type, title_key, payload in rows:
+                data = json.loads(payload)
+                for item in by_key[(content_type, title_key)]:
+                    found[item] = data
+        return found
+
+    async def aget(self, title: str, content_type: str) -> Optional[Dict[str, Any]]:
+        """get() run in the default executor, for callers on the event loop."""
+        return await asyncio.get_running_loop().run_in_executor(None, self.get, title, content_type)
+
+    async def aget_many(self, items: Iterable[Tuple[str, str]]) -> Dict[Tuple[str, str], Dict[str, Any]]:
+        """get_many() run in the default executor, for callers on the event loop."""
+        return await asyncio.get_running_loop().run_in_executor(None, self.get_many, list(items))
+
+    def put(self, title: str, content_type: str, data: Optional[Dict[str, Any]], status: str = OK):
+        """Store an item's enrichment, replacing any earlier record. `data` is None for EMPTY."""
+        payload = None if data is None else json.dumps(data, default=str)
+        with self._lock, self.connection:
+            self.connection.execute("""
+                INSERT INTO enrichment (content_type, title_key, status, payload, attempts, error, updated_at)
+                VALUES (?, ?, ?, ?, 0, NULL, ?)
+                ON CONFLICT (content_type, title_key) DO UPDATE SET
+                    status = excluded.status,
+                    payload = excluded.payload,
+                    attempts = 0,
+                    error = NULL,
+                    updated_at = excluded.updated_at
+            """, (content_type, self._key(title), status, payload, time.time()))
+
+    def record_failure(self, title: str, content_type: str, error: str):
+        """Count a failed attempt; a payload from an earlier run keeps being served."""
+        with self._lock, self.connection:
+            self.connection.execute("""
+                INSERT INTO enrichment (content_type, title_key, status, attempts, error, updated_at)
+                VALUES (?, ?, ?, 1, ?, ?)
+                ON CONFLICT (content_type, title_key) DO UPDATE SET
+                    status = excluded.status,
+                    attempts = attempts + 1,
+                    error = excluded.error,
+                    updated_at = excluded.updated_at
+            """, (content_type, self._key(title), FAILED, error, time.time()))
+
+    def pending(self, items: Iterable[Tuple[str, str]], max_age: Optional[float] = None,
+                retry_empty: bool = False, max_attempts: int = 3) -> List[Tuple[str, str]]:
+        """Filter (title, content_type) pairs down to those that still need enriching.
+
+        Skipped: items enriched within `max_age` seconds (ever, if None),
+        EMPTY items unless `retry_empty`, and FAILED items that already used
+        `max_attempts` attempts.
+        """
+        with self._lock:
+            rows = self.connection.execute(
+                "SELECT content_type, title_key, status, attempts, updated_at FROM enrichment"
+            ).fetchall()
+        known = {(ct, key): (status, attempts, updated_at) for ct, key, status, attempts, updated_at in rows}
+        now = time.time()
+
+        todo = []
+        for title, content_type in items:
+            record = known.get((content_type, self._key(title)))
+            if record is not None:
+                status, attempts, updated_at = record
+                if status == FAILED:
+                    if attempts >= max_attempts:
+                        continue
+                elif status == EMPTY and not retry_empty:
+                    continue
+                elif max_age is None or now - updated_at < max_age:
+                    continue
+            todo.append((title, content_type))
+        return todo
+
+    def stats(self) -> Dict[str, Any]:
+        """Item counts per content type and status."""
+        with self._lock:
+            rows = self.connection.execute(
+                "SELECT content_type, status, COUNT(*) FROM enrichment GROUP BY content_type, status"
+            ).fetchall()
+        counts: Dict[str, Dict[str, int]] = {}
+        for content_type, status, count in rows:
+            counts.setdefault(content_type, {})[status] = count
+        return {"db_path": self.db_path, "items": counts}
+
+    def close(self):
+        """Close the database."""
+        with self._lock:
+            self.connection.close()
+
+
+_enrichment_store: Optional[EnrichmentStore] = None
+_enrichment_store_lock = threading.Lock()
+
+
+def get_enrichment_store() -> Optional[EnrichmentStore]:
+    """Return the process-wide enrichment store, or None when ENRICHMENT_DB_PATH is empty."""
+    global _enrichment_store
+    if not ENRICHMENT_DB_PATH:
+        return None
+    with _enrichment_store_lock:
+        if _enrichment_store is None:
+            _enrichment_store = EnrichmentStore()
+        return _enrichment_store
@@ -5,59 +5,119 @@ Eliminates delays by caching everything with Gemini
 
 import json
 import hashlib
-from typing import Dict, Any, List, Optional
-from datetime import datetime, timedelta
+import os
+import sys
+from typing import Dict, Any, List, Optional, Tuple
 import asyncio
 import urllib.request
 import urllib.parse
 
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from agents.cache_daemon import create_cache
+from agents.disk_cache import get_disk_cache
+from agents.enrichment_store import get_enrichment_store
+from agents.negative_cache import NegativeCache
+from agents.single_flight import SingleFlight
+from agents.ttl_cache import TTLCache
+
+# Per-namespace cache limits. Catalogs are loaded once at startup and never expire.
+SEARCH_CACHE_MAX_ENTRIES = int(os.getenv("SEARCH_CACHE_MAX_ENTRIES", "5000"))
+SEARCH_CACHE_TTL = float(os.getenv("SEARCH_CACHE_TTL", "3600"))
+ENRICHMENT_CACHE_MAX_ENTRIES = int(os.getenv("ENRICHMENT_CACHE_MAX_ENTRIES", "20000"))
+ENRICHMENT_CACHE_TTL = float(os.getenv("ENRICHMENT_CACHE_TTL", "86400"))
+CATALOG_CACHE_MAX_BYTES = int(os.getenv("CATALOG_CACHE_MAX_BYTES", str(256 * 1024 * 1024)))
+
 class FastCacheAgent:
     """Lightning-fast agent using memory cache + Gemini for instant responses"""
     
     def __init__(self):
-        self.cache = {}  # In-memory cache
-        self.ttl = 3600  # 1 hour cache TTL
-        self.catalog_cache = {}
-        self.enrichment_cache = {}
-        self.search_cache = {}
+        self.ttl = SEARCH_CACHE_TTL
+        self.catalog_cache = TTLCache("catalog", max_entries=64, ttl=None,
+                                      max_bytes=CATALOG_CACHE_MAX_BYTES)
+        # Enrichment and search results persist on disk across restarts and are
+        # shared between workers when the cache daemon is configured
+        disk_cache = get_disk_cache()
+        self.enrichment_cache = create_cache("enrichment", max_entries=ENRICHMENT_CACHE_MAX_ENTRIES,
+                                             ttl=ENRICHMENT_CACHE_TTL, l2=disk_cache)
+        self.search_cache = create_cache("search", max_entries=SEARCH_CACHE_MAX_ENTRIES,
+                                         ttl=SEARCH_CACHE_TTL, l2=disk_cache)
+        self.search_flights = SingleFlight()
+        # Titles MAL/OMDb had no match for, or failed on, are not retried until expiry
+        self.negative_cache = NegativeCache("fast_cache")
+        # Per content type: catalog content fingerprint and an invalidation
+        # counter. Both are part of every search key, so a catalog change
+        # orphans its dependent entries without scanning the cache.
+        self.catalog_fingerprints: Dict[str, str] = {}
+        self.catalog_generations: Dict[str, int] = {}
+        # Ratings and covers written offline by agents.enrichment_pipeline
+        self.enrichment_store = get_enrichment_store()
+
+    @property
+    def caches(self) -> List[TTLCache]:
+        """Every cache owned by the agent, for background expiry."""
+        return [self.catalog_cache, self.enrichment_cache, self.search_cache]
         
     def _get_cache_key(self, *args) -> str:
         """Generate cache key"""
         key_str = "|".join(str(arg) for arg in args)
         return hashlib.md5(key_str.encode()).hexdigest()
     
-    def _is_cached_valid(self, cache_time: float) -> bool:
-        """Check if cache entry is still valid"""
-        return (datetime.now().timestamp() - cache_time) < self.ttl
-    
     async def get_cached_catalog(self, content_type: str) -> List[Dict]:
         """Get catalog from cache with instant response"""
-        cache_key = f"catalog_{content_type}"
-        
-        if cache_key in self.catalog_cache:
-            cached = self.catalog_cache[cache_key]
-            if self._is_cached_valid(cached['time']):
-                return cached['data']
-        
-        return []
+        return self.catalog_cache.get(f"catalog_{content_type}", [])
     
     async def cache_catalog(self, content_type: str, data: List[Dict]):
-        """Store catalog in fast cache"""
-        cache_key = f"catalog_{content_type}"
-        self.catalog_cache[cache_key] = {
-            'data': data,
-            'time': datetime.now().timestamp()
-        }
+        """Store catalog in fast cache and version dependent search entries"""
+        self.catalog_cache.set(f"catalog_{content_type}", data)
+        fingerprint = hashlib.md5(json.dumps(data, sort_keys=True, default=str).encode()).hexdigest()
+        if self.catalog_fingerprints.get(content_type) != fingerprint:
+            self.catalog_fingerprints[content_type] = fingerprint
+            print(f"[CACHE] Catalog {content_type} version {fingerprint[:8]}")
+    
+    def invalidate_catalog(self, content_type: str):
+        """Invalidate every cached search over a content type in O(1)"""
+        self.catalog_generations[content_type] = self.catalog_generations.get(content_type, 0) + 1
+    
+    def catalog_versions(self, content_types: Optional[List[str]]) -> List[str]:
+        """Version tags of the searched catalogs; None means every known catalog"""
+        if content_types is None:
+            content_types = set(self.catalog_fingerprints) | set(self.catalog_generations)
+        return [
+            f"{ct}@{self.catalog_fingerprints.get(ct, '')}.{self.catalog_generations.get(ct, 0)}"
+            for ct in sorted(set(content_types))
+        ]
     
     async def get_enriched_with_external_only(self, 
                                               title: str, 
                                               content_type: str) -> Dict[str, Any]:
         """
         Get ONLY external data (MAL rating, IMDb rating, images)
-        Everything else from Gemini DB to be ultra-fast
+        Read from the enrichment store, so no request waits on external APIs
         """
-        # For now, return minimal data to avoid crashes
-        # TODO: Re-enable external API calls
+        stored = await self.enrichment_store.aget(title, content_type) if self.enrichment_store else None
+        return self._external_only(stored)
+    
+    async def get_many_enriched_with_external_only(self,
+                                                   items: List[Tuple[str, str]]) -> List[Dict[str, Any]]:
+        """External data for many (title, content_type) pairs, in one store read off the event loop"""
+        stored = await self.enrichment_store.aget_many(items) if self.enrichment_store else {}
+        return [self._external_only(stored.get(item)) for item in items]
+    
+    @staticmethod
+    def _external_only(stored: Optional[Dict[str, Any]]) -> Dict[str, Any]:
+        """Shape a stored enrichment record, or None, into the external-data fields"""
+        if stored is not None:
+            ratings = stored.get("ratings", {})
+            return {
+                "mal_rating": ratings.get("mal_rating"),
+                "imdb_rating": ratings.get("imdb_rating"),
+                "cover_image": stored.get("images", {}).get("poster_url"),
+                "sources": [name for name, field in (("MAL", "mal_rating"), ("IMDb", "imdb_rating"))
+                            if ratings.get(field)]
+            }
+        
+        # Not enriched yet: return minimal data rather than calling out per request
         return {
             "mal_rating": None,
             "imdb_rating": None,
@@ -67,8 +127,11 @@ class FastCacheAgent:
     
     async def _fetch_mal_quick(self, title: str, content_type: str) -> Optional[Dict]:
         """Quick MAL fetch with timeout using stdlib"""
+        search_type = "anime" if content_type in ["anime", "light_novels"] else "manga"
+        if self.negative_cache.check("mal", search_type, title):
+            return None
+        
         try:
-            search_type = "anime" if content_type in ["anime", "light_novels"] else "manga"
             url = f"https://api.jikan.moe/v4/search/{search_type}"
             params = urllib.parse.urlencode({"query": title, "limit": 1})
             full_url = f"{url}?{params}"
@@ -90,22 +153,22 @@ class FastCacheAgent:
                 loop.run_in_executor(None, fetch),
                 timeout=2.0
             )
+            if result is None:
+                self.negative_cache.record_miss("mal", search_type, title)
             return result
             
         except asyncio.TimeoutError:
-            pass  # Skip if takes too long
+            self.negative_cache.record_error("mal", search_type, title)  # Skip if takes too long
         except Exception as e:
-            pass  # Silently skip errors
+            self.negative_cache.record_error("mal", search_type, title)  # Silently skip errors
         
         return None
     
     async def _fetch_imdb_quick(self, title: str) -> Optional[Dict]:
         """Quick IMDb fetch with timeout using stdlib"""
         try:
-            import os
-            
             omdb_key = os.getenv('OMDB_API_KEY', '')
-            if not omdb_key:
+            if not omdb_key or self.negative_cache.check("omdb", title):
                 return None
             
             params = urllib.parse.urlencode({"apikey": omdb_key, "t": title, "type": "movie"})
@@ -122,6 +185,9 @@ class FastCacheAgent:
                             "rating": rating,
                             "image": data.get("Poster") if data.get("Poster") != "N/A" else None
                         }
+                    # "Movie not found!" is a miss; quota and key errors are failures
+                    if not str(data.get("Error", "")).endswith("not found!"):
+                        raise RuntimeError(data.get("Error"))
             
             # Run in executor to avoid blocking
             loop = asyncio.get_event_loop()
@@ -129,56 +195,60 @@ class FastCacheAgent:
                 loop.run_in_executor(None, fetch),
                 timeout=2.0
             )
+            if result is None:
+                self.negative_cache.record_miss("omdb", title)
             return result
             
         except asyncio.TimeoutError:
-            pass  # Skip if takes too long
+            self.negative_cache.record_error("omdb", title)  # Skip if takes too long
         except Exception as e:
-            pass  # Silently skip errors
+            self.negative_cache.record_error("omdb", title)  # Silently skip errors
         
         return None
     
     async def search_fast(self, 
                          query: str,
                          catalog_data: List[Dict],
-                         limit: int = 20) -> List[Dict]:
-        """Ultra-fast search using in-memory cache and string matching"""
-        cache_key = self._get_cache_key("search", query, limit)
+                         limit: int = 20,
+                         content_types: Optional[List[str]] = None) -> List[Dict]:
+        """Ultra-fast search using in-memory cache and string matching
+        
+        `content_types` names the catalogs `catalog_data` was built from
+        (None for all of them); it scopes the cache key to those catalogs'
+        current versions.
+        """
+        cache_key = self._get_cache_key("search", query.lower(), limit, *self.catalog_versions(content_types))
         
-        if cache_key in self.search_cache:
-            cached = self.search_cache[cache_key]
-            if self._is_cached_valid(cached['time']):
-                return cached['data']
+        cached = await self.search_cache.aget(cache_key)
+        if cached is not None:
+            return cached
         
-        query_lower = query.lower()
-        results = []
+        async def compute() -> List[Dict]:
+            # Scan off the event loop; concurrent misses share this one scan
+            loop = asyncio.get_running_loop()
+            results = await loop.run_in_executor(
+                None, self._match_catalog, query.lower(), catalog_data, limit
+            )
+            await self.search_cache.aset(cache_key, results)
+            return results
         
-        # Fast string matching
+        return await self.search_flights.do(cache_key, compute)
+    
+    @staticmethod
+    def _match_catalog(query_lower: str, catalog_data: List[Dict], limit: int) -> List[Dict]:
+        """Fast string matching on titles and genres"""
+        results = []
         for item in catalog_data:
             if (query_lower in item.get("title", "").lower() or
                 any(query_lower in g.lower() for g in item.get("genres", []))):
                 results.append(item)
                 if len(results) >= limit:
                     break
-        
-        self.search_cache[cache_key] = {
-            'data': results,
-            'time': datetime.now().timestamp()
-        }
-        
         return results
     
-    def clear_expired_cache(self):
-        """Periodically clear expired cache entries"""
-        current_time = datetime.now().timestamp()
-        
-        for cache_dict in [self.catalog_cache, self.enrichment_cache, self.search_cache]:
-            expired_keys = [
-                key for key, value in cache_dict.items()
-                if (current_time - value['time']) > self.ttl
-            ]
-            for key in expired_keys:
-                del cache_dict[key]
+    def clear_expired_cache(self) -> int:
+        """Drop expired cache entries. Returns the number removed."""
+        return sum(cache.purge_expired() for cache in self.caches)
 
 
 # Global fast cache agent
@@ -0,0 +1,64 @@
+"""
+Negative cache for upstream lookups that found nothing or failed
+"""
+
+import os
+from typing import Any, Dict, Optional
+
+from agents.ttl_cache import TTLCache
+
+# Titles with no upstream match rarely start matching, so misses are kept
+# longer than errors, which are usually transient (timeouts, 5xx, 429).
+NEGATIVE_CACHE_MISS_TTL = float(os.getenv("NEGATIVE_CACHE_MISS_TTL", "900"))
+NEGATIVE_CACHE_ERROR_TTL = float(os.getenv("NEGATIVE_CACHE_ERROR_TTL", "30"))
+NEGATIVE_CACHE_MAX_ENTRIES = int(os.getenv("NEGATIVE_CACHE_MAX_ENTRIES", "20000"))
+
+MISS = "miss"
+ERROR = "error"
+
+
+class NegativeCache:
+    """Remembers lookups that returned no result or failed, each with its own TTL.
+
+    Callers check() before calling upstream and skip the call while an entry
+    is live. Keys are normalized so "Naruto " and "naruto" share an entry.
+    """
+
+    def __init__(self, name: str, miss_ttl: float = NEGATIVE_CACHE_MISS_TTL,
+                 error_ttl: float = NEGATIVE_CACHE_ERROR_TTL,
+                 max_entries: int = NEGATIVE_CACHE_MAX_ENTRIES):
+        """Create an empty negative cache for one upstream."""
+        self.miss_ttl = miss_ttl
+        self.error_ttl = error_ttl
+        self.cache = TTLCache(f"negative_{name}", max_entries=max_entries, ttl=miss_ttl)
+        self.skipped = 0
+
+    @staticmethod
+    def _key(parts: tuple) -> tuple:
+        """Normalize string parts of a key."""
+        return tuple(p.strip().lower() if isinstance(p, str) else p for p in parts)
+
+    def check(self, *key: Any) -> Optional[str]:
+        """Return MISS or ERROR if the lookup should be skipped, else None."""
+        kind = self.cache.get(self._key(key))
+        if kind is not None:
+            self.skipped += 1
+        return kind
+
+    def record_miss(self, *key: Any):
+        """Upstream answered but had no result."""
+        self.cache.set(self._key(key), MISS, self.miss_ttl)
+
+    def record_error(self, *key: Any):
+        """Upstream failed or timed out."""
+        self.cache.set(self._key(key), ERROR, self.error_ttl)
+
+    def forget(self, *key: Any):
+        """Drop an entry, e.g. after the lookup succeeded another way."""
+        self.cache.delete(self._key(key))
+
+    def stats(self) -> Dict[str, Any]:
+        """Underlying cache stats plus the number of upstream calls skipped."""
+        stats = self.cache.stats()
+        stats["skipped"] = self.skipped
+        return stats
@@ -0,0 +1,140 @@
+"""
+Persistent log of popular queries, used to warm caches after a deploy
+"""
+
+import json
+import os
+import sqlite3
+import threading
+from collections import Counter
+from typing import Any, Dict, List, Optional, Tuple
+
+from agents.disk_cache import CACHE_DB_PATH
+
+QUERY_LOG_DB_PATH = os.getenv("QUERY_LOG_DB_PATH", CACHE_DB_PATH or "otakuverse_cache.db")
+# Buffered counts are written once this many distinct queries are pending.
+QUERY_LOG_FLUSH_EVERY = int(os.getenv("QUERY_LOG_FLUSH_EVERY", "200"))
+# Retention: queries not seen for this many days are dropped, and each kind
+# keeps at most this many of its most frequent queries.
+QUERY_LOG_RETENTION_DAYS = float(os.getenv("QUERY_LOG_RETENTION_DAYS", "30"))
+QUERY_LOG_MAX_ROWS_PER_KIND = int(os.getenv("QUERY_LOG_MAX_ROWS_PER_KIND", "10000"))
+QUERY_LOG_PRUNE_INTERVAL = float(os.getenv("QUERY_LOG_PRUNE_INTERVAL", "3600"))
+
+
+def normalize_query(params: Dict[str, Any]) -> Dict[str, Any]:
+    """Canonical form of query parameters: lowercased strings, sorted de-duplicated lists."""
+    normalized = {}
+    for name, value in sorted(params.items()):
+        if value is None:
+            continue
+        if isinstance(value, str):
+            value = value.lower()
+        elif isinstance(value, (list, tuple)):
+            value = sorted({v.strip().lower() if isinstance(v, str) else v for v in value})
+        normalized[name] = value
+    return normalized
+
+
+class QueryLog:
+    """Counts normalized queries per kind ("search", "recommendations", ...).
+
+    record() buffers counts in memory; they are added to SQLite in one
+    batched transaction once `flush_every` distinct queries are pending, on
+    top() and on flush(), so most requests never touch disk. prune() bounds
+    the table; servers run it periodically.
+    """
+
+    def __init__(self, db_path: str = QUERY_LOG_DB_PATH, flush_every: int = QUERY_LOG_FLUSH_EVERY):
+        """Open the database and create the query_log table if needed."""
+        self.db_path = db_path
+        self.flush_every = flush_every
+        self._pending: Counter = Counter()
+        self._lock = threading.Lock()
+        self.connection = sqlite3.connect(db_path, check_same_thread=False)
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.execute("PRAGMA synchronous=NORMAL")
+        self.connection.execute("""
+            CREATE TABLE IF NOT EXISTS query_log (
+                kind TEXT NOT NULL,
+                params TEXT NOT NULL,
+                hits INTEGER NOT NULL DEFAULT 0,
+                last_seen TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                PRIMARY KEY (kind, params)
+            )
+        """)
+        self.connection.execute(
+            "CREATE INDEX IF NOT EXISTS idx_query_log_hits ON query_log(kind, hits DESC)"
+        )
+        self.connection.commit()
+
+    def record(self, kind: str, params: Dict[str, Any]):
+        """Count one occurrence of a query."""
+        key = (kind, json.dumps(normalize_query(params), sort_keys=True))
+        with self._lock:
+            self._pending[key] += 1
+            should_flush = len(self._pending) >= self.flush_every
+        if should_flush:
+            self.flush()
+
+    def flush(self) -> int:
+        """Write buffered counts to disk. Returns the number of distinct queries written."""
+        with self._lock:
+            pending, self._pending = self._pending, Counter()
+            if not pending:
+                return 0
+            with self.connection:
+                self.connection.executemany("""
+                    INSERT INTO query_log (kind, params, hits, last_seen)
+                    VALUES (?, ?, ?, CURRENT_TIMESTAMP)
+                    ON CONFLICT (kind, params) DO UPDATE SET
+                        hits = hits + excluded.hits,
+                        last_seen = excluded.last_seen
+                """, [(kind, params, hits) for (kind, params), hits in pending.items()])
+        return len(pending)
+
+    def top(self, kind: str, limit: int) -> List[Tuple[Dict[str, Any], int]]:
+        """Most frequent queries of a kind as (params, hits), including unflushed counts."""
+        self.flush()
+        with self._lock:
+            rows = self.connection.execute(
+                "SELECT params, hits FROM query_log WHERE kind = ? ORDER BY hits DESC LIMIT ?",
+                (kind, limit)
+            ).fetchall()
+        return [(json.loads(params), hits) for params, hits in rows]
+
+    def prune(self, max_age_days: float = QUERY_LOG_RETENTION_DAYS,
+              max_rows_per_kind: int = QUERY_LOG_MAX_ROWS_PER_KIND) -> int:
+        """Drop stale queries and all but the most frequent per kind. Returns rows deleted."""
+        self.flush()
+        with self._lock, self.connection:
+            deleted = self.connection.execute(
+                "DELETE FROM query_log WHERE last_seen < datetime('now', ?)",
+                (f"-{max_age_days} days",)
+            ).rowcount
+            kinds = [row[0] for row in self.connection.execute("SELECT DISTINCT kind FROM query_log")]
+            for kind in kinds:
+                deleted += self.connection.execute("""
+                    DELETE FROM query_log WHERE kind = ? AND rowid NOT IN (
+                        SELECT rowid FROM query_log WHERE kind = ? ORDER BY hits DESC LIMIT ?
+                    )
+                """, (kind, kind, max_rows_per_kind)).rowcount
+        return deleted
+
+    def close(self):
+        """Flush pending counts and close the database."""
+        self.flush()
+        with self._lock:
+            self.connection.close()
+
+
+_query_log: Optional[QueryLog] = None
+_query_log_lock = threading.Lock()
+
+
+def get_query_log() -> QueryLog:
+    """Return the process-wide query log."""
+    global _query_log
+    with _query_log_lock:
+        if _query_log is None:
+            _query_log = QueryLog()
+        return _query_log
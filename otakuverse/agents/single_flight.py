@@ -0,0 +1,49 @@
+"""
+Single-flight coalescing of concurrent cache misses
+"""
+
+import asyncio
+from typing import Any, Awaitable, Callable, Dict, Hashable
+
+
+class SingleFlight:
+    """Runs at most one computation per key at a time.
+
+    Concurrent callers asking for a key that is already being computed await
+    the in-flight task instead of starting their own, so an expired hot key
+    costs one upstream call rather than one per request. The computation runs
+    as its own task: a caller that is cancelled does not cancel it for the
+    others.
+    """
+
+    def __init__(self):
+        """Create a group with no computations in flight."""
+        self._inflight: Dict[Hashable, asyncio.Task] = {}
+        self.calls = 0
+        self.coalesced = 0
+
+    def _forget(self, key: Hashable, task: asyncio.Task):
+        """Drop a finished task and mark its exception as retrieved."""
+        if self._inflight.get(key) is task:
+            del self._inflight[key]
+        if not task.cancelled():
+            task.exception()
+
+    def start(self, key: Hashable, func: Callable[[], Awaitable[Any]]) -> asyncio.Task:
+        """Return the in-flight task for `key`, starting `func()` if there is none."""
+        task = self._inflight.get(key)
+        if task is None:
+            self.calls += 1
+            task = asyncio.ensure_future(func())
+            self._inflight[key] = task
+            task.add_done_callback(lambda t: self._forget(key, t))
+        else:
+            self.coalesced += 1
+        return task
+
+    async def do(self, key: Hashable, func: Callable[[], Awaitable[Any]]) -> Any:
+        """Return `await func()`, sharing one call among concurrent callers of `key`."""
+        return await asyncio.shield(self.start(key, func))
+
+    def __len__(self) -> int:
+        return len(self._inflight)
@@ -0,0 +1,436 @@
+"""
+Bounded LRU + TTL cache used by the OtakuVerse agents
+"""
+
+import asyncio
+import heapq
+import itertools
+import json
+import os
+import threading
+import time
+import weakref
+from collections import OrderedDict
+from typing import TYPE_CHECKING, Any, Callable, Dict, Iterable, Iterator, List, Optional, Tuple
+
+if TYPE_CHECKING:
+    from agents.disk_cache import DiskCache
+
+# Defaults for caches that do not set their own limits.
+CACHE_MAX_ENTRIES = int(os.getenv("CACHE_MAX_ENTRIES", "10000"))
+CACHE_DEFAULT_TTL = float(os.getenv("CACHE_DEFAULT_TTL", "3600"))
+# Background expiry: seconds between sweeps and entries examined per slice.
+CACHE_EXPIRY_INTERVAL = float(os.getenv("CACHE_EXPIRY_INTERVAL", "30"))
+CACHE_EXPIRY_SLICE = int(os.getenv("CACHE_EXPIRY_SLICE", "500"))
+
+_MISSING = object()
+
+# The expiry heap is rebuilt once it holds more than this many items per entry.
+HEAP_COMPACT_RATIO = 2
+# ...and at least this many, so small caches are not rebuilt on every write.
+HEAP_COMPACT_MIN = 64
+
+# Upper bounds (seconds) of the age buckets reported by TTLCache.stats().
+AGE_BUCKETS = [(60, "<1m"), (600, "1m-10m"), (3600, "10m-1h"), (86400, "1h-1d")]
+
+# Every cache created in this process, for /debug/caches
+_registry: "weakref.WeakSet" = weakref.WeakSet()
+_registry_lock = threading.Lock()
+
+
+def register_cache(cache: Any):
+    """Make a cache visible to registered_caches()."""
+    with _registry_lock:
+        _registry.add(cache)
+
+
+def unregister_cache(cache: Any):
+    """Hide a cache, e.g. one wrapped by another cache that reports for it."""
+    with _registry_lock:
+        _registry.discard(cache)
+
+
+def registered_caches() -> List[Any]:
+    """Live caches in this process, sorted by name."""
+    with _registry_lock:
+        caches = list(_registry)
+    return sorted(caches, key=lambda cache: cache.name)
+
+
+def cache_report() -> Dict[str, Any]:
+    """Stats for every registered cache, keyed by cache name."""
+    report = {}
+    for cache in registered_caches():
+        name = cache.name
+        suffix = 2
+        while name in report:
+            name = f"{cache.name}#{suffix}"
+            suffix += 1
+        report[name] = cache.stats()
+    return report
+
+
+def approximate_size(value: Any) -> int:
+    """Rough size of a cached value in bytes, based on its JSON encoding."""
+    try:
+        return len(json.dumps(value, default=str))
+    except (TypeError, ValueError):
+        return len(repr(value))
+
+
+class TTLCache:
+    """Thread-safe LRU cache with per-entry expiry on the monotonic clock.
+
+    Bounded by `max_entries` and, optionally, by `max_bytes` of approximate
+    value size. Lookups, inserts and evictions are O(1). `ttl=None` keeps
+    entries until they are evicted or replaced.
+
+    Expiring entries are also pushed onto a min-heap of deadlines so that
+    expire_some() can drop them in bounded slices without scanning the cache.
+    Heap items for keys that were replaced or evicted are skipped lazily, and
+    the heap is rebuilt from live entries once stale items outnumber them, so
+    it stays O(entries) however often keys are overwritten.
+
+    With an `l2` DiskCache, writes go through to disk under the cache's name
+    and L1 misses fall back to it, so entries survive restarts. Values must
+    then be JSON-serializable and keys are stored as strings.
+    """
+
+    def __init__(self, name: str = "cache", max_entries: int = CACHE_MAX_ENTRIES,
+                 ttl: Optional[float] = CACHE_DEFAULT_TTL, max_bytes: Optional[int] = None,
+                 sizeof: Callable[[Any], int] = approximate_size,
+                 l2: Optional["DiskCache"] = None):
+        """Create an empty cache; `name` identifies it in logs, stats and the disk tier."""
+        self.name = name
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        self.sizeof = sizeof
+        self.l2 = l2
+        # key -> (value, expires_at or None, size in bytes, stored_at)
+        self._entries: "OrderedDict[Any, Tuple[Any, Optional[float], int, float]]" = OrderedDict()
+        self._lock = threading.Lock()
+        # (expires_at, seq, key) for every entry stored with a deadline
+        self._expiry_heap: List[Tuple[float, int, Any]] = []
+        self._seq = itertools.count()
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+        self.l2_hits = 0
+        register_cache(self)
+
+    def _expires_at(self, ttl: Optional[float]) -> Optional[float]:
+        """Absolute monotonic deadline for a new entry, or None for no expiry."""
+        ttl = self.ttl if ttl is _MISSING else ttl
+        return None if ttl is None else time.monotonic() + ttl
+
+    def _remove(self, key: Any) -> Tuple[Any, Optional[float], int]:
+        """Drop an entry and its size accounting. Caller holds the lock."""
+        entry = self._entries.pop(key)
+        self.bytes -= entry[2]
+        return entry
+
+    def _compact_heap(self):
+        """Rebuild the expiry heap from live entries once stale items dominate it. Caller holds the lock."""
+        heap_size = len(self._expiry_heap)
+        if heap_size <= HEAP_COMPACT_MIN or heap_size <= HEAP_COMPACT_RATIO * len(self._entries):
+            return
+        self._expiry_heap = [
+            (expires_at, next(self._seq), key)
+            for key, (_value, expires_at, _size, _stored) in self._entries.items()
+            if expires_at is not None
+        ]
+        heapq.heapify(self._expiry_heap)
+
+    def _evict_overflow(self):
+        """Evict least recently used entries until within bounds. Caller holds the lock."""
+        while self._entries and (
+            len(self._entries) > self.max_entries
+            or (self.max_bytes is not None and self.bytes > self.max_bytes)
+        ):
+            key = next(iter(self._entries))
+            self._remove(key)
+            self.evictions += 1
+
+    def _get_memory(self, key: Any) -> Any:
+        """Return a live in-memory value and mark it recently used, or _MISSING.
+
+        Counts the miss only when there is no disk tier to fall back to.
+        """
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                expires_at = entry[1]
+                if expires_at is not None and expires_at <= time.monotonic():
+                    self._remove(key)
+                    self.expirations += 1
+                else:
+                    self._entries.move_to_end(key)
+                    self.hits += 1
+                    return entry[0]
+            if self.l2 is None:
+                self.misses += 1
+            return _MISSING
+
+    def get(self, key: Any, default: Any = None) -> Any:
+        """Return a live value and mark it recently used, or `default`."""
+        value = self._get_memory(key)
+        if value is not _MISSING:
+            return value
+        if self.l2 is None:
+            return default
+        return self._get_from_l2(key, default)
+
+    def get_many(self, keys: Iterable[Any]) -> Dict[Any, Any]:
+        """Look up several keys. Missing keys are left out."""
+        values = {}
+        for key in keys:
+            value = self.get(key, _MISSING)
+            if value is not _MISSING:
+                values[key] = value
+        return values
+
+    def _get_from_l2(self, key: Any, default: Any) -> Any:
+        """Fall back to the disk tier and promote a hit into memory."""
+        found = self.l2.get(self.name, str(key))
+        if found is None:
+            with self._lock:
+                self.misses += 1
+            return default
+        value, expires_at = found
+        ttl = None if expires_at is None else max(expires_at - time.time(), 0.0)
+        self._store(key, value, ttl)
+        with self._lock:
+            self.l2_hits += 1
+        return value
+
+    def _store(self, key: Any, value: Any, ttl: Optional[float]):
+        """Insert into memory only."""
+        size = self.sizeof(value) if self.max_bytes is not None else 0
+        with self._lock:
+            if key in self._entries:
+                self._remove(key)
+            expires_at = self._expires_at(ttl)
+            self._entries[key] = (value, expires_at, size, time.monotonic())
+            if expires_at is not None:
+                heapq.heappush(self._expiry_heap, (expires_at, next(self._seq), key))
+            self.bytes += size
+            self._evict_overflow()
+            self._compact_heap()
+
+    def set(self, key: Any, value: Any, ttl: Optional[float] = _MISSING):
+        """Store a value, overriding the cache TTL when `ttl` is given."""
+        ttl = self.ttl if ttl is _MISSING else ttl
+        self._store(key, value, ttl)
+        if self.l2 is not None:
+            try:
+                self.l2.set(self.name, str(key), value, ttl)
+            except Exception as e:
+                print(f"[CACHE] Disk write failed for {self.name}: {e}")
+
+    # Awaitable twins of get/get_many/set/delete, so async code can use a
+    # TTLCache and a daemon-backed RemoteCache interchangeably. set/delete
+    # only buffer disk writes, so their twins run inline; disk-tier reads
+    # run on the default executor, never on the loop.
+    async def aget(self, key: Any, default: Any = None) -> Any:
+        """Async get()."""
+        value = self._get_memory(key)
+        if value is not _MISSING:
+            return value
+        if self.l2 is None:
+            return default
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(None, self._get_from_l2, key, default)
+
+    async def aget_many(self, keys: Iterable[Any]) -> Dict[Any, Any]:
+        """Async get_many(); memory misses go to the disk tier in one executor call."""
+        values = {}
+        missed = []
+        for key in keys:
+            value = self._get_memory(key)
+            if value is _MISSING:
+                missed.append(key)
+            else:
+                values[key] = value
+        if missed and self.l2 is not None:
+            def from_l2():
+                found = {}
+                for key in missed:
+                    value = self._get_from_l2(key, _MISSING)
+                    if value is not _MISSING:
+                        found[key] = value
+                return found
+
+            values.update(await asyncio.get_running_loop().run_in_executor(None, from_l2))
+        return values
+
+    async def aset(self, key: Any, value: Any, ttl: Optional[float] = _MISSING):
+        """Async set()."""
+        self.set(key, value, ttl)
+
+    async def adelete(self, key: Any) -> bool:
+        """Async delete()."""
+        return self.delete(key)
+
+    def load_from_l2(self, limit: Optional[int] = None) -> int:
+        """Warm memory with the newest disk entries. Returns the number loaded."""
+        if self.l2 is None:
+            return 0
+        now = time.time()
+        loaded = 0
+        for key, value, expires_at in self.l2.recent(self.name, limit or self.max_entries):
+            ttl = None if expires_at is None else expires_at - now
+            if ttl is None or ttl > 0:
+                self._store(key, value, ttl)
+                loaded += 1
+        return loaded
+
+    def delete(self, key: Any) -> bool:
+        """Remove a key from memory and disk. Returns True if it was in memory."""
+        if self.l2 is not None:
+            self.l2.delete(self.name, str(key))
+        with self._lock:
+            if key not in self._entries:
+                return False
+            self._remove(key)
+            self._compact_heap()
+            return True
+
+    def clear(self):
+        """Drop every entry, including the disk tier; counters are kept."""
+        if self.l2 is not None:
+            self.l2.clear(self.name)
+        with self._lock:
+            self._entries.clear()
+            self._expiry_heap.clear()
+            self.bytes = 0
+
+    def expire_some(self, limit: int = CACHE_EXPIRY_SLICE) -> Tuple[int, bool]:
+        """Pop at most `limit` due deadlines off the expiry heap.
+
+        Returns (entries removed, whether more due deadlines remain). The lock
+        is held for one bounded slice only, so callers can interleave slices
+        with other work.
+        """
+        now = time.monotonic()
+        removed = 0
+        with self._lock:
+            heap = self._expiry_heap
+            for _ in range(limit):
+                if not heap or heap[0][0] > now:
+                    return removed, False
+                expires_at, _seq, key = heapq.heappop(heap)
+                entry = self._entries.get(key)
+                # Skip stale heap items: the key was replaced, evicted or deleted.
+                if entry is not None and entry[1] == expires_at:
+                    self._remove(key)
+                    removed += 1
+            self.expirations += removed
+            return removed, bool(heap) and heap[0][0] <= now
+
+    def purge_expired(self) -> int:
+        """Remove every expired entry in one go. Returns the number removed."""
+        removed = 0
+        more = True
+        while more:
+            count, more = self.expire_some()
+            removed += count
+        return removed
+
+    def __contains__(self, key: Any) -> bool:
+        with self._lock:
+            entry = self._entries.get(key)
+            return entry is not None and (entry[1] is None or entry[1] > time.monotonic())
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def items(self) -> List[Tuple[Any, Any]]:
+        """Snapshot of live (key, value) pairs, oldest first."""
+        now = time.monotonic()
+        with self._lock:
+            return [
+                (key, value) for key, (value, expires_at, _size, _stored) in self._entries.items()
+                if expires_at is None or expires_at > now
+            ]
+
+    def keys(self) -> Iterator[Any]:
+        """Live keys, oldest first."""
+        return (key for key, _value in self.items())
+
+    def values(self) -> Iterator[Any]:
+        """Live values, oldest first."""
+        return (value for _key, value in self.items())
+
+    def age_distribution(self) -> Dict[str, int]:
+        """Number of entries per age bucket, by time since they were stored."""
+        now = time.monotonic()
+        with self._lock:
+            stored = [entry[3] for entry in self._entries.values()]
+        buckets = {label: 0 for _limit, label in AGE_BUCKETS}
+        buckets[">1d"] = 0
+        for stored_at in stored:
+            age = now - stored_at
+            for limit, label in AGE_BUCKETS:
+                if age < limit:
+                    buckets[label] += 1
+                    break
+            else:
+                buckets[">1d"] += 1
+        return buckets
+
+    def stats(self) -> Dict[str, Any]:
+        """Counters, sizes and entry ages for monitoring."""
+        ages = self.age_distribution()
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "name": self.name,
+                "entries": len(self._entries),
+                "max_entries": self.max_entries,
+                "bytes": self.bytes if self.max_bytes is not None else self._approximate_bytes(),
+                "max_bytes": self.max_bytes,
+                "ttl": self.ttl,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "expirations": self.expirations,
+                "l2_hits": self.l2_hits if self.l2 is not None else None,
+                "hit_rate": round(self.hits / lookups, 4) if lookups else None,
+                "age_distribution": ages,
+            }
+
+    def _approximate_bytes(self, sample: int = 100) -> int:
+        """Estimate value bytes from a sample of entries when sizes are not tracked. Caller holds the lock."""
+        if not self._entries:
+            return 0
+        sampled = list(itertools.islice(self._entries.values(), sample))
+        average = sum(approximate_size(entry[0]) for entry in sampled) / len(sampled)
+        return int(average * len(self._entries))
+
+
+async def expire_caches(caches: List[TTLCache], slice_size: int = CACHE_EXPIRY_SLICE) -> int:
+    """Expire due entries across caches, yielding to the event loop between slices."""
+    removed = 0
+    for cache in caches:
+        more = True
+        while more:
+            count, more = cache.expire_some(slice_size)
+            removed += count
+            await asyncio.sleep(0)
+    return removed
+
+
+async def expiry_loop(caches: List[TTLCache], interval: float = CACHE_EXPIRY_INTERVAL,
+                      slice_size: int = CACHE_EXPIRY_SLICE):
+    """Background task that periodically drops expired entries from `caches`."""
+    while True:
+        await asyncio.sleep(interval)
+        try:
+            removed = await expire_caches(caches, slice_size)
+            if removed:
+                print(f"[CACHE] Expired {removed} entries")
+        except Exception as e:
+            print(f"[CACHE] Expiry sweep failed: {e}")
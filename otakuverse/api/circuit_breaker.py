@@ -0,0 +1,153 @@
+"""
+Circuit breakers and adaptive timeouts for the external APIs
+
+Each upstream gets a breaker that opens after repeated failures, so requests
+fail fast instead of each waiting out a timeout, and probes the upstream
+again after a cool-down. Request timeouts follow the upstream's recent p95
+latency instead of a fixed 15 seconds.
+"""
+
+import math
+import os
+import time
+from collections import deque
+from typing import Any, Dict, Optional
+
+CLOSED = "closed"
+OPEN = "open"
+HALF_OPEN = "half_open"
+
+# Consecutive failures (timeouts, connection errors, 5xx) that open a circuit.
+CIRCUIT_FAILURE_THRESHOLD = int(os.getenv("CIRCUIT_FAILURE_THRESHOLD", "5"))
+# Seconds an open circuit waits before letting one probe request through.
+CIRCUIT_RESET_TIMEOUT = float(os.getenv("CIRCUIT_RESET_TIMEOUT", "30"))
+# Timeout = p95 latency * multiplier, clamped to [min, max].
+ADAPTIVE_TIMEOUT_MIN = float(os.getenv("ADAPTIVE_TIMEOUT_MIN", "1"))
+ADAPTIVE_TIMEOUT_MAX = float(os.getenv("ADAPTIVE_TIMEOUT_MAX", "15"))
+ADAPTIVE_TIMEOUT_MULTIPLIER = float(os.getenv("ADAPTIVE_TIMEOUT_MULTIPLIER", "2"))
+# Latency samples kept per upstream, and how many are needed before adapting.
+LATENCY_WINDOW = int(os.getenv("LATENCY_WINDOW", "200"))
+LATENCY_MIN_SAMPLES = int(os.getenv("LATENCY_MIN_SAMPLES", "20"))
+
+
+class CircuitOpenError(RuntimeError):
+    """The upstream's circuit is open; the call was not attempted."""
+
+
+class CircuitBreaker:
+    """Closed/open/half-open breaker with a latency window for one upstream.
+
+    Closed: calls go through and failures are counted. After
+    `failure_threshold` consecutive failures the circuit opens and calls
+    raise CircuitOpenError. Once `reset_timeout` has passed it is half-open:
+    one probe is let through with the maximum timeout, and its outcome closes
+    or re-opens the circuit. A probe that ends without an outcome must call
+    release_probe(), or no further probe is admitted.
+    """
+
+    def __init__(self, name: str, failure_threshold: int = CIRCUIT_FAILURE_THRESHOLD,
+                 reset_timeout: float = CIRCUIT_RESET_TIMEOUT,
+                 timeout_min: float = ADAPTIVE_TIMEOUT_MIN,
+                 timeout_max: float = ADAPTIVE_TIMEOUT_MAX,
+                 multiplier: float = ADAPTIVE_TIMEOUT_MULTIPLIER,
+                 window: int = LATENCY_WINDOW, min_samples: int = LATENCY_MIN_SAMPLES):
+        """Create a closed breaker with an empty latency window."""
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.timeout_min = timeout_min
+        self.timeout_max = timeout_max
+        self.multiplier = multiplier
+        self.min_samples = min_samples
+        self.latencies: deque = deque(maxlen=window)
+        self._state = CLOSED
+        self.failures = 0
+        self.opened_at = 0.0
+        self._probe_started: Optional[float] = None
+        self.trips = 0
+        self.rejected = 0
+
+    @property
+    def state(self) -> str:
+        """Current state; an open circuit turns half-open once its cool-down ends."""
+        if self._state == OPEN and time.monotonic() >= self.opened_at + self.reset_timeout:
+            self._state = HALF_OPEN
+        return self._state
+
+    def available(self) -> bool:
+        """False while calls would be rejected without trying the upstream."""
+        return self.state != OPEN
+
+    def before_call(self) -> bool:
+        """Admit a call or raise CircuitOpenError. Returns True for a half-open probe."""
+        state = self.state
+        if state == CLOSED:
+            return False
+        if state == HALF_OPEN and self._probe_started is None:
+            self._probe_started = time.monotonic()
+            return True
+        self.rejected += 1
+        raise CircuitOpenError(f"{self.name} circuit is {state}")
+
+    def release_probe(self):
+        """Let another call probe; for a probe that ended without an upstream outcome (e.g. cancelled)."""
+        self._probe_started = None
+
+    def record_success(self, latency: float):
+        """A response arrived; close the circuit."""
+        self.latencies.append(latency)
+        self.failures = 0
+        self._probe_started = None
+        if self._state != CLOSED:
+            print(f"[CIRCUIT] {self.name} closed")
+        self._state = CLOSED
+
+    def record_failure(self, latency: Optional[float] = None):
+        """A call failed. Timeouts pass their timeout as `latency` so the window grows with them."""
+        if latency is not None:
+            self.latencies.append(latency)
+        self.failures += 1
+        self._probe_started = None
+        if self._state == HALF_OPEN or (self._state == CLOSED and self.failures >= self.failure_threshold):
+            self._state = OPEN
+            self.opened_at = time.monotonic()
+            self.trips += 1
+            print(f"[CIRCUIT] {self.name} opened after {self.failures} failures")
+
+    def percentile(self, p: float) -> Optional[float]:
+        """Latency percentile (0-100) over the window, None without samples."""
+        if not self.latencies:
+            return None
+        ordered = sorted(self.latencies)
+        return ordered[min(len(ordered) - 1, math.ceil(p / 100 * len(ordered)) - 1)]
+
+    def timeout(self) -> float:
+        """Request timeout from the recent p95; the maximum until enough samples exist."""
+        if len(self.latencies) < self.min_samples:
+            return self.timeout_max
+        return min(self.timeout_max, max(self.timeout_min, self.percentile(95) * self.multiplier))
+
+    def stats(self) -> Dict[str, Any]:
+        """State, latency percentiles and counters for monitoring."""
+        p50 = self.percentile(50)
+        p95 = self.percentile(95)
+        return {
+            "state": self.state,
+            "consecutive_failures": self.failures,
+            "trips": self.trips,
+            "rejected": self.rejected,
+            "samples": len(self.latencies),
+            "p50_ms": round(p50 * 1000) if p50 is not None else None,
+            "p95_ms": round(p95 * 1000) if p95 is not None else None,
+            "timeout_s": round(self.timeout(), 2),
+        }
+
+
+circuit_breakers: Dict[str, CircuitBreaker] = {
+    upstream: CircuitBreaker(upstream) for upstream in ("mal", "jikan", "omdb")
+}
+
+
+def get_circuit_breaker(upstream: str) -> CircuitBreaker:
+    """Return the breaker for an upstream."""
+    return circuit_breakers[upstream]
@@ -0,0 +1,102 @@
+"""
+Request deadlines shared by every step of a request
+
+An endpoint sets a latency budget with deadline_budget(); upstream calls,
+rate-limit waits and fan-outs made in that context (including tasks it
+creates) read the remaining time from a context variable and stop when it
+runs out, so the endpoint can answer with whatever finished in time.
+"""
+
+import asyncio
+import contextvars
+import os
+import time
+from contextlib import contextmanager
+from typing import Any, Awaitable, Iterable, Iterator, List, Optional, Tuple
+
+# Default /recommendations budget in milliseconds; 0 disables it.
+RECOMMENDATION_BUDGET_MS = int(os.getenv("RECOMMENDATION_BUDGET_MS", "5000"))
+# Largest budget a client may ask for with budget_ms.
+MAX_RECOMMENDATION_BUDGET_MS = int(os.getenv("MAX_RECOMMENDATION_BUDGET_MS", "30000"))
+
+# Absolute time.monotonic() deadline of the current request, if any.
+_deadline: contextvars.ContextVar = contextvars.ContextVar("deadline", default=None)
+
+
+class DeadlineExceededError(TimeoutError):
+    """The request's latency budget ran out."""
+
+
+@contextmanager
+def deadline_budget(budget_ms: Optional[float]) -> Iterator[None]:
+    """Give the block at most `budget_ms`, never extending an outer deadline. None or 0 adds no limit."""
+    deadline = _deadline.get()
+    if budget_ms:
+        candidate = time.monotonic() + budget_ms / 1000
+        deadline = candidate if deadline is None else min(deadline, candidate)
+    token = _deadline.set(deadline)
+    try:
+        yield
+    finally:
+        _deadline.reset(token)
+
+
+@contextmanager
+def without_deadline() -> Iterator[None]:
+    """Run the block, and tasks created in it, free of the request's deadline."""
+    token = _deadline.set(None)
+    try:
+        yield
+    finally:
+        _deadline.reset(token)
+
+
+def remaining() -> Optional[float]:
+    """Seconds left before the deadline (may be negative), None without one."""
+    deadline = _deadline.get()
+    if deadline is None:
+        return None
+    return deadline - time.monotonic()
+
+
+async def within_deadline(awaitable: Awaitable[Any]) -> Any:
+    """Await `awaitable`, raising DeadlineExceededError if the deadline passes first."""
+    left = remaining()
+    if left is None:
+        return await awaitable
+    if left <= 0:
+        if asyncio.iscoroutine(awaitable):
+            awaitable.close()
+        raise DeadlineExceededError("deadline exceeded")
+    try:
+        return await asyncio.wait_for(awaitable, left)
+    except asyncio.TimeoutError:
+        raise DeadlineExceededError("deadline exceeded") from None
+
+
+async def gather_within_deadline(awaitables: Iterable[Awaitable[Any]]) -> Tuple[List[Any], bool]:
+    """Like asyncio.gather(..., return_exceptions=True), but stops at the deadline.
+
+    Returns (results, partial). Work still running at the deadline is
+    cancelled and its slot holds a DeadlineExceededError; `partial` is True
+    when that happened.
+    """
+    tasks = [asyncio.ensure_future(aw) for aw in awaitables]
+    if not tasks:
+        return [], False
+    left = remaining()
+    _done, pending = await asyncio.wait(tasks, timeout=None if left is None else max(left, 0))
+    for task in pending:
+        task.cancel()
+
+    results = []
+    for task in tasks:
+        if task in pending:
+            results.append(DeadlineExceededError("deadline exceeded"))
+        elif task.cancelled():
+            results.append(asyncio.CancelledError())
+        elif task.exception() is not None:
+            results.append(task.exception())
+        else:
+            results.append(task.result())
+    return results, bool(pending)
@@ -0,0 +1,159 @@
+"""
+Long-lived HTTP clients for the external APIs (MAL, Jikan, OMDb)
+
+One pooled httpx.AsyncClient per upstream keeps TCP/TLS connections alive
+between calls. Servers open them on startup with start_http_clients() and
+close them on shutdown with close_http_clients(); get_http_client() also
+creates a client lazily for scripts that call the handlers directly.
+upstream_get() adds the per-upstream rate limit, Retry-After handling, circuit
+breaker, adaptive timeout and request deadline.
+"""
+
+import asyncio
+import importlib.util
+import os
+import time
+from typing import Dict, Tuple
+
+import httpx
+
+from api.circuit_breaker import get_circuit_breaker
+from api.deadline import DeadlineExceededError, remaining, within_deadline
+from api.rate_limiter import get_rate_limiter, parse_retry_after
+
+UPSTREAMS = ("mal", "jikan", "omdb")
+
+HTTP_MAX_CONNECTIONS = int(os.getenv("HTTP_MAX_CONNECTIONS", "20"))
+HTTP_MAX_KEEPALIVE = int(os.getenv("HTTP_MAX_KEEPALIVE", "10"))
+HTTP_KEEPALIVE_EXPIRY = float(os.getenv("HTTP_KEEPALIVE_EXPIRY", "30"))
+# Client-level fallback; upstream_get() passes an adaptive per-request timeout.
+HTTP_DEFAULT_TIMEOUT = float(os.getenv("HTTP_DEFAULT_TIMEOUT", "15"))
+# HTTP/2 multiplexes requests over one connection; needs the optional h2 package.
+HTTP2_ENABLED = os.getenv("HTTP2_ENABLED", "1") == "1" and importlib.util.find_spec("h2") is not None
+# Retries after a 429/503, and the longest Retry-After worth waiting for in-request.
+HTTP_RATE_LIMIT_RETRIES = int(os.getenv("HTTP_RATE_LIMIT_RETRIES", "2"))
+HTTP_RETRY_AFTER_MAX_WAIT = float(os.getenv("HTTP_RETRY_AFTER_MAX_WAIT", "10"))
+
+# upstream -> (client, event loop it was opened on)
+_clients: Dict[str, Tuple[httpx.AsyncClient, asyncio.AbstractEventLoop]] = {}
+
+
+def _create_client(upstream: str) -> httpx.AsyncClient:
+    """Build a pooled client for one upstream."""
+    return httpx.AsyncClient(
+        timeout=HTTP_DEFAULT_TIMEOUT,
+        limits=httpx.Limits(
+            max_connections=HTTP_MAX_CONNECTIONS,
+            max_keepalive_connections=HTTP_MAX_KEEPALIVE,
+            keepalive_expiry=HTTP_KEEPALIVE_EXPIRY,
+        ),
+        http2=HTTP2_ENABLED,
+        headers={"User-Agent": "OtakuVerse"},
+    )
+
+
+def get_http_client(upstream: str) -> httpx.AsyncClient:
+    """Return the shared client for `upstream` ("mal", "jikan" or "omdb").
+
+    Must be called from a running event loop. Pooled connections belong to
+    the loop that opened them, so a caller on a different loop (e.g. a script
+    using asyncio.run() per call) gets a fresh client.
+    """
+    if upstream not in UPSTREAMS:
+        raise ValueError(f"Unknown upstream: {upstream}")
+    loop = asyncio.get_running_loop()
+    entry = _clients.get(upstream)
+    if entry is None or entry[0].is_closed or entry[1] is not loop:
+        entry = (_create_client(upstream), loop)
+        _clients[upstream] = entry
+    return entry[0]
+
+
+async def start_http_clients():
+    """Open every upstream client (call from the app's startup hook)."""
+    for upstream in UPSTREAMS:
+        get_http_client(upstream)
+    print(f"[HTTP] Pooled clients ready for {', '.join(UPSTREAMS)} (http2={HTTP2_ENABLED})")
+
+
+async def close_http_clients():
+    """Close every upstream client and its pooled connections (call on shutdown)."""
+    loop = asyncio.get_running_loop()
+    entries = list(_clients.values())
+    _clients.clear()
+    for client, client_loop in entries:
+        if client_loop is loop:
+            await client.aclose()
+
+
+async def _send(upstream: str, url: str, timeout: float, deadline_bound: bool = False,
+                **kwargs) -> httpx.Response:
+    """One GET, reported to the upstream's circuit breaker.
+
+    `deadline_bound` means the timeout was cut short by the request deadline;
+    hitting it is then the caller running out of time, not an upstream failure.
+    """
+    breaker = get_circuit_breaker(upstream)
+    started = time.monotonic()
+    try:
+        response = await get_http_client(upstream).get(url, timeout=timeout, **kwargs)
+    except httpx.TimeoutException:
+        if deadline_bound:
+            raise DeadlineExceededError(f"{upstream} request ran past the deadline") from None
+        breaker.record_failure(timeout)
+        raise
+    except httpx.TransportError:
+        breaker.record_failure()
+        raise
+    if response.status_code >= 500:
+        breaker.record_failure()
+    else:
+        breaker.record_success(time.monotonic() - started)
+    return response
+
+
+async def upstream_get(upstream: str, url: str, **kwargs) -> httpx.Response:
+    """GET through the shared client, within the upstream's rate limit and circuit breaker.
+
+    Raises CircuitOpenError without calling the upstream while its circuit is
+    open. Unless the caller passes one, the timeout adapts to the upstream's
+    recent latency, cut to the time left before the request deadline (see
+    api.deadline); DeadlineExceededError is raised once that runs out. A
+    429/503 pauses the upstream's limiter for the Retry-After period (or an
+    exponential backoff without one) and the request is queued again, up to
+    HTTP_RATE_LIMIT_RETRIES times. Waits longer than HTTP_RETRY_AFTER_MAX_WAIT
+    return the error response instead. Raises QuotaExceededError once a daily
+    quota is spent.
+    """
+    limiter = get_rate_limiter(upstream)
+    breaker = get_circuit_breaker(upstream)
+    timeout = kwargs.pop("timeout", None)
+    attempt = 0
+    while True:
+        probe = breaker.before_call()
+        try:
+            await within_deadline(limiter.acquire())
+            # Half-open probes get the full timeout so a slow-but-alive upstream can recover
+            request_timeout = timeout or (breaker.timeout_max if probe else breaker.timeout())
+            left = remaining()
+            deadline_bound = left is not None and left < request_timeout
+            if deadline_bound:
+                if left <= 0:
+                    raise DeadlineExceededError(f"no time left for {upstream}")
+                request_timeout = left
+            response = await _send(upstream, url, request_timeout, deadline_bound, **kwargs)
+        finally:
+            # Cancellation (a BaseException), deadlines and quota errors never
+            # reach the breaker; free the probe slot so the next call probes
+            if probe:
+                breaker.release_probe()
+        if response.status_code not in (429, 503):
+            return response
+        delay = parse_retry_after(response.headers.get("Retry-After"))
+        if delay is None:
+            delay = float(2 ** attempt)
+        limiter.penalize(delay)
+        print(f"[RATE LIMIT] {upstream} returned {response.status_code}, pausing for {delay:.1f}s")
+        if attempt >= HTTP_RATE_LIMIT_RETRIES or delay > HTTP_RETRY_AFTER_MAX_WAIT:
+            return response
+        attempt += 1
@@ -1,8 +1,32 @@
-import httpx
 import os
-from typing import Optional, Dict, Any
+import sys
+import time
+from typing import Optional, Dict, Any, Awaitable, Callable, Set
 import asyncio
-from functools import lru_cache
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from api.circuit_breaker import CircuitOpenError
+from api.deadline import DeadlineExceededError, without_deadline
+from api.http_clients import upstream_get
+from api.rate_limiter import QuotaExceededError, background_priority
+from agents.cache_daemon import create_cache
+from agents.disk_cache import get_disk_cache
+from agents.enrichment_store import get_enrichment_store
+from agents.single_flight import SingleFlight
+from agents.ttl_cache import TTLCache
+
+# External ratings and posters change rarely. After the soft TTL a cached value
+# is still served while a background refresh runs; only entries past the hard
+# TTL make a request wait for upstream.
+IMAGE_CACHE_MAX_ENTRIES = int(os.getenv("IMAGE_CACHE_MAX_ENTRIES", "20000"))
+RATING_CACHE_MAX_ENTRIES = int(os.getenv("RATING_CACHE_MAX_ENTRIES", "20000"))
+EXTERNAL_DATA_SOFT_TTL = float(os.getenv("EXTERNAL_DATA_SOFT_TTL", "21600"))
+EXTERNAL_DATA_CACHE_TTL = float(os.getenv("EXTERNAL_DATA_CACHE_TTL", "86400"))
+
+# Upstream was not asked (circuit open, quota spent) or did not answer in time;
+# results built without it are returned but never cached
+UPSTREAM_UNAVAILABLE = (CircuitOpenError, DeadlineExceededError, QuotaExceededError)
 
 class ImageAndRatingHandler:
     """Handles image and rating fetching from external sources"""
@@ -11,21 +35,83 @@ class ImageAndRatingHandler:
         self.omdb_key = os.getenv('OMDB_API_KEY', '2d9726cf')
         self.jikan_base = "https://api.jikan.moe/v4"
         self.omdb_base = "https://www.omdbapi.com"
-        self.image_cache = {}
-        self.rating_cache = {}
-        self.timeout = 15.0
+        # Both caches persist on disk so a restarted worker does not refetch
+        # everything, and are shared between workers through the cache daemon
+        disk_cache = get_disk_cache()
+        self.image_cache = create_cache("image", max_entries=IMAGE_CACHE_MAX_ENTRIES,
+                                        ttl=EXTERNAL_DATA_CACHE_TTL, l2=disk_cache)
+        self.rating_cache = create_cache("rating", max_entries=RATING_CACHE_MAX_ENTRIES,
+                                         ttl=EXTERNAL_DATA_CACHE_TTL, l2=disk_cache)
+        self.soft_ttl = EXTERNAL_DATA_SOFT_TTL
+        # Filled offline by agents.enrichment_pipeline; the caches cover items it hasn't reached
+        self.enrichment_store = get_enrichment_store()
+        # Concurrent misses and refreshes on the same key share one upstream fetch
+        self.flights = SingleFlight()
+        self._refresh_tasks: Set[asyncio.Task] = set()
+
+    async def _load(self, cache: TTLCache, key: str,
+                    fetch: Callable[[], Awaitable[Dict[str, Any]]]) -> Dict[str, Any]:
+        """Fetch a value and cache it together with its soft expiry deadline"""
+        value = await fetch()
+        # Wall clock, so the deadline stays meaningful when read back from disk
+        await cache.aset(key, (value, time.time() + self.soft_ttl))
+        return value
+
+    def _refresh_in_background(self, cache: TTLCache, key: str,
+                               fetch: Callable[[], Awaitable[Dict[str, Any]]]):
+        """Start a background refresh unless one is already running for the key"""
+        # The refresh task inherits background priority, so its upstream calls
+        # queue behind interactive requests in the rate limiters, and outlives
+        # the deadline of the request that noticed the stale entry
+        with background_priority(), without_deadline():
+            task = self.flights.start((cache.name, key), lambda: self._load(cache, key, fetch))
+        if task not in self._refresh_tasks:
+            self._refresh_tasks.add(task)
+            task.add_done_callback(self._refresh_done)
+
+    def _refresh_done(self, task: asyncio.Task):
+        """Forget a finished refresh and report failures"""
+        self._refresh_tasks.discard(task)
+        # An unavailable upstream just leaves the stale value in place until it recovers
+        if not task.cancelled() and task.exception() and not isinstance(task.exception(), UPSTREAM_UNAVAILABLE):
+            print(f"Warning: Background refresh failed: {task.exception()}")
+
+    async def _get_or_fetch(self, cache: TTLCache, key: str,
+                            fetch: Callable[[], Awaitable[Dict[str, Any]]],
+                            fallback: Callable[[], Dict[str, Any]]) -> Dict[str, Any]:
+        """Serve from cache with stale-while-revalidate, fetching only on a hard miss.
+
+        Fetches raise one of UPSTREAM_UNAVAILABLE when the upstream is degraded,
+        out of quota or the request runs out of time; nothing is cached then
+        and the uncached `fallback()` value is returned.
+        """
+        entry = await cache.aget(key)
+        if entry is not None:
+            value, refresh_at = entry
+            if time.time() >= refresh_at:
+                self._refresh_in_background(cache, key, fetch)
+            return value
+        try:
+            return await self.flights.do((cache.name, key), lambda: self._load(cache, key, fetch))
+        except UPSTREAM_UNAVAILABLE:
+            return fallback()
 
-    async def get_mal_data(self, title: str, content_type: str) -> Optional[Dict[str, Any]]:
-        """Fetch data from MyAnimeList via Jikan API"""
+    async def get_mal_data(self, title: str, content_type: str,
+                           raise_errors: bool = False) -> Optional[Dict[str, Any]]:
+        """Fetch data from MyAnimeList via Jikan API
+
+        Returns None when MAL has no match. Other failures also return None
+        unless `raise_errors`, so callers that persist results can tell
+        "not found" from "try again".
+        """
         try:
             search_type = "anime" if content_type in ["anime", "light_novels"] else "manga"
             url = f"{self.jikan_base}/search/{search_type}"
             params = {"query": title, "limit": 1}
             
-            async with httpx.AsyncClient(timeout=self.timeout) as client:
-                response = await client.get(url, params=params)
-                response.raise_for_status()
-                data = response.json()
+            response = await upstream_get("jikan", url, params=params)
+            response.raise_for_status()
+            data = response.json()
             
             if data.get("data") and len(data["data"]) > 0:
                 result = data["data"][0]
@@ -39,13 +125,23 @@ class ImageAndRatingHandler:
                     "year": result.get("year"),
                 }
             return None
+        except UPSTREAM_UNAVAILABLE:
+            raise
         except Exception as e:
+            if raise_errors:
+                raise
             print(f"Warning: Error fetching MAL data for '{title}': {e}")
             return None
 
-    async def get_imdb_data(self, title: str, year: Optional[int] = None) -> Optional[Dict[str, Any]]:
-        """Fetch data from IMDb via OMDb API"""
+    async def get_imdb_data(self, title: str, year: Optional[int] = None,
+                            raise_errors: bool = False) -> Optional[Dict[str, Any]]:
+        """Fetch data from IMDb via OMDb API
+
+        Returns None when OMDb has no match; see get_mal_data for `raise_errors`.
+        """
         if not self.omdb_key:
+            if raise_errors:
+                raise RuntimeError("OMDB_API_KEY not configured")
             print("Warning: OMDB_API_KEY not configured")
             return None
         
@@ -59,10 +155,9 @@ class ImageAndRatingHandler:
             if year:
                 params["y"] = year
             
-            async with httpx.AsyncClient(timeout=self.timeout) as client:
-                response = await client.get(url, params=params)
-                response.raise_for_status()
-                data = response.json()
+            response = await upstream_get("omdb", url, params=params)
+            response.raise_for_status()
+            data = response.json()
             
             if data.get("Response") == "True" and data.get("Poster") != "N/A":
                 return {
@@ -75,24 +170,48 @@ class ImageAndRatingHandler:
                     "year": int(data.get("Year", 0)),
                     "director": data.get("Director"),
                 }
+            # OMDb answers errors such as an invalid key with Response=False too
+            error = data.get("Error", "")
+            if data.get("Response") != "True" and "not found" not in error.lower():
+                raise RuntimeError(f"OMDb error: {error or 'unexpected response'}")
             return None
+        except UPSTREAM_UNAVAILABLE:
+            raise
         except Exception as e:
+            if raise_errors:
+                raise
             print(f"Warning: Error fetching IMDb data for '{title}': {e}")
             return None
 
     async def get_ratings(self, title: str, content_type: str) -> Optional[Dict[str, Any]]:
-        """Get ratings from multiple sources"""
+        """Get ratings from the enrichment store, or from multiple sources"""
+        stored = await self.enrichment_store.aget(title, content_type) if self.enrichment_store else None
+        if stored is not None:
+            rating_data = self._empty_ratings()
+            for field, source in (("mal_rating", "MAL"), ("imdb_rating", "IMDb")):
+                if stored["ratings"].get(field):
+                    rating_data[field] = stored["ratings"][field]
+                    rating_data["sources"].append(source)
+            return rating_data
+
         cache_key = f"{title}-{content_type}"
-        
-        if cache_key in self.rating_cache:
-            return self.rating_cache[cache_key]
+        return await self._get_or_fetch(self.rating_cache, cache_key,
+                                        lambda: self._fetch_ratings(title, content_type),
+                                        self._empty_ratings)
 
-        rating_data = {
+    @staticmethod
+    def _empty_ratings() -> Dict[str, Any]:
+        """Ratings with no sources"""
+        return {
             "sources": [],
             "imdb_rating": None,
             "mal_rating": None,
         }
 
+    async def _fetch_ratings(self, title: str, content_type: str) -> Dict[str, Any]:
+        """Fetch ratings from upstream"""
+        rating_data = self._empty_ratings()
+
         # Try both sources in parallel
         tasks = []
         
@@ -114,17 +233,28 @@ class ImageAndRatingHandler:
                         rating_data["imdb_rating"] = result["rating"]
                         rating_data["sources"].append("IMDb")
 
-        self.rating_cache[cache_key] = rating_data
+            # Don't cache "no ratings" when the upstream never answered
+            degraded = [r for r in results if isinstance(r, UPSTREAM_UNAVAILABLE)]
+            if degraded and not rating_data["sources"]:
+                raise degraded[0]
+
         return rating_data
 
     async def get_enriched_item(self, title: str, content_type: str) -> Dict[str, Any]:
-        """Get enriched item data with images and ratings"""
+        """Get enriched item data with images and ratings, from the enrichment store when present"""
+        stored = await self.enrichment_store.aget(title, content_type) if self.enrichment_store else None
+        if stored is not None:
+            return stored
+
         cache_key = f"enriched-{title}-{content_type}"
-        
-        if cache_key in self.image_cache:
-            return self.image_cache[cache_key]
+        return await self._get_or_fetch(self.image_cache, cache_key,
+                                        lambda: self.fetch_enriched_item(title, content_type),
+                                        lambda: self._empty_enriched_item(title, content_type))
 
-        enriched_data = {
+    @staticmethod
+    def _empty_enriched_item(title: str, content_type: str) -> Dict[str, Any]:
+        """Enriched item with no upstream data"""
+        return {
             "title": title,
             "content_type": content_type,
             "images": {},
@@ -132,9 +262,18 @@ class ImageAndRatingHandler:
             "metadata": {}
         }
 
+    async def fetch_enriched_item(self, title: str, content_type: str,
+                                  raise_errors: bool = False) -> Dict[str, Any]:
+        """Fetch images, ratings and metadata from upstream, bypassing the caches
+
+        With `raise_errors`, upstream failures raise instead of yielding an
+        item with no data, which is then a genuine "not found".
+        """
+        enriched_data = self._empty_enriched_item(title, content_type)
+
         # Fetch from appropriate source
         if content_type in ["anime", "manga", "light_novels", "manhwa"]:
-            mal_data = await self.get_mal_data(title, content_type)
+            mal_data = await self.get_mal_data(title, content_type, raise_errors=raise_errors)
             if mal_data:
                 enriched_data["images"]["poster_url"] = mal_data.get("poster_url")
                 enriched_data["ratings"]["mal_rating"] = mal_data.get("rating")
@@ -142,7 +281,7 @@ class ImageAndRatingHandler:
                 enriched_data["metadata"]["genres"] = mal_data.get("genres")
                 enriched_data["metadata"]["year"] = mal_data.get("year")
         else:
-            imdb_data = await self.get_imdb_data(title)
+            imdb_data = await self.get_imdb_data(title, raise_errors=raise_errors)
             if imdb_data:
                 enriched_data["images"]["poster_url"] = imdb_data.get("poster_url")
                 enriched_data["ratings"]["imdb_rating"] = imdb_data.get("rating")
@@ -151,7 +290,6 @@ class ImageAndRatingHandler:
                 enriched_data["metadata"]["year"] = imdb_data.get("year")
                 enriched_data["metadata"]["director"] = imdb_data.get("director")
 
-        self.image_cache[cache_key] = enriched_data
         return enriched_data
 
     def clear_cache(self):
@@ -0,0 +1,321 @@
+"""
+Per-upstream rate limiting for the external APIs
+
+Each upstream gets a token bucket sized to its published limits. Callers that
+cannot get a token wait in a priority queue, so interactive requests are
+served before background enrichment and cache warming.
+
+Buckets live in each worker process, so the configured rates are divided by
+WEB_CONCURRENCY (the worker count, as gunicorn and uvicorn read it) to keep
+the host's total within the upstream's limits. Daily quotas are counted in
+SQLite and shared by every process using the same RATE_LIMIT_DB_PATH.
+"""
+
+import asyncio
+import contextvars
+import heapq
+import itertools
+import os
+import sqlite3
+import threading
+import time
+from contextlib import contextmanager
+from datetime import datetime, timezone
+from email.utils import parsedate_to_datetime
+from typing import Any, Dict, Iterator, List, Optional, Tuple
+
+# Lower values are served first.
+INTERACTIVE = 0
+BACKGROUND = 10
+
+# Priority of upstream calls made from the current task; tasks inherit it.
+request_priority: contextvars.ContextVar = contextvars.ContextVar("request_priority", default=INTERACTIVE)
+
+
+@contextmanager
+def background_priority() -> Iterator[None]:
+    """Run the block, and any task created in it, at background priority."""
+    token = request_priority.set(BACKGROUND)
+    try:
+        yield
+    finally:
+        request_priority.reset(token)
+
+
+class QuotaExceededError(RuntimeError):
+    """The upstream's daily request quota is used up."""
+
+
+# Empty RATE_LIMIT_DB_PATH counts daily quotas per process instead.
+RATE_LIMIT_DB_PATH = os.getenv("RATE_LIMIT_DB_PATH", "otakuverse_cache.db")
+# Worker processes sharing the host's upstream limits.
+WEB_CONCURRENCY = max(int(os.getenv("WEB_CONCURRENCY", "1")), 1)
+
+
+class SharedQuota:
+    """Per-upstream, per-day request counts in SQLite, shared across processes."""
+
+    def __init__(self, db_path: str = RATE_LIMIT_DB_PATH):
+        """Open the database and create the upstream_quota table if needed."""
+        self.db_path = db_path
+        self._lock = threading.Lock()
+        self.connection = sqlite3.connect(db_path, check_same_thread=False)
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.execute("PRAGMA synchronous=NORMAL")
+        self.connection.execute("""
+            CREATE TABLE IF NOT EXISTS upstream_quota (
+                upstream TEXT NOT NULL,
+                day TEXT NOT NULL,
+                used INTEGER NOT NULL DEFAULT 0,
+                PRIMARY KEY (upstream, day)
+            )
+        """)
+        self.connection.commit()
+
+    def take(self, upstream: str, day: str, limit: int) -> Optional[int]:
+        """Count one request. Returns the new count, or None if `limit` was already reached."""
+        with self._lock, self.connection:
+            # One conditional upsert, so racing workers cannot both take the last request
+            taken = self.connection.execute("""
+                INSERT INTO upstream_quota (upstream, day, used) VALUES (?, ?, 1)
+                ON CONFLICT (upstream, day) DO UPDATE SET used = used + 1
+                WHERE upstream_quota.used < ?
+            """, (upstream, day, limit)).rowcount
+            if not taken:
+                return None
+            return self.connection.execute(
+                "SELECT used FROM upstream_quota WHERE upstream = ? AND day = ?", (upstream, day)
+            ).fetchone()[0]
+
+    def exhaust(self, upstream: str, day: str, limit: int):
+        """Mark the day's quota as spent for every process."""
+        with self._lock, self.connection:
+            self.connection.execute("""
+                INSERT INTO upstream_quota (upstream, day, used) VALUES (?, ?, ?)
+                ON CONFLICT (upstream, day) DO UPDATE SET used = MAX(used, excluded.used)
+            """, (upstream, day, limit))
+
+
+_shared_quota: Optional[SharedQuota] = None
+_shared_quota_lock = threading.Lock()
+
+
+def get_shared_quota() -> Optional[SharedQuota]:
+    """Return the process-wide quota counter, or None when RATE_LIMIT_DB_PATH is empty."""
+    global _shared_quota
+    if not RATE_LIMIT_DB_PATH:
+        return None
+    with _shared_quota_lock:
+        if _shared_quota is None:
+            _shared_quota = SharedQuota()
+        return _shared_quota
+
+
+def parse_retry_after(value: Optional[str]) -> Optional[float]:
+    """Seconds to wait from a Retry-After header (delta-seconds or HTTP date)."""
+    if not value:
+        return None
+    try:
+        return max(float(value), 0.0)
+    except ValueError:
+        pass
+    try:
+        retry_at = parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return None
+    if retry_at.tzinfo is None:
+        retry_at = retry_at.replace(tzinfo=timezone.utc)
+    return max((retry_at - datetime.now(timezone.utc)).total_seconds(), 0.0)
+
+
+class TokenBucketLimiter:
+    """Token bucket with a priority queue of waiters and an optional daily quota.
+
+    `rate` tokens per second are added up to `burst`. A caller that finds no
+    token waits in a heap ordered by (priority, arrival); a single timer
+    wakes the queue when the next token is due, so waiting costs no polling.
+    penalize() empties the bucket and blocks everyone until a Retry-After
+    deadline has passed. With `shared_quota`, the daily quota is counted in
+    SQLite across processes; otherwise it is counted in this process.
+    """
+
+    def __init__(self, name: str, rate: float, burst: int, daily_quota: Optional[int] = None,
+                 shared_quota: bool = False):
+        """Create a full bucket for one upstream."""
+        self.name = name
+        self.rate = rate
+        self.burst = burst
+        self.daily_quota = daily_quota
+        self.shared_quota = shared_quota
+        self.tokens = float(burst)
+        self.updated = time.monotonic()
+        self.blocked_until = 0.0
+        self._waiters: List[Tuple[int, int, asyncio.Future]] = []
+        self._seq = itertools.count()
+        self._wakeup: Optional[asyncio.TimerHandle] = None
+        self._quota_day = None
+        self.used_today = 0
+        self.granted = 0
+        self.waited = 0
+        self.penalties = 0
+
+    def _refill(self, now: float):
+        """Add the tokens earned since the last update."""
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def _quota_store(self) -> Optional[SharedQuota]:
+        """The cross-process counter, if this limiter's quota is shared."""
+        return get_shared_quota() if self.shared_quota else None
+
+    def _today(self):
+        """Today's UTC date, resetting the local count when the day has changed."""
+        today = datetime.now(timezone.utc).date()
+        if today != self._quota_day:
+            self._quota_day = today
+            self.used_today = 0
+        return today
+
+    def _quota_spent(self) -> QuotaExceededError:
+        """Record today's quota as used up and build the error to raise."""
+        self.used_today = self.daily_quota
+        return QuotaExceededError(f"{self.name} daily quota of {self.daily_quota} requests used up")
+
+    async def _take_quota(self):
+        """Count one request against the daily quota, or raise if it is used up.
+
+        Only the SQLite write runs in the executor; the count is applied here
+        on the event loop, so limiter state is never touched from a thread.
+        """
+        if self.daily_quota is None:
+            return
+        today = self._today()
+        if self.used_today >= self.daily_quota:
+            raise self._quota_spent()
+        store = self._quota_store()
+        if store is None:
+            self.used_today += 1
+            return
+        used = await asyncio.get_running_loop().run_in_executor(
+            None, store.take, self.name, today.isoformat(), self.daily_quota
+        )
+        if today != self._today():
+            # The day rolled over while the write ran; the count belongs to yesterday
+            return
+        if used is None:
+            raise self._quota_spent()
+        self.used_today = used
+
+    def exhaust_quota(self):
+        """Treat today's quota as spent, e.g. after the upstream says so."""
+        if self.daily_quota is not None:
+            today = self._today()
+            self.used_today = self.daily_quota
+            store = self._quota_store()
+            if store is not None:
+                store.exhaust(self.name, today.isoformat(), self.daily_quota)
+
+    def _schedule(self, delay: float):
+        """(Re)arm the single wake-up timer on the running loop."""
+        if self._wakeup is not None:
+            self._wakeup.cancel()
+        self._wakeup = asyncio.get_running_loop().call_later(delay, self._on_wakeup)
+
+    def _on_wakeup(self):
+        self._wakeup = None
+        self._dispatch()
+
+    def _dispatch(self):
+        """Hand out available tokens to waiters in priority order."""
+        now = time.monotonic()
+        self._refill(now)
+        while self._waiters:
+            if now < self.blocked_until:
+                self._schedule(self.blocked_until - now)
+                return
+            _priority, _seq, future = self._waiters[0]
+            if future.done():
+                # Cancelled while waiting
+                heapq.heappop(self._waiters)
+                continue
+            if self.tokens < 1:
+                self._schedule((1 - self.tokens) / self.rate)
+                return
+            self.tokens -= 1
+            heapq.heappop(self._waiters)
+            future.set_result(None)
+
+    async def acquire(self, priority: Optional[int] = None):
+        """Wait for a token, then count the request against the daily quota.
+
+        Raises QuotaExceededError once the daily quota is spent. The quota is
+        taken only after the token, so callers cancelled while queued (e.g. by
+        a deadline) never spend quota.
+        """
+        if self.daily_quota is not None:
+            # Fail fast rather than queue for a request that cannot be made
+            self._today()
+            if self.used_today >= self.daily_quota:
+                raise self._quota_spent()
+        if priority is None:
+            priority = request_priority.get()
+
+        now = time.monotonic()
+        self._refill(now)
+        if not self._waiters and now >= self.blocked_until and self.tokens >= 1:
+            self.tokens -= 1
+        else:
+            self.waited += 1
+            future = asyncio.get_running_loop().create_future()
+            heapq.heappush(self._waiters, (priority, next(self._seq), future))
+            self._dispatch()
+            await future
+
+        await self._take_quota()
+        self.granted += 1
+
+    def penalize(self, retry_after: float):
+        """Stop granting tokens for `retry_after` seconds after an upstream 429/503."""
+        self.penalties += 1
+        self.tokens = 0.0
+        self.blocked_until = max(self.blocked_until, time.monotonic() + retry_after)
+
+    def stats(self) -> Dict[str, Any]:
+        """Counters for monitoring."""
+        return {
+            "rate": self.rate,
+            "burst": self.burst,
+            "tokens": round(self.tokens, 2),
+            "waiting": len(self._waiters),
+            "blocked_for": round(max(self.blocked_until - time.monotonic(), 0.0), 2),
+            "granted": self.granted,
+            "waited": self.waited,
+            "penalties": self.penalties,
+            "daily_quota": self.daily_quota,
+            "used_today": self.used_today,
+            "quota_shared": self._quota_store() is not None,
+        }
+
+
+def _limit(upstream: str, rate: str, burst: str) -> Tuple[float, int]:
+    """Read an upstream's host-wide rate and burst from the environment; return this worker's share."""
+    prefix = f"RATE_LIMIT_{upstream.upper()}"
+    rate = float(os.getenv(f"{prefix}_PER_SECOND", rate)) / WEB_CONCURRENCY
+    burst = max(int(os.getenv(f"{prefix}_BURST", burst)) // WEB_CONCURRENCY, 1)
+    return rate, burst
+
+
+# Jikan documents 3 requests/second; MAL does not publish a limit; OMDb's free
+# tier allows 1,000 requests per day. Rates are per host; quotas are per API key.
+OMDB_DAILY_QUOTA = int(os.getenv("OMDB_DAILY_QUOTA", "1000"))
+rate_limiters: Dict[str, TokenBucketLimiter] = {
+    "jikan": TokenBucketLimiter("jikan", *_limit("jikan", "3", "3")),
+    "mal": TokenBucketLimiter("mal", *_limit("mal", "5", "5")),
+    "omdb": TokenBucketLimiter("omdb", *_limit("omdb", "10", "10"),
+                               daily_quota=OMDB_DAILY_QUOTA or None, shared_quota=True),
+}
+
+
+def get_rate_limiter(upstream: str) -> TokenBucketLimiter:
+    """Return the limiter for an upstream."""
+    return rate_limiters[upstream]
@@ -1,17 +1,24 @@
-from fastapi import FastAPI, HTTPException
+from fastapi import Depends, FastAPI, Header, HTTPException, Query, Request
+from fastapi.responses import StreamingResponse
 from fastapi.middleware.cors import CORSMiddleware
 from pydantic import BaseModel
-from typing import Optional, List
+from typing import Callable, Optional, List
 import uuid
 from datetime import datetime
 import os
 import sys
 import json
+import asyncio
 
 # Add parent directory to path for imports
 sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
 
-from history_agent.db import HistoryDatabase
+from history_agent.async_db import AsyncHistoryDatabase
+from history_agent.db import (
+    decode_cursor, encode_cursor, history_position, recommendation_position, set_catalog_lookup
+)
+from history_agent.maintenance import RETENTION_DAYS, run_maintenance, worker_id
+from history_agent.bulk import CHUNK_SIZE, NdjsonImporter, export_ndjson
 from catalog_agent.agent import CatalogManager
 
 # Mood mapping from frontend to anime moods
@@ -42,9 +49,45 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
-# Initialize database
-db = HistoryDatabase()
+# Initialize database (queries run on a bounded executor, off the event loop)
+db = AsyncHistoryDatabase()
 catalog_manager = CatalogManager()
+set_catalog_lookup(catalog_manager.get_item)
+
+# Top genres from a user's affinity profile used when a request has no genres or moods
+AFFINITY_FALLBACK_GENRES = 3
+
+# Admin endpoints require this token in X-Admin-Token and are disabled without it
+ADMIN_TOKEN = os.getenv("ADMIN_TOKEN", "")
+
+
+async def require_admin(x_admin_token: Optional[str] = Header(None)):
+    """Reject admin requests without the configured token; with no token configured, reject all."""
+    if not ADMIN_TOKEN:
+        raise HTTPException(status_code=403, detail="Admin endpoints are disabled; set ADMIN_TOKEN")
+    if x_admin_token != ADMIN_TOKEN:
+        raise HTTPException(status_code=403, detail="Admin token required")
+
+# Recommendation retention job
+MAINTENANCE_INTERVAL_SECONDS = int(os.getenv("MAINTENANCE_INTERVAL_SECONDS", "3600"))
+maintenance_task: Optional[asyncio.Task] = None
+
+
+async def maintenance_loop():
+    """Periodically prune old recommendations and vacuum the freed space.
+
+    Every worker runs this loop, but only the holder of the database lease
+    does the work; the lease outlives two intervals so the holder keeps it.
+    """
+    holder = worker_id()
+    while True:
+        await asyncio.sleep(MAINTENANCE_INTERVAL_SECONDS)
+        try:
+            summary = await db.scatter(run_maintenance, RETENTION_DAYS, holder,
+                                       2 * MAINTENANCE_INTERVAL_SECONDS)
+            print(f"[MAINTENANCE] {summary}")
+        except Exception as e:
+            print(f"[MAINTENANCE] Failed: {e}")
 
 
 async def generate_explanation(title: str, content_type: str, genres: List[str], mood: List[str]) -> str:
@@ -57,6 +100,23 @@ async def generate_explanation(title: str, content_type: str, genres: List[str],
         print(f"Error generating explanation: {e}")
         return f"This {content_type} matches your preferences."
 
+def parse_cursor(cursor: Optional[str], size: int = 2):
+    """Decode a page cursor query parameter of `size` fields, rejecting malformed values."""
+    if cursor is None:
+        return None
+    try:
+        return decode_cursor(cursor, size)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+
+def paginate(rows: List[dict], limit: Optional[int], position: Callable[[dict], tuple]):
+    """Trim a limit+1 fetch to one page and build the cursor for the next page from position(last row)."""
+    if limit is None or len(rows) <= limit:
+        return rows, None
+    page = rows[:limit]
+    return page, encode_cursor(*position(page[-1]))
+
 # Pydantic models
 class UserCreate(BaseModel):
     user_id: str
@@ -106,7 +166,7 @@ async def root():
 @app.post("/users")
 async def create_user(user: UserCreate):
     """Create a new user or get existing user."""
-    db.create_user(user.user_id, user.preferences)
+    await db.create_user(user.user_id, user.preferences)
     return {
         "user_id": user.user_id,
         "message": "User created or updated",
@@ -117,20 +177,32 @@ async def create_user(user: UserCreate):
 @app.get("/users/{user_id}")
 async def get_user(user_id: str):
     """Get user profile and preferences."""
-    user = db.get_user(user_id)
+    user = await db.get_user(user_id)
     if not user:
         raise HTTPException(status_code=404, detail="User not found")
     return user
 
 
 @app.get("/users/{user_id}/history")
-async def get_user_history(user_id: str, content_type: Optional[str] = None):
-    """Get user's content history."""
-    history = db.get_user_history(user_id, content_type)
+async def get_user_history(user_id: str, content_type: Optional[str] = None,
+                           limit: Optional[int] = Query(None, ge=1, le=500),
+                           cursor: Optional[str] = None):
+    """Get user's content history, newest first.
+    
+    Pass `limit` to page; follow `next_cursor` to fetch the next page.
+    """
+    history = await db.get_user_history(
+        user_id,
+        content_type,
+        limit=limit + 1 if limit else None,
+        cursor=parse_cursor(cursor)
+    )
+    history, next_cursor = paginate(history, limit, history_position)
     return {
         "user_id": user_id,
         "count": len(history),
-        "history": history
+        "history": history,
+        "next_cursor": next_cursor
     }
 
 
@@ -138,10 +210,10 @@ async def get_user_history(user_id: str, content_type: Optional[str] = None):
 async def add_to_history(user_id: str, entry: ContentHistoryEntry):
     """Add content to user's history."""
     # Ensure user exists
-    if not db.get_user(user_id):
-        db.create_user(user_id)
+    if not await db.get_user(user_id):
+        await db.create_user(user_id)
     
-    db.add_to_history(
+    await db.add_to_history(
         user_id, 
         entry.content_id, 
         entry.content_type, 
@@ -180,9 +252,9 @@ async def get_recommendations(request: RecommendationRequest):
     """Get recommendations for a user."""
     
     # Ensure user exists
-    user = db.get_user(request.user_id)
+    user = await db.get_user(request.user_id)
     if not user:
-        db.create_user(request.user_id)
+        await db.create_user(request.user_id)
     
     # Validate that content_types are provided
     if not request.content_types:
@@ -191,8 +263,12 @@ async def get_recommendations(request: RecommendationRequest):
             detail="content_types must be specified"
         )
     
-    # Get user's consumed content
-    consumed_ids = db.get_consumed_ids(request.user_id)
+    # Without explicit criteria, personalize from the user's taste profile
+    if not request.genres and not request.moods:
+        affinity = await db.get_user_affinity(request.user_id)
+        top_genres = list(affinity["genre"])[:AFFINITY_FALLBACK_GENRES]
+        if top_genres:
+            request.genres = top_genres
     
     # Search catalog
     try:
@@ -228,7 +304,10 @@ async def get_recommendations(request: RecommendationRequest):
         else:
             results = catalog_manager.get_by_type(request.content_types)
         
-        # Filter out consumed content
+        # Filter out consumed content, checked for just these candidates off the event loop
+        consumed_ids = await db.consumed_among(
+            request.user_id, [item["id"] for item in results if item.get("id")]
+        )
         filtered_results = catalog_manager.filter_out_consumed(results, consumed_ids)
         
         # Limit to top 10 recommendations
@@ -267,7 +346,7 @@ async def get_recommendations(request: RecommendationRequest):
             formatted_recommendations.append(formatted_rec)
             
             # Save to database
-            db.save_recommendation(
+            await db.save_recommendation(
                 request.user_id,
                 batch_id,
                 rec.get("id"),
@@ -297,16 +376,82 @@ async def get_recommendations(request: RecommendationRequest):
 
 
 @app.get("/recommendations/{user_id}")
-async def get_user_recommendations(user_id: str):
-    """Get user's past recommendations."""
-    recommendations = db.get_recommendations(user_id)
+async def get_user_recommendations(user_id: str,
+                                   limit: Optional[int] = Query(None, ge=1, le=500),
+                                   cursor: Optional[str] = None):
+    """Get user's past recommendations, newest batch first.
+    
+    Pass `limit` to page; follow `next_cursor` to fetch the next page.
+    """
+    recommendations = await db.get_recommendations(
+        user_id,
+        limit=limit + 1 if limit else None,
+        cursor=parse_cursor(cursor, size=3)
+    )
+    recommendations, next_cursor = paginate(recommendations, limit, recommendation_position)
     return {
         "user_id": user_id,
         "count": len(recommendations),
-        "recommendations": recommendations
+        "recommendations": recommendations,
+        "next_cursor": next_cursor
     }
 
 
+@app.get("/admin/stats", dependencies=[Depends(require_admin)])
+async def get_admin_stats():
+    """Get history database row counts, gathered across all shards."""
+    return await db.get_stats()
+
+
+@app.get("/admin/export", dependencies=[Depends(require_admin)])
+async def export_history(tables: str = "content_history,recommendations"):
+    """Stream content_history and recommendations rows out as NDJSON."""
+    table_list = [t.strip() for t in tables.split(",") if t.strip()]
+    try:
+        rows = export_ndjson(db.pool, table_list)
+        # Priming opens the first shard; keep that off the event loop too
+        first = await db.run_blocking(next, rows, "")
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    
+    # StreamingResponse iterates sync generators in its threadpool
+    def stream():
+        if first:
+            yield first
+        yield from rows
+    
+    return StreamingResponse(stream(), media_type="application/x-ndjson")
+
+
+@app.post("/admin/import", dependencies=[Depends(require_admin)])
+async def import_history(request: Request):
+    """Import NDJSON rows from the request body in chunked transactions.
+    
+    The body is streamed; at most one chunk of lines is held in memory.
+    """
+    importer = NdjsonImporter(db.pool)
+    pending = b""
+    lines = []
+    try:
+        async for chunk in request.stream():
+            pending += chunk
+            *complete, pending = pending.split(b"\n")
+            lines.extend(complete)
+            if len(lines) >= CHUNK_SIZE:
+                await db.run_blocking(importer.feed_lines, lines)
+                lines = []
+        lines.append(pending)
+        await db.run_blocking(importer.feed_lines, lines)
+        counts = await db.run_blocking(importer.flush)
+    except ValueError as e:
+        # Chunks flushed before the bad line stay committed; report how many
+        raise HTTPException(status_code=400, detail={
+            "error": str(e), "rows_committed": dict(importer.counts)
+        })
+    
+    return {"status": "imported", "lines": importer.lines_read, "rows": counts}
+
+
 @app.get("/health")
 async def health_check():
     """Health check endpoint."""
@@ -429,10 +574,20 @@ async def search(q: str, limit: int = 25):
         raise HTTPException(status_code=500, detail=f"Search error: {str(e)}")
 
 
+@app.on_event("startup")
+async def startup_event():
+    """Start the recommendation retention job."""
+    global maintenance_task
+    if MAINTENANCE_INTERVAL_SECONDS > 0:
+        maintenance_task = asyncio.create_task(maintenance_loop())
+
+
 @app.on_event("shutdown")
 async def shutdown_event():
-    """Close database connection on shutdown."""
-    db.close()
+    """Stop background jobs and close database connection on shutdown."""
+    if maintenance_task:
+        maintenance_task.cancel()
+    await db.close()
 
 
 if __name__ == "__main__":
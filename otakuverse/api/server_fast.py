@@ -3,10 +3,10 @@ Ultra-Fast OtakuVerse API - Optimized for Speed
 Uses caching, parallel operations, and Gemini for instant responses
 """
 
-from fastapi import FastAPI, HTTPException
+from fastapi import FastAPI, HTTPException, Depends, Header
 from fastapi.middleware.cors import CORSMiddleware
-from pydantic import BaseModel
-from typing import Optional, List
+from pydantic import BaseModel, Field
+from typing import Optional, List, Tuple
 import uuid
 from datetime import datetime
 import os
@@ -16,9 +16,19 @@ import asyncio
 
 sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
 
-from history_agent.db import HistoryDatabase
+from history_agent.async_db import AsyncHistoryDatabase
+from history_agent.db import set_catalog_lookup
 from catalog_agent.agent import CatalogManager
 from agents.fast_cache_agent import fast_cache
+from agents.cache_daemon import create_cache
+from agents.disk_cache import get_disk_cache
+from agents.query_log import QUERY_LOG_PRUNE_INTERVAL, get_query_log, normalize_query
+from agents.single_flight import SingleFlight
+from agents.ttl_cache import cache_report, expiry_loop
+from api.deadline import (
+    MAX_RECOMMENDATION_BUDGET_MS, RECOMMENDATION_BUDGET_MS, DeadlineExceededError, deadline_budget,
+    within_deadline, without_deadline
+)
 
 # Initialize FastAPI with response compression
 app = FastAPI(
@@ -37,13 +47,83 @@ app.add_middleware(
 )
 
 # Initialize services
-db = HistoryDatabase()
+db = AsyncHistoryDatabase()
 catalog_manager = CatalogManager()
+expiry_task: Optional[asyncio.Task] = None
+
+# Recommendation lists depend only on the request filters and catalog versions,
+# so they are cached and re-stamped with fresh ids per request
+RECOMMENDATION_CACHE_MAX_ENTRIES = int(os.getenv("RECOMMENDATION_CACHE_MAX_ENTRIES", "2000"))
+RECOMMENDATION_CACHE_TTL = float(os.getenv("RECOMMENDATION_CACHE_TTL", "900"))
+recommendation_cache = create_cache("recommendations", max_entries=RECOMMENDATION_CACHE_MAX_ENTRIES,
+                                    ttl=RECOMMENDATION_CACHE_TTL, l2=get_disk_cache())
+recommendation_flights = SingleFlight()
+
+# Popular queries are logged and replayed after startup and catalog reloads
+query_log = get_query_log()
+CACHE_WARM_TOP_N = int(os.getenv("CACHE_WARM_TOP_N", "50"))
+warm_task: Optional[asyncio.Task] = None
+prune_task: Optional[asyncio.Task] = None
+
+ADMIN_TOKEN = os.getenv("ADMIN_TOKEN", "")
+
+
+async def require_admin(x_admin_token: Optional[str] = Header(None)):
+    """Reject admin requests without the configured token; with no token configured, reject all."""
+    if not ADMIN_TOKEN:
+        raise HTTPException(status_code=403, detail="Admin endpoints are disabled; set ADMIN_TOKEN")
+    if x_admin_token != ADMIN_TOKEN:
+        raise HTTPException(status_code=403, detail="Admin token required")
+
+
+async def warm_caches(top_n: int = CACHE_WARM_TOP_N):
+    """Replay the most frequent searches and recommendation requests to pre-fill caches"""
+    warmed = 0
+    for params, _hits in query_log.top("search", top_n):
+        try:
+            await run_search(params.get("q", ""), params.get("content_type"))
+            warmed += 1
+        except Exception as e:
+            print(f"[WARM] Search {params} failed: {e}")
+        await asyncio.sleep(0)
+    
+    for params, _hits in query_log.top("recommendations", top_n):
+        try:
+            await cached_recommendations(params.get("content_types", []), params.get("genres"), params.get("moods"))
+            warmed += 1
+        except Exception as e:
+            print(f"[WARM] Recommendations {params} failed: {e}")
+        await asyncio.sleep(0)
+    
+    print(f"[WARM] Replayed {warmed} popular queries")
+
+
+async def query_log_prune_loop(interval: float = QUERY_LOG_PRUNE_INTERVAL):
+    """Periodically drop stale and rarely seen queries so the query log stays bounded"""
+    loop = asyncio.get_running_loop()
+    while True:
+        try:
+            deleted = await loop.run_in_executor(None, query_log.prune)
+            if deleted:
+                print(f"[QUERY LOG] Pruned {deleted} queries")
+        except Exception as e:
+            print(f"[QUERY LOG] Prune failed: {e}")
+        await asyncio.sleep(interval)
+
+
+def schedule_cache_warming():
+    """Start warming in the background, replacing any run still in progress"""
+    global warm_task
+    if warm_task and not warm_task.done():
+        warm_task.cancel()
+    warm_task = asyncio.create_task(warm_caches())
 
 # Pre-load all catalogs into fast cache on startup
 @app.on_event("startup")
 async def startup_event():
     """Pre-cache all catalogs for instant access"""
+    # History writes look up genres and moods here for the user's affinity profile
+    set_catalog_lookup(catalog_manager.get_item)
     print("[STARTUP] Pre-caching all catalogs...")
     
     for content_type, catalog in catalog_manager.catalogs.items():
@@ -52,6 +132,21 @@ async def startup_event():
     
     print("[SUCCESS] All catalogs cached - Ready for ultra-fast performance!")
 
+    global expiry_task, prune_task
+    expiry_task = asyncio.create_task(expiry_loop(fast_cache.caches + [recommendation_cache]))
+    prune_task = asyncio.create_task(query_log_prune_loop())
+    schedule_cache_warming()
+
+
+@app.on_event("shutdown")
+async def shutdown_event():
+    """Stop background cache tasks, persist the query log and close history database connections on shutdown"""
+    for task in (expiry_task, warm_task, prune_task):
+        if task:
+            task.cancel()
+    query_log.flush()
+    await db.close()
+
 
 # ==================== Pydantic Models ====================
 
@@ -60,6 +155,8 @@ class RecommendationRequest(BaseModel):
     genres: Optional[List[str]] = None
     moods: Optional[List[str]] = None
     content_types: List[str]
+    # Latency budget; defaults to RECOMMENDATION_BUDGET_MS
+    budget_ms: Optional[int] = Field(None, ge=1, le=MAX_RECOMMENDATION_BUDGET_MS)
 
 
 class ContentHistoryEntry(BaseModel):
@@ -148,6 +245,138 @@ async def get_catalog_by_type_fast(content_type: str):
         raise HTTPException(status_code=500, detail=str(e))
 
 
+async def rank_items(content_types: List[str],
+                     genres: Optional[List[str]],
+                     moods: Optional[List[str]]) -> List[dict]:
+    """Top catalog items for the filters, best match first."""
+    # Get all cached items for the requested content types in parallel
+    print(f"[RECO] Fetching catalogs for: {content_types}")
+    tasks = [
+        fast_cache.get_cached_catalog(ct.replace('-', '_').lower())
+        for ct in content_types
+    ]
+    
+    catalog_results = await asyncio.gather(*tasks)
+    all_items = []
+    for items in catalog_results:
+        all_items.extend(items)
+    
+    print(f"[RECO] Total items found: {len(all_items)}")
+    
+    # Skip consumed check for now
+    # consumed_ids = db.get_consumed_ids(request.user_id)
+    # available_items = [
+    #     item for item in all_items 
+    #     if item.get("id") not in consumed_ids
+    # ]
+    available_items = all_items
+    
+    # Sort by relevance if genres/moods specified
+    if genres or moods:
+        scored_items = []
+        
+        for item in available_items:
+            score = 0
+            if genres:
+                score += sum(1 for g in genres 
+                           if g.lower() in [x.lower() for x in item.get("genres", [])])
+            if moods:
+                score += sum(1 for m in moods 
+                           if m.lower() in [x.lower() for x in item.get("mood", [])])
+            
+            if score > 0:
+                scored_items.append((item, score))
+        
+        # Sort by score descending
+        scored_items.sort(key=lambda x: x[1], reverse=True)
+        available_items = [item for item, _ in scored_items[:20]]
+    else:
+        # Return up to 20 items
+        available_items = available_items[:20]
+    
+    return available_items
+
+
+def format_recommendations(items: List[dict], enrichments: List[Optional[dict]]) -> List[dict]:
+    """Shape ranked items and their external data (None for none) into recommendations."""
+    recommendations = []
+    for i, (item, enriched) in enumerate(zip(items, enrichments)):
+        if enriched is None:
+            enriched = {"mal_rating": None, "imdb_rating": None, "cover_image": None}
+        
+        recommendations.append({
+            "content_id": item.get("id"),
+            "title": item.get("title"),
+            "content_type": item.get("content_type"),
+            "genres": item.get("genres", []),
+            "mood": item.get("mood", []),
+            "rating": item.get("rating", 0),
+            "description": item.get("description", ""),
+            "mal_score": enriched.get("mal_rating"),
+            "imdb_score": enriched.get("imdb_rating"),
+            "cover_image": enriched.get("cover_image"),
+            "rank": i + 1
+        })
+    
+    return recommendations
+
+
+async def build_recommendations(content_types: List[str],
+                                genres: Optional[List[str]],
+                                moods: Optional[List[str]]) -> List[dict]:
+    """Rank catalog items for the filters and attach external data (no per-request ids)."""
+    items = await rank_items(content_types, genres, moods)
+    
+    # External data (MAL/IMDb) for the top items, in one enrichment store read
+    try:
+        enrichments = await fast_cache.get_many_enriched_with_external_only([
+            (item.get("title", ""), item.get("content_type", ""))
+            for item in items
+        ])
+    except Exception as e:
+        print(f"Enrichment error: {e}")
+        enrichments = [None] * len(items)
+    return format_recommendations(items, enrichments)
+
+
+async def cached_recommendations(content_types: List[str],
+                                 genres: Optional[List[str]],
+                                 moods: Optional[List[str]]) -> Tuple[List[dict], bool]:
+    """Recommendations from the response cache, computing each distinct request once.
+
+    Returns (recommendations, partial). The shared computation runs free of
+    any caller's deadline and is cached once complete; each caller waits only
+    until its own deadline, then gets the ranked items without external data
+    (partial, never cached).
+    """
+    params = normalize_query({
+        "content_types": [ct.replace('-', '_') for ct in content_types],
+        "genres": genres,
+        "moods": moods,
+    })
+    content_types = params.get("content_types", [])
+    cache_key = fast_cache._get_cache_key(
+        "recommendations", json.dumps(params, sort_keys=True), *fast_cache.catalog_versions(content_types)
+    )
+    
+    cached = await recommendation_cache.aget(cache_key)
+    if cached is not None:
+        return cached, False
+    
+    async def compute() -> List[dict]:
+        # Coalesced callers must not inherit the deadline of whichever caller started the flight
+        with without_deadline():
+            recommendations = await build_recommendations(content_types, params.get("genres"), params.get("moods"))
+            await recommendation_cache.aset(cache_key, recommendations)
+            return recommendations
+    
+    try:
+        return await within_deadline(recommendation_flights.do(cache_key, compute)), False
+    except DeadlineExceededError:
+        items = await rank_items(content_types, params.get("genres"), params.get("moods"))
+        return format_recommendations(items, [None] * len(items)), True
+
+
 @app.post("/recommendations")
 async def get_recommendations_fast(request: RecommendationRequest):
     """
@@ -168,100 +397,34 @@ async def get_recommendations_fast(request: RecommendationRequest):
         if not request.content_types:
             raise HTTPException(status_code=400, detail="content_types required")
         
-        # Get all cached items for the requested content types in parallel
-        print(f"[RECO] Fetching catalogs for: {request.content_types}")
-        tasks = [
-            fast_cache.get_cached_catalog(ct.replace('-', '_').lower())
-            for ct in request.content_types
-        ]
-        
-        catalog_results = await asyncio.gather(*tasks)
-        all_items = []
-        for items in catalog_results:
-            all_items.extend(items)
-        
-        print(f"[RECO] Total items found: {len(all_items)}")
-        
-        # Skip consumed check for now
-        # consumed_ids = db.get_consumed_ids(request.user_id)
-        # available_items = [
-        #     item for item in all_items 
-        #     if item.get("id") not in consumed_ids
-        # ]
-        available_items = all_items
-        
-        # Sort by relevance if genres/moods specified
-        if request.genres or request.moods:
-            scored_items = []
-            
-            for item in available_items:
-                score = 0
-                if request.genres:
-                    score += sum(1 for g in request.genres 
-                               if g.lower() in [x.lower() for x in item.get("genres", [])])
-                if request.moods:
-                    score += sum(1 for m in request.moods 
-                               if m.lower() in [x.lower() for x in item.get("mood", [])])
-                
-                if score > 0:
-                    scored_items.append((item, score))
-            
-            # Sort by score descending
-            scored_items.sort(key=lambda x: x[1], reverse=True)
-            available_items = [item for item, _ in scored_items[:20]]
-        else:
-            # Return up to 20 items
-            available_items = available_items[:20]
-        
-        # Fetch external data (MAL/IMDb) for top items in parallel
-        enrichment_tasks = [
-            fast_cache.get_enriched_with_external_only(
-                item.get("title", ""),
-                item.get("content_type", "")
-            )
-            for item in available_items
-        ]
-        
-        enrichments = await asyncio.gather(*enrichment_tasks, return_exceptions=True)
+        query_log.record("recommendations", {
+            "content_types": [ct.replace('-', '_') for ct in request.content_types],
+            "genres": request.genres,
+            "moods": request.moods,
+        })
+        with deadline_budget(request.budget_ms or RECOMMENDATION_BUDGET_MS):
+            cached, partial = await cached_recommendations(request.content_types, request.genres, request.moods)
         
         # Format response
         batch_id = str(uuid.uuid4())
-        recommendations = []
+        recommendations = [
+            {"recommendation_id": f"{batch_id}_{i}", **rec}
+            for i, rec in enumerate(cached)
+        ]
         
-        for i, (item, enriched) in enumerate(zip(available_items, enrichments)):
-            if isinstance(enriched, Exception):
-                print(f"Enrichment error for {item.get('title')}: {enriched}")
-                enriched = {"mal_rating": None, "imdb_rating": None, "cover_image": None}
-            
-            rec = {
-                "recommendation_id": f"{batch_id}_{i}",
-                "content_id": item.get("id"),
-                "title": item.get("title"),
-                "content_type": item.get("content_type"),
-                "genres": item.get("genres", []),
-                "mood": item.get("mood", []),
-                "rating": item.get("rating", 0),
-                "description": item.get("description", ""),
-                "mal_score": enriched.get("mal_rating"),
-                "imdb_score": enriched.get("imdb_rating"),
-                "cover_image": enriched.get("cover_image"),
-                "rank": i + 1
-            }
-            
-            recommendations.append(rec)
-            
-            # Skip DB save for now
-            # db.save_recommendation(
-            #     request.user_id, batch_id, item.get("id"),
-            #     item.get("content_type"), item.get("title"),
-            #     f"Recommendation {i+1}", i + 1
-            # )
+        # Skip DB save for now
+        # db.save_recommendation(
+        #     request.user_id, batch_id, item.get("id"),
+        #     item.get("content_type"), item.get("title"),
+        #     f"Recommendation {i+1}", i + 1
+        # )
         
         return {
             "status": "success",
             "user_id": request.user_id,
             "count": len(recommendations),
             "recommendations": recommendations,
+            "partial": partial,
             "response_time_ms": f"1-3s (external data only)"
         }
         
@@ -272,6 +435,20 @@ async def get_recommendations_fast(request: RecommendationRequest):
         raise HTTPException(status_code=500, detail=str(e))
 
 
+async def run_search(q: str, content_type: Optional[str] = None) -> List[dict]:
+    """Search the catalogs, optionally limited to one content type"""
+    # Get all cached items
+    all_items = []
+    searched_types = []
+    for ct, catalog in catalog_manager.catalogs.items():
+        if content_type is None or ct == content_type:
+            all_items.extend(catalog)
+            searched_types.append(ct)
+    
+    # Fast search, cached per searched catalog slice and version
+    return await fast_cache.search_fast(q, all_items, limit=20, content_types=searched_types)
+
+
 @app.get("/search")
 async def search_fast(q: str, content_type: Optional[str] = None):
     """
@@ -279,14 +456,8 @@ async def search_fast(q: str, content_type: Optional[str] = None):
     Response time: < 20ms
     """
     try:
-        # Get all cached items
-        all_items = []
-        for ct, catalog in catalog_manager.catalogs.items():
-            if content_type is None or ct == content_type:
-                all_items.extend(catalog)
-        
-        # Fast search
-        results = await fast_cache.search_fast(q, all_items, limit=20)
+        query_log.record("search", {"q": q, "content_type": content_type})
+        results = await run_search(q, content_type)
         
         return {
             "query": q,
@@ -298,27 +469,50 @@ async def search_fast(q: str, content_type: Optional[str] = None):
         raise HTTPException(status_code=500, detail=str(e))
 
 
+@app.post("/admin/catalog/reload", dependencies=[Depends(require_admin)])
+async def reload_catalogs():
+    """Reload catalog files, re-version dependent caches and re-warm popular queries"""
+    catalog_manager.load_catalogs()
+    for content_type, catalog in catalog_manager.catalogs.items():
+        await fast_cache.cache_catalog(content_type, catalog)
+    schedule_cache_warming()
+    return {
+        "status": "reloaded",
+        "catalogs": {ct: len(items) for ct, items in catalog_manager.catalogs.items()}
+    }
+
+
+@app.get("/debug/caches")
+async def debug_caches():
+    """Hit/miss/eviction counters, sizes and entry ages for every cache in this worker"""
+    disk_cache = get_disk_cache()
+    return {
+        "caches": cache_report(),
+        "disk": disk_cache.stats() if disk_cache else None
+    }
+
+
 @app.post("/users")
 async def create_user_fast(user: UserCreate):
     """Create user instantly"""
-    db.create_user(user.user_id, user.preferences)
+    await db.create_user(user.user_id, user.preferences)
     return {"user_id": user.user_id, "status": "created"}
 
 
 @app.get("/users/{user_id}/history")
 async def get_history_fast(user_id: str):
     """Get user history instantly"""
-    history = db.get_user_history(user_id)
+    history = await db.get_user_history(user_id)
     return {"user_id": user_id, "count": len(history), "history": history}
 
 
 @app.post("/users/{user_id}/history")
 async def add_to_history_fast(user_id: str, entry: ContentHistoryEntry):
     """Add to history instantly"""
-    if not db.get_user(user_id):
-        db.create_user(user_id)
+    if not await db.get_user(user_id):
+        await db.create_user(user_id)
     
-    db.add_to_history(
+    await db.add_to_history(
         user_id, entry.content_id, entry.content_type, entry.title, entry.rating
     )
     return {"status": "added"}
@@ -44,10 +44,24 @@ def load_env_file():
 
 load_env_file()
 
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
 from fastapi import FastAPI, HTTPException
 from fastapi.middleware.cors import CORSMiddleware
-from pydantic import BaseModel
-import httpx
+from pydantic import BaseModel, Field
+
+from history_agent.user_state import create_async_user_state_store
+from api.http_clients import close_http_clients, start_http_clients, upstream_get
+from api.circuit_breaker import CircuitOpenError, circuit_breakers
+from api.deadline import (
+    MAX_RECOMMENDATION_BUDGET_MS, RECOMMENDATION_BUDGET_MS, DeadlineExceededError,
+    deadline_budget, gather_within_deadline
+)
+from api.rate_limiter import get_rate_limiter, rate_limiters
+from agents.disk_cache import get_disk_cache
+from agents.negative_cache import NegativeCache
+from agents.single_flight import SingleFlight
+from agents.ttl_cache import TTLCache, cache_report
 
 # API Keys
 OMDB_API_KEY = os.getenv("OMDB_API_KEY", "")
@@ -77,12 +91,22 @@ class RecommendationRequest(BaseModel):
     content_types: List[str]
     exclude_titles: Optional[List[str]] = None
     count: Optional[int] = 15
-
-# In-memory storage
-user_history = {}
-user_watchlater = {}
-user_settings = {}
-search_cache = {}  # Cache search results for persistent catalog
+    # Latency budget; defaults to RECOMMENDATION_BUDGET_MS
+    budget_ms: Optional[int] = Field(None, ge=1, le=MAX_RECOMMENDATION_BUDGET_MS)
+
+# Per-user history and watch later: hot users in a bounded LRU, all users in SQLite
+user_state = create_async_user_state_store()
+USER_HISTORY_MAX_ITEMS = int(os.getenv("USER_HISTORY_MAX_ITEMS", "100"))
+USER_WATCHLATER_MAX_ITEMS = int(os.getenv("USER_WATCHLATER_MAX_ITEMS", "500"))
+# Search results double as the persistent catalog, so they do not expire; the
+# least recently used queries are dropped once the cache is full. They are
+# also kept on disk and reloaded on startup.
+SEARCH_CACHE_MAX_ENTRIES = int(os.getenv("SEARCH_CACHE_MAX_ENTRIES", "5000"))
+search_cache = TTLCache("mal_search", max_entries=SEARCH_CACHE_MAX_ENTRIES, ttl=None,
+                        l2=get_disk_cache())
+search_flights = SingleFlight()
+# Queries MAL/OMDb had no results for, or failed on, are not retried until expiry
+upstream_negative_cache = NegativeCache("upstream")
 
 
 # ==================== MAL API Functions ====================
@@ -92,38 +116,46 @@ async def fetch_mal_anime(query: str, limit: int = 10) -> List[dict]:
     if not MAL_CLIENT_ID:
         print("[WARNING] MAL_CLIENT_ID not configured")
         return []
+    if upstream_negative_cache.check("mal_anime", query):
+        return []
     
     try:
-        async with httpx.AsyncClient(timeout=15) as client:
-            headers = {"X-MAL-CLIENT-ID": MAL_CLIENT_ID}
-            
-            # Properly encode the query
-            params = {
-                "query": query.strip(),
-                "limit": min(limit, 25),
-                "fields": "id,title,mean,main_picture,genres,synopsis,status,num_episodes"
-            }
-            
-            response = await client.get(
-                "https://api.myanimelist.net/v2/anime/search",
-                params=params,
-                headers=headers
-            )
-            
-            if response.status_code == 200:
-                data = response.json()
-                results = data.get("data", [])
-                if results:
-                    print(f"[MAL API] ✓ Found {len(results)} results for '{query}'")
-                    return results
-                else:
-                    print(f"[MAL API] ✗ No results for '{query}'")
-                    return []
+        headers = {"X-MAL-CLIENT-ID": MAL_CLIENT_ID}
+        
+        # Properly encode the query
+        params = {
+            "query": query.strip(),
+            "limit": min(limit, 25),
+            "fields": "id,title,mean,main_picture,genres,synopsis,status,num_episodes"
+        }
+        
+        response = await upstream_get(
+            "mal",
+            "https://api.myanimelist.net/v2/anime/search",
+            params=params,
+            headers=headers
+        )
+        
+        if response.status_code == 200:
+            data = response.json()
+            results = data.get("data", [])
+            if results:
+                print(f"[MAL API] ✓ Found {len(results)} results for '{query}'")
+                return results
             else:
-                print(f"[MAL API] Error {response.status_code}: {response.text}")
+                print(f"[MAL API] ✗ No results for '{query}'")
+                upstream_negative_cache.record_miss("mal_anime", query)
                 return []
+        else:
+            print(f"[MAL API] Error {response.status_code}: {response.text}")
+            upstream_negative_cache.record_error("mal_anime", query)
+            return []
+    except (CircuitOpenError, DeadlineExceededError):
+        # Upstream is degraded or the request ran out of time: not the query's fault
+        return []
     except Exception as e:
         print(f"[ERROR] MAL API exception: {str(e)}")
+        upstream_negative_cache.record_error("mal_anime", query)
         return []
 
 
@@ -132,90 +164,125 @@ async def fetch_mal_manga(query: str, limit: int = 10) -> List[dict]:
     if not MAL_CLIENT_ID:
         print("[WARNING] MAL_CLIENT_ID not configured")
         return []
+    if upstream_negative_cache.check("mal_manga", query):
+        return []
     
     try:
-        async with httpx.AsyncClient(timeout=15) as client:
-            headers = {"X-MAL-CLIENT-ID": MAL_CLIENT_ID}
-            
-            params = {
-                "query": query.strip(),
-                "limit": min(limit, 25),
-                "fields": "id,title,mean,main_picture,genres,synopsis,status"
-            }
-            
-            response = await client.get(
-                "https://api.myanimelist.net/v2/manga/search",
-                params=params,
-                headers=headers
-            )
-            
-            if response.status_code == 200:
-                data = response.json()
-                results = data.get("data", [])
-                if results:
-                    print(f"[MAL API] ✓ Found {len(results)} manga results for '{query}'")
-                    return results
-                else:
-                    print(f"[MAL API] ✗ No manga results for '{query}'")
-                    return []
+        headers = {"X-MAL-CLIENT-ID": MAL_CLIENT_ID}
+        
+        params = {
+            "query": query.strip(),
+            "limit": min(limit, 25),
+            "fields": "id,title,mean,main_picture,genres,synopsis,status"
+        }
+        
+        response = await upstream_get(
+            "mal",
+            "https://api.myanimelist.net/v2/manga/search",
+            params=params,
+            headers=headers
+        )
+        
+        if response.status_code == 200:
+            data = response.json()
+            results = data.get("data", [])
+            if results:
+                print(f"[MAL API] ✓ Found {len(results)} manga results for '{query}'")
+                return results
             else:
-                print(f"[MAL API] Error {response.status_code}: {response.text}")
+                print(f"[MAL API] ✗ No manga results for '{query}'")
+                upstream_negative_cache.record_miss("mal_manga", query)
                 return []
+        else:
+            print(f"[MAL API] Error {response.status_code}: {response.text}")
+            upstream_negative_cache.record_error("mal_manga", query)
+            return []
+    except (CircuitOpenError, DeadlineExceededError):
+        return []
     except Exception as e:
         print(f"[ERROR] MAL Manga API exception: {str(e)}")
+        upstream_negative_cache.record_error("mal_manga", query)
         return []
 
 
 # ==================== IMDb Functions ====================
 
+def record_omdb_failure(kind: str, query: str, data: dict):
+    """Negative-cache an OMDb "Response": "False" answer as a miss or an error"""
+    # "Movie not found!" / "Series not found!" / "Too many results." mean no usable
+    # match; anything else (invalid key, request limit) is an upstream failure
+    error = str(data.get("Error", ""))
+    if error.endswith("not found!") or error.startswith("Too many results"):
+        upstream_negative_cache.record_miss(kind, query)
+    else:
+        if error.startswith("Request limit reached"):
+            # Daily quota spent: stop calling OMDb until the day rolls over
+            get_rate_limiter("omdb").exhaust_quota()
+        upstream_negative_cache.record_error(kind, query)
+
+
 async def fetch_imdb_movies(query: str, year: Optional[int] = None) -> List[dict]:
     """Fetch movies from OMDb (IMDb API)"""
     if not OMDB_API_KEY:
         print("[WARNING] OMDB_API_KEY not set")
         return []
+    if upstream_negative_cache.check("omdb_movie", query):
+        return []
     
     try:
-        async with httpx.AsyncClient(timeout=10) as client:
-            response = await client.get(
-                "http://www.omdbapi.com/",
-                params={
-                    "apikey": OMDB_API_KEY,
-                    "s": query,
-                    "type": "movie",
-                    "page": 1
-                }
-            )
-            if response.status_code == 200:
-                data = response.json()
-                if data.get("Response") == "True":
-                    return data.get("Search", [])
+        response = await upstream_get(
+            "omdb",
+            "http://www.omdbapi.com/",
+            params={
+                "apikey": OMDB_API_KEY,
+                "s": query,
+                "type": "movie",
+                "page": 1
+            }
+        )
+        if response.status_code == 200:
+            data = response.json()
+            if data.get("Response") == "True":
+                return data.get("Search", [])
+            record_omdb_failure("omdb_movie", query, data)
+        else:
+            upstream_negative_cache.record_error("omdb_movie", query)
+    except (CircuitOpenError, DeadlineExceededError):
+        return []
     except Exception as e:
         print(f"[ERROR] IMDb API: {e}")
+        upstream_negative_cache.record_error("omdb_movie", query)
     return []
 
 
 async def fetch_imdb_series(query: str) -> List[dict]:
     """Fetch TV series from OMDb"""
-    if not OMDB_API_KEY:
+    if not OMDB_API_KEY or upstream_negative_cache.check("omdb_series", query):
         return []
     
     try:
-        async with httpx.AsyncClient(timeout=10) as client:
-            response = await client.get(
-                "http://www.omdbapi.com/",
-                params={
-                    "apikey": OMDB_API_KEY,
-                    "s": query,
-                    "type": "series",
-                    "page": 1
-                }
-            )
-            if response.status_code == 200:
-                data = response.json()
-                if data.get("Response") == "True":
-                    return data.get("Search", [])
+        response = await upstream_get(
+            "omdb",
+            "http://www.omdbapi.com/",
+            params={
+                "apikey": OMDB_API_KEY,
+                "s": query,
+                "type": "series",
+                "page": 1
+            }
+        )
+        if response.status_code == 200:
+            data = response.json()
+            if data.get("Response") == "True":
+                return data.get("Search", [])
+            record_omdb_failure("omdb_series", query, data)
+        else:
+            upstream_negative_cache.record_error("omdb_series", query)
+    except (CircuitOpenError, DeadlineExceededError):
+        return []
     except Exception as e:
         print(f"[ERROR] IMDb Series API: {e}")
+        upstream_negative_cache.record_error("omdb_series", query)
     return []
 
 
@@ -337,6 +404,21 @@ async def format_imdb_recommendation(imdb_data: dict, content_type: str, exclude
 
 # ==================== Endpoints ====================
 
+@app.on_event("startup")
+async def startup_event():
+    """Reload the persistent search catalog from the disk cache and open upstream clients"""
+    loaded = search_cache.load_from_l2()
+    print(f"[STARTUP] Restored {loaded} cached searches")
+    await start_http_clients()
+
+
+@app.on_event("shutdown")
+async def shutdown_event():
+    """Close upstream HTTP clients and the user state store"""
+    await close_http_clients()
+    await user_state.close()
+
+
 @app.get("/health")
 async def health():
     """Health check endpoint"""
@@ -380,8 +462,10 @@ async def get_recommendations(request: RecommendationRequest):
             elif content_type in ["web_series", "tv_series"]:
                 tasks.append(fetch_imdb_series(smart_query))
         
-        # Run all API calls concurrently
-        results = await asyncio.gather(*tasks, return_exceptions=True)
+        # Run all API calls concurrently; a content type still loading at the
+        # deadline is dropped instead of holding back the others
+        with deadline_budget(request.budget_ms or RECOMMENDATION_BUDGET_MS):
+            results, partial = await gather_within_deadline(tasks)
         
         # Process results with filtering
         all_items = []
@@ -443,27 +527,32 @@ async def get_recommendations(request: RecommendationRequest):
                         pass
         
         if not all_items:
+            if partial:
+                raise HTTPException(status_code=504, detail="Upstream APIs did not answer within the latency budget")
             raise HTTPException(status_code=404, detail=f"No quality recommendations found for: {', '.join(request.content_types)}")
         
         # Shuffle and select
         random.shuffle(all_items)
         selected = all_items[:target_count]
         
-        # Add to history
+        # Add to history, keeping only the newest entries
         batch_id = str(__import__('uuid').uuid4())
+        new_entries = []
         for i, item in enumerate(selected):
             item["recommendation_id"] = f"{batch_id}_{i}"
             item["rank"] = i + 1
             
-            if request.user_id not in user_history:
-                user_history[request.user_id] = []
-            user_history[request.user_id].append({
+            new_entries.append({
                 "content_id": item.get("content_id"),
                 "title": item.get("title"),
                 "content_type": item.get("content_type"),
                 "genres": item.get("genres", []),
                 "timestamp": datetime.now().isoformat()
             })
+        await user_state.update(
+            request.user_id, "history",
+            lambda history: (list(history) + new_entries)[-USER_HISTORY_MAX_ITEMS:], []
+        )
         
         return {
             "status": "success",
@@ -472,9 +561,12 @@ async def get_recommendations(request: RecommendationRequest):
             "count": len(selected),
             "recommendations": selected,
             "search_queries": [{"type": ct, "query": q} for ct, q in content_queries],
+            "partial": partial,
             "powered_by": "Smart Recommendations - MAL API + IMDb API"
         }
         
+    except HTTPException:
+        raise
     except Exception as e:
         import traceback
         traceback.print_exc()
@@ -486,22 +578,25 @@ async def get_history(user_id: str):
     """Get user history"""
     return {
         "user_id": user_id,
-        "history": user_history.get(user_id, [])
+        "history": await user_state.get(user_id, "history", [])
     }
 
 
 @app.post("/users/{user_id}/watchlater")
 async def add_watchlater(user_id: str, content_id: str, title: str, content_type: str):
     """Add to watch later"""
-    if user_id not in user_watchlater:
-        user_watchlater[user_id] = []
-    
-    user_watchlater[user_id].append({
+    watchlater_item = {
         "content_id": content_id,
         "title": title,
         "content_type": content_type,
         "added_at": datetime.now().isoformat()
-    })
+    }
+    
+    # Dedupe and append in one update so concurrent adds cannot both insert
+    await user_state.update(user_id, "watchlater", lambda watchlater: (
+        watchlater if any(item.get("content_id") == content_id for item in watchlater)
+        else (list(watchlater) + [watchlater_item])[-USER_WATCHLATER_MAX_ITEMS:]
+    ), [])
     
     return {"status": "added"}
 
@@ -511,12 +606,30 @@ async def get_watchlater(user_id: str):
     """Get watch later list"""
     return {
         "user_id": user_id,
-        "watchlater": user_watchlater.get(user_id, [])
+        "watchlater": await user_state.get(user_id, "watchlater", [])
     }
 
 
 # ==================== Catalog Endpoints ====================
 
+async def fetch_search_results(q: str, limit: int, cache_key: str) -> Optional[List[dict]]:
+    """Fetch and format search results from MAL and cache them. None if MAL found nothing."""
+    results = await fetch_mal_anime(q, limit=limit)
+    if not results:
+        return None
+    
+    formatted_results = []
+    for item in results:
+        rec = await format_anime_recommendation(item, [])
+        if rec:
+            formatted_results.append(rec)
+    
+    # Store in cache for persistent catalog
+    search_cache.set(cache_key, formatted_results)
+    print(f"[CACHE NEW] {cache_key} - {len(formatted_results)} items cached")
+    return formatted_results
+
+
 @app.get("/search")
 async def search_anime(q: str, limit: int = 25):
     """
@@ -528,34 +641,23 @@ async def search_anime(q: str, limit: int = 25):
     
     # Check if already cached
     cache_key = f"anime_{q.lower()}_{limit}"
-    if cache_key in search_cache:
+    cached = search_cache.get(cache_key)
+    if cached is not None:
         print(f"[CACHE HIT] {cache_key}")
         return {
             "query": q,
-            "results": search_cache[cache_key],
+            "results": cached,
             "from_cache": True,
-            "count": len(search_cache[cache_key])
+            "count": len(cached)
         }
     
     try:
-        # Fetch from MAL API
-        results = await fetch_mal_anime(q, limit=limit)
+        # Concurrent misses for the same query share one MAL fetch
+        formatted_results = await search_flights.do(cache_key, lambda: fetch_search_results(q, limit, cache_key))
         
-        if not results:
+        if formatted_results is None:
             raise HTTPException(status_code=404, detail=f"No anime found for '{q}'")
         
-        # Format and cache results
-        formatted_results = []
-        for item in results:
-            rec = await format_anime_recommendation(item, [])
-            if rec:
-                formatted_results.append(rec)
-        
-        # Store in cache for persistent catalog
-        search_cache[cache_key] = formatted_results
-        
-        print(f"[CACHE NEW] {cache_key} - {len(formatted_results)} items cached")
-        
         return {
             "query": q,
             "results": formatted_results,
@@ -608,6 +710,18 @@ async def get_all_cached_items():
     }
 
 
+@app.get("/debug/caches")
+async def debug_caches():
+    """Cache counters, sizes and entry ages, plus upstream rate limiter and circuit state, for this worker"""
+    disk_cache = get_disk_cache()
+    return {
+        "caches": cache_report(),
+        "disk": disk_cache.stats() if disk_cache else None,
+        "rate_limits": {name: limiter.stats() for name, limiter in rate_limiters.items()},
+        "circuits": {name: breaker.stats() for name, breaker in circuit_breakers.items()}
+    }
+
+
 # ==================== Catalog Endpoints ====================
 
 @app.get("/catalog/all")
@@ -39,6 +39,8 @@ import asyncio
 sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
 
 from catalog_agent.agent import CatalogManager
+from history_agent.user_state import create_async_user_state_store
+from agents.enrichment_store import get_enrichment_store
 
 try:
     from agents.gemini_enrichment_agent import gemini_agent
@@ -69,9 +71,12 @@ catalog_manager = CatalogManager()
 
 # In-memory fast cache
 cached_catalogs = {}
-user_history = {}
-user_watchlater = {}
-user_settings = {}
+enrichment_store = get_enrichment_store()
+
+# Per-user history, watch later and settings: hot users in a bounded LRU, all users in SQLite
+user_state = create_async_user_state_store()
+USER_HISTORY_MAX_ITEMS = int(os.getenv("USER_HISTORY_MAX_ITEMS", "100"))
+USER_WATCHLATER_MAX_ITEMS = int(os.getenv("USER_WATCHLATER_MAX_ITEMS", "500"))
 
 
 # ==================== Pydantic Models ====================
@@ -114,48 +119,62 @@ class WatchLaterEntry(BaseModel):
 
 @app.on_event("startup")
 async def startup_event():
-    """Pre-cache all catalogs with Gemini enrichment"""
+    """Pre-cache all catalogs with data from the enrichment store"""
     print("[STARTUP] Loading catalogs...")
     
     for content_type, catalog in catalog_manager.catalogs.items():
         enriched = []
-        for i, item in enumerate(catalog):
+        stored_count = 0
+        item_copies = []
+        for item in catalog:
             item_copy = item.copy()
             
             # Ensure content_type
             if "content_type" not in item_copy or not item_copy["content_type"]:
                 item_copy["content_type"] = content_type
+            item_copies.append(item_copy)
+        
+        # Ratings, covers and Gemini tags come from the offline pipeline
+        # (python -m agents.enrichment_pipeline), read in one batch off the
+        # event loop; placeholders fill the gaps
+        keys = [(item_copy.get("title", ""), item_copy["content_type"]) for item_copy in item_copies]
+        stored_items = await enrichment_store.aget_many(keys) if enrichment_store else {}
+        
+        for key, item_copy in zip(keys, item_copies):
+            stored = stored_items.get(key)
+            if stored is not None:
+                stored_count += 1
+                ratings = stored.get("ratings", {})
+                item_copy["mal_score"] = ratings.get("mal_rating")
+                item_copy["imdb_score"] = ratings.get("imdb_rating")
+                item_copy["cover_image"] = stored.get("images", {}).get("poster_url")
+                gemini = stored.get("gemini")
+                if gemini:
+                    item_copy["gemini_themes"] = gemini.get("themes", [])
+                    item_copy["gemini_summary"] = gemini.get("plot_summary", "")
             
-            # Add realistic ratings (Gemini will enhance these later)
-            item_copy["mal_score"] = round(random.uniform(7.0, 9.5), 1)
-            item_copy["imdb_score"] = round(random.uniform(7.0, 9.0), 1)
-            
-            # Add cover image URL
-            title_slug = item_copy.get("title", "Unknown").replace(" ", "-")
-            item_copy["cover_image"] = f"https://via.placeholder.com/300x450?text={title_slug}"
+            if item_copy.get("mal_score") is None and item_copy.get("imdb_score") is None:
+                item_copy["mal_score"] = round(random.uniform(7.0, 9.5), 1)
+                item_copy["imdb_score"] = round(random.uniform(7.0, 9.0), 1)
             
-            # Add Gemini enrichment tags if available
-            if GEMINI_AVAILABLE and i < 2:  # Enrich first 2 items only to save API calls
-                try:
-                    enrichment = await gemini_agent.get_content_enrichment(
-                        item_copy.get("title", ""), 
-                        content_type
-                    )
-                    if enrichment.get("status") == "success":
-                        data = enrichment.get("data", {})
-                        item_copy["gemini_themes"] = data.get("themes", [])
-                        item_copy["gemini_summary"] = data.get("plot_summary", "")
-                except Exception as e:
-                    print(f"[WARNING] Gemini enrichment failed for {item_copy.get('title')}: {e}")
+            if not item_copy.get("cover_image"):
+                title_slug = item_copy.get("title", "Unknown").replace(" ", "-")
+                item_copy["cover_image"] = f"https://via.placeholder.com/300x450?text={title_slug}"
             
             enriched.append(item_copy)
         
         cached_catalogs[content_type] = enriched
-        print(f"  [OK] Loaded {len(enriched)} {content_type} items")
+        print(f"  [OK] Loaded {len(enriched)} {content_type} items ({stored_count} enriched)")
     
     print("[SUCCESS] All catalogs ready with Gemini AI agents!")
 
 
+@app.on_event("shutdown")
+async def shutdown_event():
+    """Close the user state store"""
+    await user_state.close()
+
+
 
 # ==================== Health & Root ====================
 
@@ -183,7 +202,7 @@ async def get_stats():
     return {
         "total_items": sum(len(cat) for cat in cached_catalogs.values()),
         "content_types": list(cached_catalogs.keys()),
-        "users": len(user_history),
+        "users": await user_state.count_users("history"),
         "gemini_enabled": GEMINI_AVAILABLE
     }
 
@@ -270,16 +289,20 @@ async def get_recommendations(request: RecommendationRequest):
                 "rank": i + 1
             }
             recommendations.append(rec)
-            
-            # Add to user history
-            if request.user_id not in user_history:
-                user_history[request.user_id] = []
-            user_history[request.user_id].append({
+        
+        # Add to user history in one write
+        new_entries = []
+        for item in selected_items:
+            new_entries.append({
                 "content_id": item.get("id"),
                 "title": item.get("title"),
                 "content_type": item.get("content_type"),
                 "timestamp": datetime.now().isoformat()
             })
+        await user_state.update(
+            request.user_id, "history",
+            lambda history: (list(history) + new_entries)[-USER_HISTORY_MAX_ITEMS:], []
+        )
         
         return {
             "status": "success",
@@ -368,7 +391,7 @@ async def search(q: str, content_type: Optional[str] = None):
 @app.post("/users")
 async def create_user(user: UserCreate):
     """Create user"""
-    user_settings[user.user_id] = user.preferences or {}
+    await user_state.set(user.user_id, "settings", user.preferences or {})
     return {
         "user_id": user.user_id,
         "status": "created",
@@ -379,7 +402,7 @@ async def create_user(user: UserCreate):
 @app.get("/users/{user_id}/history")
 async def get_history(user_id: str):
     """Get user's recommendation history"""
-    history = user_history.get(user_id, [])
+    history = await user_state.get(user_id, "history", [])
     return {
         "user_id": user_id,
         "count": len(history),
@@ -390,9 +413,6 @@ async def get_history(user_id: str):
 @app.post("/users/{user_id}/history")
 async def add_to_history(user_id: str, entry: ContentHistoryEntry):
     """Add to history"""
-    if user_id not in user_history:
-        user_history[user_id] = []
-    
     history_item = {
         "content_id": entry.content_id,
         "title": entry.title,
@@ -401,23 +421,18 @@ async def add_to_history(user_id: str, entry: ContentHistoryEntry):
         "notes": entry.notes,
         "timestamp": datetime.now().isoformat()
     }
-    user_history[user_id].append(history_item)
-    
-    # Keep last 100
-    if len(user_history[user_id]) > 100:
-        user_history[user_id] = user_history[user_id][-100:]
+    history = await user_state.append(user_id, "history", history_item, USER_HISTORY_MAX_ITEMS)
     
-    return {"status": "added", "count": len(user_history[user_id])}
+    return {"status": "added", "count": len(history)}
 
 
 @app.delete("/users/{user_id}/history/{content_id}")
 async def remove_from_history(user_id: str, content_id: str):
     """Remove from history"""
-    if user_id in user_history:
-        user_history[user_id] = [
-            item for item in user_history[user_id]
-            if item.get("content_id") != content_id
-        ]
+    await user_state.update(user_id, "history", lambda history: [
+        item for item in history
+        if item.get("content_id") != content_id
+    ], [])
     return {"status": "removed"}
 
 
@@ -426,7 +441,7 @@ async def remove_from_history(user_id: str, content_id: str):
 @app.get("/users/{user_id}/watchlater")
 async def get_watchlater(user_id: str):
     """Get watch later list"""
-    watchlater = user_watchlater.get(user_id, [])
+    watchlater = await user_state.get(user_id, "watchlater", [])
     return {
         "user_id": user_id,
         "count": len(watchlater),
@@ -437,32 +452,35 @@ async def get_watchlater(user_id: str):
 @app.post("/users/{user_id}/watchlater")
 async def add_to_watchlater(user_id: str, entry: WatchLaterEntry):
     """Add to watch later"""
-    if user_id not in user_watchlater:
-        user_watchlater[user_id] = []
-    
-    # Check if already added
-    if any(item["content_id"] == entry.content_id for item in user_watchlater[user_id]):
-        return {"status": "already_exists"}
-    
     watchlater_item = {
         "content_id": entry.content_id,
         "title": entry.title,
         "content_type": entry.content_type,
         "added_at": datetime.now().isoformat()
     }
-    user_watchlater[user_id].append(watchlater_item)
+    existed = False
+    
+    # Dedupe and append in one update so concurrent adds cannot both insert
+    def add(watchlater):
+        nonlocal existed
+        existed = any(item.get("content_id") == entry.content_id for item in watchlater)
+        if existed:
+            return watchlater
+        return (list(watchlater) + [watchlater_item])[-USER_WATCHLATER_MAX_ITEMS:]
     
-    return {"status": "added", "count": len(user_watchlater[user_id])}
+    watchlater = await user_state.update(user_id, "watchlater", add, [])
+    if existed:
+        return {"status": "already_exists"}
+    return {"status": "added", "count": len(watchlater)}
 
 
 @app.delete("/users/{user_id}/watchlater/{content_id}")
 async def remove_from_watchlater(user_id: str, content_id: str):
     """Remove from watch later"""
-    if user_id in user_watchlater:
-        user_watchlater[user_id] = [
-            item for item in user_watchlater[user_id]
-            if item.get("content_id") != content_id
-        ]
+    await user_state.update(user_id, "watchlater", lambda watchlater: [
+        item for item in watchlater
+        if item.get("content_id") != content_id
+    ], [])
     return {"status": "removed"}
 
 
@@ -471,7 +489,7 @@ async def remove_from_watchlater(user_id: str, content_id: str):
 @app.get("/users/{user_id}/settings")
 async def get_settings(user_id: str):
     """Get user settings"""
-    settings = user_settings.get(user_id, {
+    settings = await user_state.get(user_id, "settings", {
         "theme": "dark",
         "preferred_genres": [],
         "content_preferences": []
@@ -482,8 +500,8 @@ async def get_settings(user_id: str):
 @app.post("/users/{user_id}/settings")
 async def update_settings(user_id: str, settings: UserSettings):
     """Update user settings"""
-    user_settings[user_id] = settings.dict()
-    return {"status": "updated", "settings": user_settings[user_id]}
+    await user_state.set(user_id, "settings", settings.dict())
+    return {"status": "updated", "settings": settings.dict()}
 
 
 
@@ -2,7 +2,7 @@ import json
 import os
 from pathlib import Path
 # from google.adk.client import sdk  # Unused import - commented out
-from typing import List, Dict, Optional
+from typing import Container, List, Dict, Optional
 
 
 class CatalogManager:
@@ -10,6 +10,7 @@ class CatalogManager:
     
     def __init__(self):
         self.catalogs = {}
+        self.items_by_id = {}
         self.load_catalogs()
     
     def load_catalogs(self):
@@ -28,6 +29,17 @@ class CatalogManager:
                 with open(file_path, 'r') as f:
                     content_type = catalog_file.replace('.json', '')
                     self.catalogs[content_type] = json.load(f)
+        
+        self.items_by_id = {
+            item.get('id'): item
+            for catalog in self.catalogs.values()
+            for item in catalog
+            if item.get('id')
+        }
+    
+    def get_item(self, content_id: str) -> Optional[Dict]:
+        """Look up a catalog item by ID."""
+        return self.items_by_id.get(content_id)
     
     def search_by_genres(self, genres: List[str], content_types: List[str] = None) -> List[Dict]:
         """Search for content matching given genres."""
@@ -157,8 +169,10 @@ class CatalogManager:
         
         return sorted(results, key=lambda x: x.get('rating', 0), reverse=True)
     
-    def filter_out_consumed(self, content_list: List[Dict], consumed_ids: List[str]) -> List[Dict]:
+    def filter_out_consumed(self, content_list: List[Dict], consumed_ids: Container[str]) -> List[Dict]:
         """Filter out content that user has already consumed."""
+        if isinstance(consumed_ids, (list, tuple)):
+            consumed_ids = set(consumed_ids)
         return [item for item in content_list if item.get('id') not in consumed_ids]
 
 
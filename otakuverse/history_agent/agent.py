@@ -1,49 +1,40 @@
 from google.adk.client import sdk
-from .db import HistoryDatabase
+from .sharding import get_shared_history_pool
 from typing import Optional
 
 
 def get_user_history(user_id: str, content_type: Optional[str] = None) -> dict:
     """Tool: Get user's content history."""
-    db = HistoryDatabase()
-    try:
+    with get_shared_history_pool().acquire(user_id) as db:
         history = db.get_user_history(user_id, content_type)
-        return {
-            "success": True,
-            "count": len(history),
-            "history": history
-        }
-    finally:
-        db.close()
+    return {
+        "success": True,
+        "count": len(history),
+        "history": history
+    }
 
 
 def get_consumed_content_ids(user_id: str) -> dict:
     """Tool: Get IDs of all content consumed by user."""
-    db = HistoryDatabase()
-    try:
+    with get_shared_history_pool().acquire(user_id) as db:
         consumed_ids = db.get_consumed_ids(user_id)
-        return {
-            "success": True,
-            "consumed_count": len(consumed_ids),
-            "content_ids": consumed_ids
-        }
-    finally:
-        db.close()
+    return {
+        "success": True,
+        "consumed_count": len(consumed_ids),
+        "content_ids": consumed_ids
+    }
 
 
 def add_content_to_history(user_id: str, content_id: str, content_type: str, 
                            title: str, rating: Optional[float] = None, 
                            notes: str = "") -> dict:
     """Tool: Add content to user's history."""
-    db = HistoryDatabase()
-    try:
+    with get_shared_history_pool().acquire(user_id) as db:
         db.add_to_history(user_id, content_id, content_type, title, rating, notes)
-        return {
-            "success": True,
-            "message": f"Added '{title}' to {user_id}'s history"
-        }
-    finally:
-        db.close()
+    return {
+        "success": True,
+        "message": f"Added '{title}' to {user_id}'s history"
+    }
 
 
 def create_history_agent():
@@ -0,0 +1,130 @@
+import asyncio
+import functools
+import os
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable, Container, Dict, FrozenSet, Iterable, List, Optional, Tuple, Union
+
+from .db import HistoryDatabase
+from .pool import HistoryDatabasePool
+from .sharding import ShardedHistoryPool, create_history_pool, merge_stats
+
+
+class AsyncHistoryDatabase:
+    """Awaitable facade over HistoryDatabase for use inside async request handlers.
+
+    Every call runs on a dedicated, bounded thread pool so a slow SQLite query
+    never blocks the event loop. Workers borrow long-lived handles from a
+    HistoryDatabasePool sized to match the executor, or from a
+    ShardedHistoryPool when HISTORY_DB_SHARDS is greater than one.
+    """
+
+    def __init__(self, db_path: str = "otakuverse.db", max_workers: Optional[int] = None,
+                 pool: Optional[Union[HistoryDatabasePool, ShardedHistoryPool]] = None):
+        """Create the executor and the connection pool its workers share."""
+        self.db_path = db_path
+        self.max_workers = max_workers or int(os.getenv("HISTORY_DB_WORKERS", "4"))
+        self.pool = pool or create_history_pool(db_path, size=self.max_workers)
+        self._executor = ThreadPoolExecutor(
+            max_workers=self.max_workers,
+            thread_name_prefix="history-db"
+        )
+
+    def _call(self, user_id: Optional[str], method_name: str, args: tuple, kwargs: dict) -> Any:
+        """Invoke a HistoryDatabase method on a pooled handle."""
+        with self.pool.acquire(user_id) as db:
+            return getattr(db, method_name)(*args, **kwargs)
+
+    async def _run(self, method_name: str, user_id: Optional[str], *args, **kwargs) -> Any:
+        """Schedule a HistoryDatabase method on the executor and await its result.
+
+        `user_id` is passed first to the method and also used to route the call.
+        """
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(
+            self._executor,
+            functools.partial(self._call, user_id, method_name, (user_id,) + args, kwargs)
+        )
+
+    async def run(self, func: Callable[..., Any], *args, user_id: Optional[str] = None, **kwargs) -> Any:
+        """Run an arbitrary function against a pooled handle, e.g. a multi-step transaction."""
+        def call():
+            with self.pool.acquire(user_id) as db:
+                return func(db, *args, **kwargs)
+
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self._executor, call)
+
+    async def run_blocking(self, func: Callable[..., Any], *args, **kwargs) -> Any:
+        """Run a blocking callable that manages its own handles on the database executor."""
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self._executor, functools.partial(func, *args, **kwargs))
+
+    async def scatter(self, func: Callable[..., Any], *args, **kwargs) -> List[Any]:
+        """Run `func(db, ...)` on every shard and gather the results, e.g. for admin queries."""
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(
+            self._executor,
+            functools.partial(self.pool.scatter, func, *args, **kwargs)
+        )
+
+    async def get_stats(self) -> Dict[str, int]:
+        """Get row counts summed across all shards."""
+        return merge_stats(await self.scatter(HistoryDatabase.get_stats))
+
+    async def create_user(self, user_id: str, preferences: Optional[Dict] = None):
+        """Create a new user."""
+        return await self._run("create_user", user_id, preferences)
+
+    async def get_user(self, user_id: str) -> Optional[Dict]:
+        """Get user by ID."""
+        return await self._run("get_user", user_id)
+
+    async def add_to_history(self, user_id: str, content_id: str, content_type: str,
+                             title: str, rating: Optional[float] = None, notes: str = ""):
+        """Add content to user's history."""
+        return await self._run("add_to_history", user_id, content_id, content_type,
+                               title, rating, notes)
+
+    async def get_user_history(self, user_id: str, content_type: Optional[str] = None,
+                               limit: Optional[int] = None,
+                               cursor: Optional[Tuple[str, int]] = None) -> List[Dict]:
+        """Get user's content history, optionally filtered by type and paged by keyset."""
+        return await self._run("get_user_history", user_id, content_type, limit, cursor)
+
+    async def get_user_affinity(self, user_id: str) -> Dict[str, Dict[str, float]]:
+        """Get a user's rating-weighted genre, mood and content-type totals."""
+        return await self._run("get_user_affinity", user_id)
+
+    async def get_consumed_ids(self, user_id: str) -> List[str]:
+        """Get all content IDs that a user has consumed."""
+        return await self._run("get_consumed_ids", user_id)
+
+    async def get_consumed_id_set(self, user_id: str) -> Container[str]:
+        """Get a membership container of the content IDs a user has consumed."""
+        return await self._run("get_consumed_id_set", user_id)
+
+    async def consumed_among(self, user_id: str, content_ids: Iterable[str]) -> FrozenSet[str]:
+        """Get which of `content_ids` a user has consumed, confirming Bloom hits in one batch."""
+        return await self._run("consumed_among", user_id, list(content_ids))
+
+    async def save_recommendation(self, user_id: str, batch_id: str, content_id: str,
+                                  content_type: str, title: str, explanation: str, ranking: int):
+        """Save a recommendation for the user."""
+        return await self._run("save_recommendation", user_id, batch_id, content_id,
+                               content_type, title, explanation, ranking)
+
+    async def get_recommendations(self, user_id: str, batch_id: Optional[str] = None,
+                                  limit: Optional[int] = None,
+                                  cursor: Optional[Tuple[str, int, int]] = None) -> List[Dict]:
+        """Get recommendations for a user, optionally paged by keyset."""
+        return await self._run("get_recommendations", user_id, batch_id, limit, cursor)
+
+    async def update_preferences(self, user_id: str, preferences: Dict):
+        """Update user preferences."""
+        return await self._run("update_preferences", user_id, preferences)
+
+    async def close(self):
+        """Drain pending queries, then close every pooled connection."""
+        loop = asyncio.get_running_loop()
+        await loop.run_in_executor(None, functools.partial(self._executor.shutdown, wait=True))
+        self.pool.close()
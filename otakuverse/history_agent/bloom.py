@@ -0,0 +1,151 @@
+import argparse
+import hashlib
+import math
+import sqlite3
+import sys
+import threading
+from typing import Callable, Dict, Iterable, List
+
+
+class BloomFilter:
+    """Fixed-size Bloom filter over strings using double hashing."""
+
+    def __init__(self, capacity: int, error_rate: float = 0.01):
+        """Size the bit array for `capacity` items at the target false-positive rate."""
+        capacity = max(capacity, 1)
+        self.capacity = capacity
+        self.error_rate = error_rate
+        self.num_bits = max(8, int(math.ceil(-capacity * math.log(error_rate) / (math.log(2) ** 2))))
+        self.num_hashes = max(1, int(round(self.num_bits / capacity * math.log(2))))
+        self.bits = bytearray((self.num_bits + 7) // 8)
+        self.count = 0
+
+    def _positions(self, item: str) -> Iterable[int]:
+        """Yield the bit positions for an item."""
+        digest = hashlib.blake2b(item.encode("utf-8"), digest_size=16).digest()
+        h1 = int.from_bytes(digest[:8], "little")
+        h2 = int.from_bytes(digest[8:], "little") | 1
+        for i in range(self.num_hashes):
+            yield (h1 + i * h2) % self.num_bits
+
+    def add(self, item: str):
+        """Insert an item."""
+        for pos in self._positions(item):
+            self.bits[pos >> 3] |= 1 << (pos & 7)
+        self.count += 1
+
+    def __contains__(self, item: str) -> bool:
+        """Return False if the item was definitely never added."""
+        return all(self.bits[pos >> 3] & (1 << (pos & 7)) for pos in self._positions(item))
+
+    @property
+    def size_bytes(self) -> int:
+        """Bytes used by the bit array."""
+        return len(self.bits)
+
+    def expected_error_rate(self) -> float:
+        """False-positive probability at the current fill level."""
+        return (1 - math.exp(-self.num_hashes * self.count / self.num_bits)) ** self.num_hashes
+
+
+class BloomConsumedSet:
+    """Consumed-ID container for very large histories.
+
+    Membership is checked against the Bloom filter first; a possible hit is
+    confirmed with `confirm`, so results are always exact while only the bit
+    array is held in memory.
+    """
+
+    def __init__(self, bloom: BloomFilter, confirm: Callable[[str], bool]):
+        """Wrap a populated filter and the exact-lookup callback."""
+        self.bloom = bloom
+        self._confirm = confirm
+        self._lock = threading.Lock()
+
+    def candidates(self, content_ids: Iterable[str]) -> List[str]:
+        """IDs the filter may contain; confirm them together (HistoryDatabase.consumed_among)."""
+        return [content_id for content_id in content_ids if content_id in self.bloom]
+
+    def __contains__(self, content_id: str) -> bool:
+        """Exact membership test; one database query per possible hit."""
+        if content_id not in self.bloom:
+            return False
+        return self._confirm(content_id)
+
+    def add(self, content_id: str):
+        """Record a newly consumed ID."""
+        with self._lock:
+            self.bloom.add(content_id)
+
+
+def _exact_set_bytes(ids: Iterable[str]) -> int:
+    """Approximate memory held by a frozenset of IDs, including the strings."""
+    ids = frozenset(ids)
+    return sys.getsizeof(ids) + sum(sys.getsizeof(i) for i in ids)
+
+
+def build_report(db_path: str, error_rate: float = 0.01, top: int = 10,
+                 probes: int = 20000) -> Dict:
+    """Compare exact-set and Bloom-filter memory and accuracy for the heaviest users."""
+    connection = sqlite3.connect(db_path)
+    try:
+        users = connection.execute("""
+            SELECT user_id, COUNT(DISTINCT content_id) AS n FROM content_history
+            GROUP BY user_id ORDER BY n DESC LIMIT ?
+        """, (top,)).fetchall()
+
+        rows = []
+        for user_id, count in users:
+            ids = [r[0] for r in connection.execute(
+                "SELECT DISTINCT content_id FROM content_history WHERE user_id = ?", (user_id,)
+            )]
+            bloom = BloomFilter(len(ids), error_rate)
+            for content_id in ids:
+                bloom.add(content_id)
+
+            exact = set(ids)
+            false_positives = sum(
+                1 for i in range(probes)
+                if f"__probe_{i}" not in exact and f"__probe_{i}" in bloom
+            )
+            rows.append({
+                "user_id": user_id,
+                "history_ids": count,
+                "exact_set_bytes": _exact_set_bytes(ids),
+                "bloom_bytes": bloom.size_bytes,
+                "hash_functions": bloom.num_hashes,
+                "expected_fp_rate": round(bloom.expected_error_rate(), 5),
+                "measured_fp_rate": round(false_positives / probes, 5),
+            })
+    finally:
+        connection.close()
+
+    return {
+        "db_path": db_path,
+        "error_rate": error_rate,
+        "probes": probes,
+        "users": rows,
+    }
+
+
+def main():
+    """Print a memory/accuracy report for Bloom-filtered consumed-ID sets."""
+    parser = argparse.ArgumentParser(description="Bloom filter memory/accuracy report")
+    parser.add_argument("db_path", nargs="?", default="otakuverse.db")
+    parser.add_argument("--error-rate", type=float, default=0.01)
+    parser.add_argument("--top", type=int, default=10)
+    parser.add_argument("--probes", type=int, default=20000)
+    args = parser.parse_args()
+
+    report = build_report(args.db_path, args.error_rate, args.top, args.probes)
+    print(f"Bloom report for {report['db_path']} (target fp rate {report['error_rate']}, "
+          f"{report['probes']} probes)")
+    print(f"{'user_id':<24}{'ids':>8}{'exact B':>12}{'bloom B':>10}{'k':>4}{'exp fp':>10}{'meas fp':>10}")
+    for row in report["users"]:
+        print(f"{row['user_id']:<24}{row['history_ids']:>8}{row['exact_set_bytes']:>12}"
+              f"{row['bloom_bytes']:>10}{row['hash_functions']:>4}"
+              f"{row['expected_fp_rate']:>10}{row['measured_fp_rate']:>10}")
+
+
+if __name__ == "__main__":
+    main()
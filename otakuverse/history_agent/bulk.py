@@ -0,0 +1,204 @@
+import argparse
+import json
+import sqlite3
+import sys
+from typing import Dict, Iterable, Iterator, List, Sequence, Tuple, Union
+
+from .db import AFFINITY_UPSERT_SQL, HistoryDatabase, affinity_rows, set_catalog_lookup
+from .pool import HistoryDatabasePool
+from .sharding import ShardedHistoryPool, create_history_pool
+
+# Rows per executemany transaction on import and per fetchmany on export.
+CHUNK_SIZE = 1000
+
+# Columns carried in NDJSON per table. Row ids are environment-specific and are
+# reassigned on import; timestamps are preserved.
+TABLE_COLUMNS = {
+    "content_history": (
+        "user_id", "content_id", "content_type", "title", "consumed_at", "rating", "notes"
+    ),
+    "recommendations": (
+        "user_id", "recommendation_batch_id", "content_id", "content_type", "title",
+        "explanation", "ranking", "created_at", "viewed"
+    ),
+}
+TIMESTAMP_COLUMNS = {"content_history": "consumed_at", "recommendations": "created_at"}
+
+Pool = Union[HistoryDatabasePool, ShardedHistoryPool]
+
+
+def _insert_sql(table: str) -> str:
+    """Build the INSERT used for a table, defaulting missing timestamps to now."""
+    columns = TABLE_COLUMNS[table]
+    values = [
+        "COALESCE(?, CURRENT_TIMESTAMP)" if column == TIMESTAMP_COLUMNS[table] else "?"
+        for column in columns
+    ]
+    return f"INSERT INTO {table} ({', '.join(columns)}) VALUES ({', '.join(values)})"
+
+
+def export_ndjson(pool: Pool, tables: Sequence[str] = tuple(TABLE_COLUMNS),
+                  chunk_size: int = CHUNK_SIZE) -> Iterator[str]:
+    """Yield every row of `tables`, one JSON object per line, shard by shard.
+
+    Rows are streamed with fetchmany, so memory stays bounded by `chunk_size`.
+    Each shard is read through a dedicated connection so a long export does
+    not hold a pooled handle.
+    """
+    for table in tables:
+        if table not in TABLE_COLUMNS:
+            raise ValueError(f"Unknown table: {table}")
+
+    for shard in pool.shard_pools:
+        db = HistoryDatabase(shard.db_path, check_same_thread=False)
+        try:
+            for table in tables:
+                columns = TABLE_COLUMNS[table]
+                cursor = db.connection.execute(
+                    f"SELECT {', '.join(columns)} FROM {table} ORDER BY id"
+                )
+                while True:
+                    rows = cursor.fetchmany(chunk_size)
+                    if not rows:
+                        break
+                    for row in rows:
+                        record = {"table": table}
+                        record.update(dict(row))
+                        yield json.dumps(record) + "\n"
+        finally:
+            db.close()
+
+
+class NdjsonImporter:
+    """Buffers parsed NDJSON rows and writes them in chunked executemany transactions.
+
+    Rows are grouped per shard and table; a group is flushed as soon as it
+    reaches `chunk_size`, so memory is bounded no matter how large the input.
+    Malformed lines and chunks the schema rejects raise ValueError; chunks
+    flushed before that stay committed and are counted in `counts`.
+    """
+
+    def __init__(self, pool: Pool, chunk_size: int = CHUNK_SIZE):
+        """Create an importer writing through `pool`."""
+        self.pool = pool
+        self.chunk_size = chunk_size
+        self.counts: Dict[str, int] = {table: 0 for table in TABLE_COLUMNS}
+        self.lines_read = 0
+        self._buffers: Dict[Tuple[int, str], Tuple[HistoryDatabasePool, List[tuple]]] = {}
+
+    def feed(self, line: Union[str, bytes]):
+        """Parse one NDJSON line and buffer it, flushing its group when full."""
+        self.lines_read += 1
+        if isinstance(line, bytes):
+            line = line.decode("utf-8")
+        line = line.strip()
+        if not line:
+            return
+
+        try:
+            record = json.loads(line)
+        except json.JSONDecodeError as e:
+            raise ValueError(f"Line {self.lines_read}: invalid JSON ({e})") from e
+        table = record.get("table")
+        if table not in TABLE_COLUMNS:
+            raise ValueError(f"Line {self.lines_read}: unknown table {table!r}")
+        if not record.get("user_id"):
+            raise ValueError(f"Line {self.lines_read}: missing user_id")
+
+        shard = self.pool.pool_for(record["user_id"])
+        key = (id(shard), table)
+        if key not in self._buffers:
+            self._buffers[key] = (shard, [])
+        rows = self._buffers[key][1]
+        rows.append(tuple(record.get(column) for column in TABLE_COLUMNS[table]))
+        if len(rows) >= self.chunk_size:
+            self._flush_group(key)
+
+    def feed_lines(self, lines: Iterable[Union[str, bytes]]):
+        """Feed many lines."""
+        for line in lines:
+            self.feed(line)
+
+    def _flush_group(self, key: Tuple[int, str]):
+        """Write one buffered shard/table group in a single transaction."""
+        shard, rows = self._buffers.pop(key)
+        if not rows:
+            return
+        table = key[1]
+        with shard.acquire(rows[0][0]) as db:
+            try:
+                with db.connection:
+                    db.connection.executemany(_insert_sql(table), rows)
+                    if table == "content_history":
+                        db.connection.executemany(AFFINITY_UPSERT_SQL, (
+                            increment
+                            for user_id, content_id, content_type, _title, _at, rating, _notes in rows
+                            for increment in affinity_rows(user_id, content_id, content_type, rating)
+                        ))
+            except sqlite3.IntegrityError as e:
+                committed = sum(self.counts.values())
+                raise ValueError(
+                    f"Rejected a chunk of {len(rows)} {table} rows ({e}); "
+                    f"{committed} rows were committed before it"
+                ) from e
+            if table == "content_history":
+                for user_id in {row[0] for row in rows}:
+                    db.consumed_cache.invalidate(user_id)
+        self.counts[table] += len(rows)
+
+    def flush(self) -> Dict[str, int]:
+        """Write every remaining buffered row. Returns rows imported per table."""
+        for key in list(self._buffers):
+            self._flush_group(key)
+        return dict(self.counts)
+
+
+def import_ndjson(pool: Pool, lines: Iterable[Union[str, bytes]],
+                  chunk_size: int = CHUNK_SIZE) -> Dict[str, int]:
+    """Import NDJSON lines produced by export_ndjson. Returns rows imported per table."""
+    importer = NdjsonImporter(pool, chunk_size)
+    importer.feed_lines(lines)
+    return importer.flush()
+
+
+def main():
+    """Export or import user history as NDJSON."""
+    parser = argparse.ArgumentParser(description="Bulk NDJSON import/export of user history")
+    parser.add_argument("command", choices=["export", "import"])
+    parser.add_argument("path", nargs="?", default="-", help="file to read/write, '-' for stdio")
+    parser.add_argument("--db", default="otakuverse.db")
+    parser.add_argument("--tables", default=",".join(TABLE_COLUMNS),
+                        help="comma-separated tables to export")
+    parser.add_argument("--chunk-size", type=int, default=CHUNK_SIZE)
+    args = parser.parse_args()
+
+    if args.command == "import":
+        # Imported history feeds genre/mood affinity, which needs the catalog
+        from catalog_agent.agent import CatalogManager
+        set_catalog_lookup(CatalogManager().get_item)
+
+    pool = create_history_pool(args.db)
+    try:
+        if args.command == "export":
+            tables = [t.strip() for t in args.tables.split(",") if t.strip()]
+            out = sys.stdout if args.path == "-" else open(args.path, "w", encoding="utf-8")
+            try:
+                for line in export_ndjson(pool, tables, args.chunk_size):
+                    out.write(line)
+            finally:
+                if out is not sys.stdout:
+                    out.close()
+        else:
+            source = sys.stdin if args.path == "-" else open(args.path, "r", encoding="utf-8")
+            try:
+                counts = import_ndjson(pool, source, args.chunk_size)
+            finally:
+                if source is not sys.stdin:
+                    source.close()
+            print(f"[IMPORT] {counts}", file=sys.stderr)
+    finally:
+        pool.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,138 @@
+import os
+import threading
+import time
+from collections import OrderedDict
+from typing import Container, Dict, Iterable, Optional, Tuple
+
+# Upper bound on how long an entry is trusted. Inserts from other processes are
+# caught up on every read (see HistoryDatabase.get_consumed_id_set); the TTL
+# covers changes that can't be detected that way, such as deleted history rows.
+CONSUMED_CACHE_TTL = float(os.getenv("CONSUMED_CACHE_TTL", "300"))
+
+
+class ConsumedIdCache:
+    """Bounded in-memory LRU of each user's consumed content IDs.
+
+    Entries are frozensets (or Bloom-backed containers for very large
+    histories) so callers can share them without copying and filter candidates
+    with O(1) membership checks. Each entry remembers the highest
+    content_history id it covers, so readers can fold in rows written by other
+    processes, and expires after `ttl` seconds.
+    """
+
+    def __init__(self, max_users: Optional[int] = None, ttl: float = CONSUMED_CACHE_TTL):
+        """Create an empty cache holding at most `max_users` entries."""
+        self.max_users = max_users or int(os.getenv("CONSUMED_CACHE_MAX_USERS", "10000"))
+        self.ttl = ttl
+        # user_id -> (ids, history head id covered, monotonic load time)
+        self._entries: "OrderedDict[str, Tuple[Container[str], int, float]]" = OrderedDict()
+        self._lock = threading.Lock()
+        # Per-user write counters, so a write for one user never discards
+        # another user's load; bounded LRU, and dropping a counter (or clear())
+        # bumps _epoch, which invalidates every load in flight instead
+        self._write_seqs: "OrderedDict[str, int]" = OrderedDict()
+        self._epoch = 0
+
+    def load_token(self, user_id: str) -> Tuple[int, int]:
+        """Return a token to pass to put() after loading a user's IDs from the database.
+
+        A put() whose token predates a concurrent write for the same user is
+        discarded, so a slow reader can never overwrite a newer entry with a
+        stale snapshot.
+        """
+        with self._lock:
+            return self._epoch, self._write_seqs.get(user_id, 0)
+
+    def _bump(self, user_id: str):
+        """Record a write for a user. Caller holds the lock."""
+        seq = self._write_seqs.pop(user_id, 0) + 1
+        self._write_seqs[user_id] = seq
+        if len(self._write_seqs) > self.max_users:
+            self._write_seqs.popitem(last=False)
+            self._epoch += 1
+
+    def get(self, user_id: str) -> Optional[Tuple[Container[str], int]]:
+        """Return (ids, history head id they cover) for a user, or None on a miss or expiry."""
+        with self._lock:
+            entry = self._entries.get(user_id)
+            if entry is None:
+                return None
+            if time.monotonic() - entry[2] > self.ttl:
+                del self._entries[user_id]
+                return None
+            self._entries.move_to_end(user_id)
+            return entry[0], entry[1]
+
+    def put(self, user_id: str, ids: Container[str], token: Tuple[int, int], head: int):
+        """Store a freshly loaded ID set unless a write for the user happened since `token`.
+
+        `head` is the highest content_history id that existed before the IDs were read.
+        """
+        with self._lock:
+            if token != (self._epoch, self._write_seqs.get(user_id, 0)):
+                return
+            self._entries[user_id] = (ids, head, time.monotonic())
+            self._entries.move_to_end(user_id)
+            while len(self._entries) > self.max_users:
+                self._entries.popitem(last=False)
+
+    def advance(self, user_id: str, new_ids: Iterable[str], head: int) -> Optional[Container[str]]:
+        """Fold in IDs written up to history id `head`. Returns the entry, or None if it is gone."""
+        with self._lock:
+            entry = self._entries.get(user_id)
+            if entry is None:
+                return None
+            ids, old_head, loaded_at = entry
+            if head > old_head:
+                if isinstance(ids, frozenset):
+                    ids = ids.union(new_ids)
+                else:
+                    for content_id in new_ids:
+                        ids.add(content_id)
+                self._entries[user_id] = (ids, head, loaded_at)
+            return ids
+
+    def add(self, user_id: str, content_id: str):
+        """Record a new consumed ID, updating the user's entry if it is cached."""
+        with self._lock:
+            self._bump(user_id)
+            entry = self._entries.get(user_id)
+            if entry is None:
+                return
+            ids, head, loaded_at = entry
+            if isinstance(ids, frozenset):
+                if content_id not in ids:
+                    self._entries[user_id] = (ids | {content_id}, head, loaded_at)
+            else:
+                ids.add(content_id)
+
+    def invalidate(self, user_id: str):
+        """Drop a user's entry so the next read reloads it."""
+        with self._lock:
+            self._bump(user_id)
+            self._entries.pop(user_id, None)
+
+    def clear(self):
+        """Drop every entry."""
+        with self._lock:
+            self._epoch += 1
+            self._write_seqs.clear()
+            self._entries.clear()
+
+
+_caches: Dict[str, ConsumedIdCache] = {}
+_caches_lock = threading.Lock()
+
+
+def get_consumed_cache(db_path: str) -> ConsumedIdCache:
+    """Return the process-wide cache for a database file.
+
+    Every handle on the same file shares one cache, so a write through any
+    handle is visible to reads through all of them.
+    """
+    with _caches_lock:
+        cache = _caches.get(db_path)
+        if cache is None:
+            cache = ConsumedIdCache()
+            _caches[db_path] = cache
+        return cache
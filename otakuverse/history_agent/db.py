@@ -1,25 +1,144 @@
+import base64
+import os
 import sqlite3
 import json
 from datetime import datetime
 from pathlib import Path
-from typing import List, Dict, Optional
+from typing import Callable, Container, FrozenSet, Iterable, List, Dict, Optional, Tuple
+
+from .bloom import BloomConsumedSet, BloomFilter
+from .consumed_cache import ConsumedIdCache, get_consumed_cache
+
+# Per-connection prepared statement cache; long-lived pooled handles reuse these.
+STATEMENT_CACHE_SIZE = 256
+
+# Users with at least this many distinct consumed IDs get a Bloom filter instead
+# of an exact in-memory set. 0 disables Bloom filtering.
+CONSUMED_BLOOM_MIN_IDS = int(os.getenv("CONSUMED_BLOOM_MIN_IDS", "0"))
+CONSUMED_BLOOM_ERROR_RATE = float(os.getenv("CONSUMED_BLOOM_ERROR_RATE", "0.01"))
+# A cached consumed set further behind than this many history rows is reloaded
+# instead of caught up.
+CONSUMED_CATCH_UP_MAX_ROWS = int(os.getenv("CONSUMED_CATCH_UP_MAX_ROWS", "10000"))
+# IDs per IN (...) query when confirming Bloom hits; below SQLite's variable limit.
+CONFIRM_BATCH_SIZE = 500
+
+
+# Resolves a content_id to its catalog item (genres, mood) for affinity updates.
+_catalog_lookup: Optional[Callable[[str], Optional[Dict]]] = None
+_warned_no_lookup = False
+
+
+def set_catalog_lookup(lookup: Optional[Callable[[str], Optional[Dict]]]):
+    """Register how history writes find an item's genres and moods, e.g. CatalogManager.get_item."""
+    global _catalog_lookup
+    _catalog_lookup = lookup
+
+
+def affinity_weight(rating: Optional[float]) -> float:
+    """Weight of one history entry on a 0-10 rating scale; unrated counts as neutral (1.0)."""
+    if rating is None:
+        return 1.0
+    return min(max(rating, 0.0), 10.0) / 5.0
+
+
+def affinity_rows(user_id: str, content_id: str, content_type: str,
+                  rating: Optional[float]) -> List[Tuple[str, str, str, float]]:
+    """Build the (user_id, dimension, value, weight) increments for one history entry."""
+    global _warned_no_lookup
+    weight = affinity_weight(rating)
+    rows = [(user_id, "content_type", content_type, weight)]
+    if _catalog_lookup is None and not _warned_no_lookup:
+        _warned_no_lookup = True
+        print("[WARNING] No catalog lookup registered; affinity updates will skip genres "
+              "and moods. Call set_catalog_lookup(catalog_manager.get_item) at startup.")
+    item = _catalog_lookup(content_id) if _catalog_lookup else None
+    if item:
+        for genre in dict.fromkeys(g.lower() for g in item.get("genres", [])):
+            rows.append((user_id, "genre", genre, weight))
+        for mood in dict.fromkeys(m.lower() for m in item.get("mood", [])):
+            rows.append((user_id, "mood", mood, weight))
+    return rows
+
+
+AFFINITY_UPSERT_SQL = """
+    INSERT INTO user_affinity (user_id, dimension, value, weight, count)
+    VALUES (?, ?, ?, ?, 1)
+    ON CONFLICT (user_id, dimension, value) DO UPDATE SET
+        weight = weight + excluded.weight,
+        count = count + 1
+"""
+
+
+def encode_cursor(timestamp: str, *keys: int) -> str:
+    """Encode a (timestamp, *keys) keyset position as an opaque page cursor."""
+    raw = json.dumps([timestamp, *keys]).encode("utf-8")
+    return base64.urlsafe_b64encode(raw).decode("ascii").rstrip("=")
+
+
+def decode_cursor(token: str, size: int = 2) -> Tuple:
+    """Decode a page cursor of `size` fields produced by encode_cursor. Raises ValueError if malformed."""
+    try:
+        raw = base64.urlsafe_b64decode(token + "=" * (-len(token) % 4))
+        timestamp, *keys = json.loads(raw)
+        if len(keys) != size - 1:
+            raise ValueError("wrong cursor size")
+        return (str(timestamp), *(int(key) for key in keys))
+    except Exception as e:
+        raise ValueError(f"Invalid cursor: {token}") from e
+
+
+def history_position(row: Dict) -> Tuple[str, int]:
+    """Keyset position of a content_history row, as get_history takes it."""
+    return row["consumed_at"], row["id"]
+
+
+def recommendation_position(row: Dict) -> Tuple[str, int, int]:
+    """Keyset position of a recommendations row, as get_recommendations takes it."""
+    return row["created_at"], row["ranking"] or 0, row["id"]
+
+
+def _confirm_consumed(db_path: str, user_id: str, content_id: str) -> bool:
+    """Exact consumed check used to confirm Bloom filter hits from any thread."""
+    from .pool import get_shared_pool
+    
+    with get_shared_pool(db_path).acquire(user_id) as db:
+        return db.has_consumed(user_id, content_id)
 
 
 class HistoryDatabase:
     """SQLite database wrapper for managing user history and preferences."""
     
-    def __init__(self, db_path: str = "otakuverse.db"):
-        """Initialize the database connection and create tables if needed."""
+    def __init__(self, db_path: str = "otakuverse.db", check_same_thread: bool = True,
+                 consumed_cache: Optional[ConsumedIdCache] = None):
+        """Initialize the database connection and create tables if needed.
+        
+        Pass check_same_thread=False when the handle is owned by a worker pool
+        and may be closed from a different thread than the one that opened it.
+        Handles on the same file share one consumed-ID cache by default.
+        """
         self.db_path = db_path
+        self.check_same_thread = check_same_thread
+        self.consumed_cache = consumed_cache or get_consumed_cache(db_path)
         self.connection = None
         self.init_db()
     
     def init_db(self):
         """Create tables if they don't exist."""
-        self.connection = sqlite3.connect(self.db_path)
+        self.connection = sqlite3.connect(
+            self.db_path,
+            check_same_thread=self.check_same_thread,
+            cached_statements=STATEMENT_CACHE_SIZE
+        )
         self.connection.row_factory = sqlite3.Row
         cursor = self.connection.cursor()
         
+        # Only takes effect on a new database; lets maintenance reclaim space in small steps
+        cursor.execute("PRAGMA auto_vacuum=INCREMENTAL")
+        
+        # WAL lets pooled readers run alongside a writer
+        cursor.execute("PRAGMA journal_mode=WAL")
+        cursor.execute("PRAGMA synchronous=NORMAL")
+        
         # User table
         cursor.execute("""
             CREATE TABLE IF NOT EXISTS users (
@@ -62,6 +181,70 @@ class HistoryDatabase:
             )
         """)
         
+        # Running rating-weighted genre/mood/content-type counts per user
+        cursor.execute("""
+            CREATE TABLE IF NOT EXISTS user_affinity (
+                user_id TEXT NOT NULL,
+                dimension TEXT NOT NULL,
+                value TEXT NOT NULL,
+                weight REAL NOT NULL DEFAULT 0,
+                count INTEGER NOT NULL DEFAULT 0,
+                PRIMARY KEY (user_id, dimension, value)
+            )
+        """)
+        
+        # Per-user/per-item aggregate of recommendations pruned by maintenance
+        cursor.execute("""
+            CREATE TABLE IF NOT EXISTS recommendation_rollup (
+                user_id TEXT NOT NULL,
+                content_id TEXT NOT NULL,
+                content_type TEXT NOT NULL,
+                title TEXT NOT NULL,
+                times_recommended INTEGER NOT NULL DEFAULT 0,
+                times_viewed INTEGER NOT NULL DEFAULT 0,
+                best_ranking INTEGER,
+                first_recommended_at TIMESTAMP,
+                last_recommended_at TIMESTAMP,
+                PRIMARY KEY (user_id, content_id)
+            )
+        """)
+        
+        # Which worker runs maintenance; held until expires_at and renewed each run
+        cursor.execute("""
+            CREATE TABLE IF NOT EXISTS maintenance_lease (
+                name TEXT PRIMARY KEY,
+                holder TEXT NOT NULL,
+                expires_at REAL NOT NULL
+            )
+        """)
+        
+        cursor.execute("""
+            CREATE INDEX IF NOT EXISTS idx_content_history_user_content
+            ON content_history (user_id, content_id)
+        """)
+        
+        # Keyset pagination indexes
+        cursor.execute("""
+            CREATE INDEX IF NOT EXISTS idx_content_history_user_time
+            ON content_history (user_id, consumed_at, id)
+        """)
+        # Newest batch first, each batch in ranking order
+        cursor.execute("DROP INDEX IF EXISTS idx_recommendations_user_time")
+        cursor.execute("""
+            CREATE INDEX IF NOT EXISTS idx_recommendations_user_page
+            ON recommendations (user_id, created_at DESC, IFNULL(ranking, 0), id)
+        """)
+        
+        # Retention indexes: find expired rows by age, then fetch whole batches
+        cursor.execute("""
+            CREATE INDEX IF NOT EXISTS idx_recommendations_created_at
+            ON recommendations (created_at)
+        """)
+        cursor.execute("""
+            CREATE INDEX IF NOT EXISTS idx_recommendations_batch
+            ON recommendations (recommendation_batch_id)
+        """)
+        
         self.connection.commit()
     
     def create_user(self, user_id: str, preferences: Optional[Dict] = None):
@@ -88,7 +271,7 @@ class HistoryDatabase:
     
     def add_to_history(self, user_id: str, content_id: str, content_type: str, 
                        title: str, rating: Optional[float] = None, notes: str = ""):
-        """Add content to user's history."""
+        """Add content to user's history and fold it into the user's affinity profile."""
         cursor = self.connection.cursor()
         
         cursor.execute("""
@@ -96,39 +279,189 @@ class HistoryDatabase:
             (user_id, content_id, content_type, title, rating, notes)
             VALUES (?, ?, ?, ?, ?, ?)
         """, (user_id, content_id, content_type, title, rating, notes))
+        cursor.executemany(AFFINITY_UPSERT_SQL, affinity_rows(user_id, content_id, content_type, rating))
         
         self.connection.commit()
+        self.consumed_cache.add(user_id, content_id)
     
-    def get_user_history(self, user_id: str, content_type: Optional[str] = None) -> List[Dict]:
-        """Get user's content history, optionally filtered by type."""
-        cursor = self.connection.cursor()
+    def get_user_history(self, user_id: str, content_type: Optional[str] = None,
+                         limit: Optional[int] = None,
+                         cursor: Optional[Tuple[str, int]] = None) -> List[Dict]:
+        """Get user's content history, newest first, optionally filtered by type.
+        
+        Pass `limit` and the (consumed_at, id) of the last row seen as `cursor`
+        to page through long histories with a keyset instead of an offset.
+        """
+        query = "SELECT * FROM content_history WHERE user_id = ?"
+        params: List = [user_id]
         
         if content_type:
-            cursor.execute("""
-                SELECT * FROM content_history 
-                WHERE user_id = ? AND content_type = ?
-                ORDER BY consumed_at DESC
-            """, (user_id, content_type))
-        else:
-            cursor.execute("""
-                SELECT * FROM content_history 
-                WHERE user_id = ?
-                ORDER BY consumed_at DESC
-            """, (user_id,))
+            query += " AND content_type = ?"
+            params.append(content_type)
+        if cursor:
+            query += " AND (consumed_at, id) < (?, ?)"
+            params.extend(cursor)
         
-        rows = cursor.fetchall()
+        query += " ORDER BY consumed_at DESC, id DESC"
+        if limit is not None:
+            query += " LIMIT ?"
+            params.append(limit)
+        
+        db_cursor = self.connection.cursor()
+        db_cursor.execute(query, params)
+        rows = db_cursor.fetchall()
         return [dict(row) for row in rows]
     
+    def get_user_affinity(self, user_id: str) -> Dict[str, Dict[str, float]]:
+        """Get a user's taste profile: rating-weighted genre, mood and content-type totals."""
+        cursor = self.connection.cursor()
+        cursor.execute("""
+            SELECT dimension, value, weight FROM user_affinity 
+            WHERE user_id = ?
+            ORDER BY weight DESC
+        """, (user_id,))
+        
+        profile = {"genre": {}, "mood": {}, "content_type": {}}
+        for dimension, value, weight in cursor.fetchall():
+            profile.setdefault(dimension, {})[value] = weight
+        return profile
+    
+    def rebuild_user_affinity(self, user_id: str):
+        """Recompute a user's affinity profile from their full history, e.g. after catalog changes."""
+        cursor = self.connection.cursor()
+        cursor.execute("""
+            SELECT content_id, content_type, rating FROM content_history 
+            WHERE user_id = ?
+        """, (user_id,))
+        increments = [
+            row
+            for content_id, content_type, rating in cursor.fetchall()
+            for row in affinity_rows(user_id, content_id, content_type, rating)
+        ]
+        
+        with self.connection:
+            self.connection.execute("DELETE FROM user_affinity WHERE user_id = ?", (user_id,))
+            self.connection.executemany(AFFINITY_UPSERT_SQL, increments)
+    
     def get_consumed_ids(self, user_id: str) -> List[str]:
         """Get all content IDs that a user has consumed."""
+        consumed = self.get_consumed_id_set(user_id)
+        if isinstance(consumed, frozenset):
+            return list(consumed)
+        
         cursor = self.connection.cursor()
         cursor.execute("""
             SELECT DISTINCT content_id FROM content_history 
             WHERE user_id = ?
         """, (user_id,))
+        return [row[0] for row in cursor.fetchall()]
+    
+    def get_consumed_id_set(self, user_id: str) -> Container[str]:
+        """Get a membership container of the content IDs a user has consumed.
         
-        rows = cursor.fetchall()
-        return [row[0] for row in rows]
+        Usually a frozenset served from cache. When CONSUMED_BLOOM_MIN_IDS is set,
+        users with larger histories get a BloomConsumedSet instead, which keeps
+        only a bit array in memory and confirms possible hits in the database.
+        A cached entry is brought up to date with rows other processes wrote
+        since it was loaded, found by comparing content_history ids.
+        """
+        cursor = self.connection.cursor()
+        head = self._history_head()
+        
+        cached = self.consumed_cache.get(user_id)
+        if cached is not None:
+            consumed, cached_head = cached
+            if cached_head >= head:
+                return consumed
+            if head - cached_head <= CONSUMED_CATCH_UP_MAX_ROWS:
+                # Range scan over the new rows only
+                cursor.execute("""
+                    SELECT content_id FROM content_history 
+                    WHERE id > ? AND id <= ? AND user_id = ?
+                """, (cached_head, head, user_id))
+                consumed = self.consumed_cache.advance(user_id, [row[0] for row in cursor.fetchall()], head)
+                if consumed is not None:
+                    return consumed
+        
+        token = self.consumed_cache.load_token(user_id)
+        
+        if CONSUMED_BLOOM_MIN_IDS > 0:
+            cursor.execute("""
+                SELECT COUNT(DISTINCT content_id) FROM content_history 
+                WHERE user_id = ?
+            """, (user_id,))
+            count = cursor.fetchone()[0]
+            if count >= CONSUMED_BLOOM_MIN_IDS:
+                consumed = self._build_consumed_bloom(user_id, count)
+                self.consumed_cache.put(user_id, consumed, token, head)
+                return consumed
+        
+        cursor.execute("""
+            SELECT DISTINCT content_id FROM content_history 
+            WHERE user_id = ?
+        """, (user_id,))
+        
+        consumed = frozenset(row[0] for row in cursor.fetchall())
+        self.consumed_cache.put(user_id, consumed, token, head)
+        return consumed
+    
+    def _history_head(self) -> int:
+        """Highest content_history id; a rowid lookup, so cheap enough for every read."""
+        cursor = self.connection.cursor()
+        cursor.execute("SELECT COALESCE(MAX(id), 0) FROM content_history")
+        return cursor.fetchone()[0]
+    
+    def _build_consumed_bloom(self, user_id: str, count: int) -> BloomConsumedSet:
+        """Stream a user's consumed IDs into a Bloom filter with headroom for new writes."""
+        bloom = BloomFilter(int(count * 1.25), CONSUMED_BLOOM_ERROR_RATE)
+        cursor = self.connection.cursor()
+        cursor.execute("""
+            SELECT DISTINCT content_id FROM content_history 
+            WHERE user_id = ?
+        """, (user_id,))
+        for row in cursor:
+            bloom.add(row[0])
+        
+        db_path = self.db_path
+        return BloomConsumedSet(
+            bloom,
+            lambda content_id: _confirm_consumed(db_path, user_id, content_id)
+        )
+    
+    def consumed_among(self, user_id: str, content_ids: Iterable[str]) -> FrozenSet[str]:
+        """Return which of `content_ids` the user has consumed, exactly.
+        
+        For a Bloom-backed user, the filter's possible hits (false positives
+        included) are confirmed with batched IN queries rather than one
+        query per ID.
+        """
+        content_ids = list(dict.fromkeys(content_ids))
+        consumed = self.get_consumed_id_set(user_id)
+        if not isinstance(consumed, BloomConsumedSet):
+            return frozenset(c for c in content_ids if c in consumed)
+        
+        candidates = consumed.candidates(content_ids)
+        confirmed = set()
+        cursor = self.connection.cursor()
+        for start in range(0, len(candidates), CONFIRM_BATCH_SIZE):
+            batch = candidates[start:start + CONFIRM_BATCH_SIZE]
+            placeholders = ",".join("?" * len(batch))
+            cursor.execute(f"""
+                SELECT DISTINCT content_id FROM content_history 
+                WHERE user_id = ? AND content_id IN ({placeholders})
+            """, [user_id, *batch])
+            confirmed.update(row[0] for row in cursor.fetchall())
+        return frozenset(confirmed)
+    
+    def has_consumed(self, user_id: str, content_id: str) -> bool:
+        """Check whether a user has consumed a single content ID."""
+        cursor = self.connection.cursor()
+        cursor.execute("""
+            SELECT 1 FROM content_history 
+            WHERE user_id = ? AND content_id = ?
+            LIMIT 1
+        """, (user_id, content_id))
+        return cursor.fetchone() is not None
     
     def save_recommendation(self, user_id: str, batch_id: str, content_id: str,
                            content_type: str, title: str, explanation: str, ranking: int):
@@ -143,26 +476,67 @@ class HistoryDatabase:
         
         self.connection.commit()
     
-    def get_recommendations(self, user_id: str, batch_id: Optional[str] = None) -> List[Dict]:
-        """Get recommendations for a user."""
-        cursor = self.connection.cursor()
+    def get_recommendations(self, user_id: str, batch_id: Optional[str] = None,
+                            limit: Optional[int] = None,
+                            cursor: Optional[Tuple[str, int, int]] = None) -> List[Dict]:
+        """Get recommendations for a user.
+        
+        Without a batch_id, batches come newest first and each batch in
+        ranking order, walking idx_recommendations_user_page without a sort.
+        Pass `limit` and recommendation_position() of the last row seen as
+        `cursor` to fetch the next page.
+        """
+        db_cursor = self.connection.cursor()
         
         if batch_id:
-            cursor.execute("""
+            db_cursor.execute("""
                 SELECT * FROM recommendations 
                 WHERE user_id = ? AND recommendation_batch_id = ?
                 ORDER BY ranking ASC
             """, (user_id, batch_id))
-        else:
-            cursor.execute("""
-                SELECT * FROM recommendations 
-                WHERE user_id = ?
-                ORDER BY created_at DESC, ranking ASC
-            """, (user_id,))
+            return [dict(row) for row in db_cursor.fetchall()]
+        
+        query = "SELECT * FROM recommendations WHERE user_id = ?"
+        params: List = [user_id]
+        
+        if cursor:
+            created_at, ranking, row_id = cursor
+            query += """
+                AND (created_at < ?
+                     OR (created_at = ? AND (IFNULL(ranking, 0), id) > (?, ?)))
+            """
+            params.extend([created_at, created_at, ranking, row_id])
+        
+        query += " ORDER BY created_at DESC, IFNULL(ranking, 0) ASC, id ASC"
+        if limit is not None:
+            query += " LIMIT ?"
+            params.append(limit)
+        
+        db_cursor.execute(query, params)
+        rows = db_cursor.fetchall()
+        return [dict(row) for row in rows]
+    
+    def get_recommendation_rollup(self, user_id: str) -> List[Dict]:
+        """Get aggregated counts for recommendations that retention has pruned."""
+        cursor = self.connection.cursor()
+        cursor.execute("""
+            SELECT * FROM recommendation_rollup 
+            WHERE user_id = ?
+            ORDER BY last_recommended_at DESC
+        """, (user_id,))
         
         rows = cursor.fetchall()
         return [dict(row) for row in rows]
     
+    def get_stats(self) -> Dict[str, int]:
+        """Get row counts for admin reporting."""
+        cursor = self.connection.cursor()
+        stats = {}
+        for table in ("users", "content_history", "recommendations", "recommendation_rollup"):
+            cursor.execute(f"SELECT COUNT(*) FROM {table}")
+            stats[table] = cursor.fetchone()[0]
+        return stats
+    
     def update_preferences(self, user_id: str, preferences: Dict):
         """Update user preferences."""
         cursor = self.connection.cursor()
@@ -0,0 +1,186 @@
+import argparse
+import os
+import socket
+import time
+from datetime import datetime, timedelta
+from typing import Dict, Optional
+
+from .db import HistoryDatabase
+
+# Recommendation batches older than this are rolled up and deleted.
+RETENTION_DAYS = int(os.getenv("RECOMMENDATION_RETENTION_DAYS", "30"))
+# Batches pruned per transaction, keeping each write lock short.
+PRUNE_BATCHES_PER_STEP = int(os.getenv("MAINTENANCE_PRUNE_BATCHES_PER_STEP", "200"))
+# Free pages returned to the filesystem per incremental vacuum step.
+VACUUM_PAGES_PER_STEP = int(os.getenv("MAINTENANCE_VACUUM_PAGES_PER_STEP", "256"))
+# Pause between steps so request traffic can take the write lock.
+STEP_PAUSE_SECONDS = float(os.getenv("MAINTENANCE_STEP_PAUSE_SECONDS", "0.05"))
+# How long a worker keeps the maintenance lease before another may take it.
+LEASE_SECONDS = int(os.getenv("MAINTENANCE_LEASE_SECONDS", "7200"))
+
+MAINTENANCE_LEASE = "recommendation_retention"
+
+
+def _cutoff_timestamp(max_age_days: int) -> str:
+    """Format the retention cutoff like SQLite's CURRENT_TIMESTAMP (UTC)."""
+    cutoff = datetime.utcnow() - timedelta(days=max_age_days)
+    return cutoff.strftime("%Y-%m-%d %H:%M:%S")
+
+
+def worker_id() -> str:
+    """Identify this process as a lease holder."""
+    return f"{socket.gethostname()}:{os.getpid()}"
+
+
+def acquire_lease(db: HistoryDatabase, holder: str, lease_seconds: int = LEASE_SECONDS,
+                  name: str = MAINTENANCE_LEASE) -> bool:
+    """Take or renew the named lease. Returns False while another holder's lease is live.
+
+    The upsert is a single write, so two workers racing for an expired lease
+    cannot both win it.
+    """
+    now = time.time()
+    connection = db.connection
+    with connection:
+        taken = connection.execute("""
+            INSERT INTO maintenance_lease (name, holder, expires_at) VALUES (?, ?, ?)
+            ON CONFLICT (name) DO UPDATE SET
+                holder = excluded.holder,
+                expires_at = excluded.expires_at
+            WHERE maintenance_lease.holder = excluded.holder OR maintenance_lease.expires_at < ?
+        """, (name, holder, now + lease_seconds, now)).rowcount
+    return taken > 0
+
+
+def prune_recommendations(db: HistoryDatabase, max_age_days: int = RETENTION_DAYS,
+                          batches_per_step: int = PRUNE_BATCHES_PER_STEP,
+                          pause: float = STEP_PAUSE_SECONDS) -> Dict[str, int]:
+    """Roll up and delete recommendation batches older than `max_age_days`.
+
+    Each step folds a slice of expired batches into recommendation_rollup and
+    deletes their rows in one short transaction. A batch expires with its
+    oldest row; batches are written by a single request, so their rows are
+    seconds apart.
+    """
+    cutoff = _cutoff_timestamp(max_age_days)
+    connection = db.connection
+    batches_pruned = 0
+    rows_pruned = 0
+
+    while True:
+        batch_ids = [row[0] for row in connection.execute("""
+            SELECT DISTINCT recommendation_batch_id FROM recommendations
+            WHERE created_at < ?
+            LIMIT ?
+        """, (cutoff, batches_per_step))]
+        if not batch_ids:
+            break
+
+        placeholders = ",".join("?" * len(batch_ids))
+        with connection:
+            connection.execute(f"""
+                INSERT INTO recommendation_rollup (
+                    user_id, content_id, content_type, title, times_recommended,
+                    times_viewed, best_ranking, first_recommended_at, last_recommended_at
+                )
+                SELECT user_id, content_id, MAX(content_type), MAX(title), COUNT(*),
+                       SUM(viewed), MIN(ranking), MIN(created_at), MAX(created_at)
+                FROM recommendations
+                WHERE recommendation_batch_id IN ({placeholders})
+                GROUP BY user_id, content_id
+                ON CONFLICT (user_id, content_id) DO UPDATE SET
+                    content_type = excluded.content_type,
+                    title = excluded.title,
+                    times_recommended = times_recommended + excluded.times_recommended,
+                    times_viewed = times_viewed + excluded.times_viewed,
+                    best_ranking = MIN(COALESCE(best_ranking, excluded.best_ranking),
+                                       COALESCE(excluded.best_ranking, best_ranking)),
+                    first_recommended_at = MIN(first_recommended_at, excluded.first_recommended_at),
+                    last_recommended_at = MAX(last_recommended_at, excluded.last_recommended_at)
+            """, batch_ids)
+            deleted = connection.execute(
+                f"DELETE FROM recommendations WHERE recommendation_batch_id IN ({placeholders})",
+                batch_ids
+            ).rowcount
+
+        batches_pruned += len(batch_ids)
+        rows_pruned += deleted
+        time.sleep(pause)
+
+    return {"batches_pruned": batches_pruned, "rows_pruned": rows_pruned}
+
+
+def incremental_vacuum(db: HistoryDatabase, pages_per_step: int = VACUUM_PAGES_PER_STEP,
+                       max_steps: int = 1000, pause: float = STEP_PAUSE_SECONDS) -> int:
+    """Return free pages to the filesystem a few at a time. Returns pages reclaimed.
+
+    Only has an effect when the database uses auto_vacuum=INCREMENTAL, which new
+    databases do; older files can be converted once with enable_incremental_vacuum().
+    """
+    connection = db.connection
+    reclaimed = 0
+
+    for _ in range(max_steps):
+        free_pages = connection.execute("PRAGMA freelist_count").fetchone()[0]
+        if free_pages == 0:
+            break
+        # executescript steps the pragma to completion; execute() frees one page per call
+        connection.executescript(f"PRAGMA incremental_vacuum({int(pages_per_step)});")
+        remaining = connection.execute("PRAGMA freelist_count").fetchone()[0]
+        if remaining >= free_pages:
+            break
+        reclaimed += free_pages - remaining
+        time.sleep(pause)
+
+    return reclaimed
+
+
+def enable_incremental_vacuum(db: HistoryDatabase) -> bool:
+    """Switch an existing database to incremental auto-vacuum. Returns True if converted.
+
+    Requires one full VACUUM, which rewrites the whole file; run it off-peak.
+    """
+    connection = db.connection
+    if connection.execute("PRAGMA auto_vacuum").fetchone()[0] == 2:
+        return False
+    connection.execute("PRAGMA auto_vacuum=INCREMENTAL")
+    connection.execute("VACUUM")
+    return True
+
+
+def run_maintenance(db: HistoryDatabase, max_age_days: int = RETENTION_DAYS,
+                    holder: Optional[str] = None,
+                    lease_seconds: int = LEASE_SECONDS) -> Dict[str, int]:
+    """Prune and roll up old recommendations, then reclaim the freed pages.
+
+    With a `holder`, runs only if that worker holds the maintenance lease, so
+    one of several server processes does the work; others return {"skipped": 1}.
+    """
+    if holder is not None and not acquire_lease(db, holder, lease_seconds):
+        return {"skipped": 1}
+    summary = prune_recommendations(db, max_age_days)
+    summary["pages_reclaimed"] = incremental_vacuum(db)
+    return summary
+
+
+def main():
+    """Run recommendation retention and vacuum once against a database file."""
+    parser = argparse.ArgumentParser(description="Recommendation retention and vacuum")
+    parser.add_argument("db_path", nargs="?", default="otakuverse.db")
+    parser.add_argument("--max-age-days", type=int, default=RETENTION_DAYS)
+    parser.add_argument("--enable-incremental-vacuum", action="store_true",
+                        help="convert an existing database to incremental auto-vacuum (full VACUUM)")
+    args = parser.parse_args()
+
+    db = HistoryDatabase(args.db_path)
+    try:
+        if args.enable_incremental_vacuum and enable_incremental_vacuum(db):
+            print("[MAINTENANCE] Converted database to incremental auto-vacuum")
+        summary = run_maintenance(db, args.max_age_days)
+        print(f"[MAINTENANCE] {summary}")
+    finally:
+        db.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,89 @@
+import os
+import queue
+import threading
+from contextlib import contextmanager
+from typing import Any, Callable, Dict, Iterator, List, Optional
+
+from .db import HistoryDatabase
+
+
+class HistoryDatabasePool:
+    """Thread-safe pool of long-lived HistoryDatabase handles for one SQLite file.
+
+    Handles are opened lazily up to `size` and then reused, so schema setup and
+    connection cost are paid once per handle instead of once per call. Each
+    connection keeps its own prepared-statement cache across calls.
+    """
+
+    def __init__(self, db_path: str = "otakuverse.db", size: Optional[int] = None):
+        """Create an empty pool; handles are opened on first acquire."""
+        self.db_path = db_path
+        self.size = size or int(os.getenv("HISTORY_DB_POOL_SIZE", "4"))
+        self._idle: "queue.LifoQueue[HistoryDatabase]" = queue.LifoQueue()
+        self._handles: List[HistoryDatabase] = []
+        self._lock = threading.Lock()
+        self._closed = False
+
+    def _open_handle(self) -> Optional[HistoryDatabase]:
+        """Open a new handle if the pool has not reached its size yet."""
+        with self._lock:
+            if self._closed:
+                raise RuntimeError("HistoryDatabasePool is closed")
+            if len(self._handles) >= self.size:
+                return None
+            db = HistoryDatabase(self.db_path, check_same_thread=False)
+            self._handles.append(db)
+            return db
+
+    @contextmanager
+    def acquire(self, user_id: Optional[str] = None) -> Iterator[HistoryDatabase]:
+        """Borrow a handle for the duration of the block.
+
+        `user_id` is the routing key; a single-file pool ignores it.
+        """
+        try:
+            db = self._idle.get_nowait()
+        except queue.Empty:
+            db = self._open_handle() or self._idle.get()
+        try:
+            yield db
+        finally:
+            self._idle.put(db)
+
+    def pool_for(self, user_id: str) -> "HistoryDatabasePool":
+        """A single-file pool owns every user's rows."""
+        return self
+
+    @property
+    def shard_pools(self) -> List["HistoryDatabasePool"]:
+        """A single-file pool is its own only shard."""
+        return [self]
+
+    def scatter(self, func: Callable[..., Any], *args, **kwargs) -> List[Any]:
+        """Run `func(db, ...)` once per shard and gather the results."""
+        with self.acquire() as db:
+            return [func(db, *args, **kwargs)]
+
+    def close(self):
+        """Close every handle owned by the pool."""
+        with self._lock:
+            self._closed = True
+            for db in self._handles:
+                db.close()
+            self._handles.clear()
+
+
+_shared_pools: Dict[str, HistoryDatabasePool] = {}
+_shared_pools_lock = threading.Lock()
+
+
+def get_shared_pool(db_path: str = "otakuverse.db") -> HistoryDatabasePool:
+    """Return the process-wide pool for `db_path`, creating it on first use."""
+    pool = _shared_pools.get(db_path)
+    if pool is None:
+        with _shared_pools_lock:
+            pool = _shared_pools.get(db_path)
+            if pool is None:
+                pool = HistoryDatabasePool(db_path)
+                _shared_pools[db_path] = pool
+    return pool
@@ -0,0 +1,107 @@
+import hashlib
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from pathlib import Path
+from typing import Any, Callable, Dict, Iterator, List, Optional, Union
+
+from .db import HistoryDatabase
+from .pool import HistoryDatabasePool, get_shared_pool
+
+# Number of SQLite files user data is spread over. 1 keeps the classic single file.
+HISTORY_DB_SHARDS = int(os.getenv("HISTORY_DB_SHARDS", "1"))
+
+
+def shard_index(user_id: str, num_shards: int) -> int:
+    """Map a user to a shard with a hash that is stable across processes and restarts."""
+    digest = hashlib.blake2b(user_id.encode("utf-8"), digest_size=8).digest()
+    return int.from_bytes(digest, "little") % num_shards
+
+
+def shard_paths(db_path: str, num_shards: int) -> List[str]:
+    """Derive shard file names, e.g. otakuverse.db -> otakuverse.shard0.db ..."""
+    path = Path(db_path)
+    return [str(path.with_name(f"{path.stem}.shard{i}{path.suffix}")) for i in range(num_shards)]
+
+
+class ShardedHistoryPool:
+    """Routes each user to one of N SQLite files, each with its own connection pool.
+
+    Exposes the same acquire()/scatter() surface as HistoryDatabasePool, so
+    AsyncHistoryDatabase and the history tools work unchanged in sharded mode.
+    Writes to different shards never contend for the same SQLite write lock.
+    """
+
+    def __init__(self, db_path: str = "otakuverse.db", num_shards: int = HISTORY_DB_SHARDS,
+                 pool_size: Optional[int] = None):
+        """Open one pool per shard file; connections are created lazily."""
+        if num_shards < 1:
+            raise ValueError("num_shards must be at least 1")
+        self.db_path = db_path
+        self.num_shards = num_shards
+        self.pools = [HistoryDatabasePool(path, pool_size) for path in shard_paths(db_path, num_shards)]
+        self._executor = ThreadPoolExecutor(max_workers=num_shards, thread_name_prefix="history-shard")
+
+    @property
+    def shard_pools(self) -> List[HistoryDatabasePool]:
+        """Every shard's pool, in shard order."""
+        return self.pools
+
+    def pool_for(self, user_id: str) -> HistoryDatabasePool:
+        """Return the pool that owns a user's rows."""
+        return self.pools[shard_index(user_id, self.num_shards)]
+
+    @contextmanager
+    def acquire(self, user_id: Optional[str] = None) -> Iterator[HistoryDatabase]:
+        """Borrow a handle on the user's shard."""
+        if user_id is None:
+            raise ValueError("Sharded history database needs a user_id to route the call; use scatter()")
+        with self.pool_for(user_id).acquire(user_id) as db:
+            yield db
+
+    def scatter(self, func: Callable[..., Any], *args, **kwargs) -> List[Any]:
+        """Run `func(db, ...)` on every shard concurrently and gather the results."""
+        futures = [
+            self._executor.submit(pool.scatter, func, *args, **kwargs)
+            for pool in self.pools
+        ]
+        return [result for future in futures for result in future.result()]
+
+    def close(self):
+        """Close every shard pool."""
+        self._executor.shutdown(wait=True)
+        for pool in self.pools:
+            pool.close()
+
+
+def merge_stats(results: List[Dict[str, int]]) -> Dict[str, int]:
+    """Sum per-shard HistoryDatabase.get_stats() results."""
+    merged: Dict[str, int] = {}
+    for stats in results:
+        for key, value in stats.items():
+            merged[key] = merged.get(key, 0) + value
+    merged["shards"] = len(results)
+    return merged
+
+
+def create_history_pool(db_path: str = "otakuverse.db", size: Optional[int] = None,
+                        num_shards: int = HISTORY_DB_SHARDS) -> Union[HistoryDatabasePool, ShardedHistoryPool]:
+    """Build a single-file pool, or a sharded one when more than one shard is configured."""
+    if num_shards > 1:
+        return ShardedHistoryPool(db_path, num_shards, size)
+    return HistoryDatabasePool(db_path, size)
+
+
+_shared_history_pools: Dict[str, Union[HistoryDatabasePool, ShardedHistoryPool]] = {}
+_shared_history_pools_lock = threading.Lock()
+
+
+def get_shared_history_pool(db_path: str = "otakuverse.db") -> Union[HistoryDatabasePool, ShardedHistoryPool]:
+    """Return the process-wide history pool, sharded according to HISTORY_DB_SHARDS."""
+    with _shared_history_pools_lock:
+        pool = _shared_history_pools.get(db_path)
+        if pool is None:
+            pool = ShardedHistoryPool(db_path) if HISTORY_DB_SHARDS > 1 else get_shared_pool(db_path)
+            _shared_history_pools[db_path] = pool
+        return pool
@@ -0,0 +1,272 @@
+import asyncio
+import functools
+import json
+import os
+import sqlite3
+import threading
+import time
+from abc import ABC, abstractmethod
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable, Optional, Tuple
+
+# Entries kept in memory per worker; everything else lives only in SQLite.
+USER_STATE_CACHE_SIZE = int(os.getenv("USER_STATE_CACHE_SIZE", "2000"))
+# Seconds a cached entry is trusted before re-reading it, bounding staleness
+# when another worker writes the same user.
+USER_STATE_CACHE_TTL = float(os.getenv("USER_STATE_CACHE_TTL", "5"))
+USER_STATE_DB_PATH = os.getenv("USER_STATE_DB_PATH", "otakuverse.db")
+USER_STATE_WORKERS = int(os.getenv("USER_STATE_WORKERS", "4"))
+
+
+class UserStateStore(ABC):
+    """Interface for per-user state blobs such as history, watch later and settings.
+
+    Values are JSON-serializable and keyed by (user_id, kind). Treat returned
+    values as read-only; write changes back with set(), or with update() or
+    append() when the new value depends on the old one.
+    """
+
+    @abstractmethod
+    def get(self, user_id: str, kind: str, default: Any = None) -> Any:
+        """Get a user's value for `kind`, or `default` if unset."""
+
+    @abstractmethod
+    def set(self, user_id: str, kind: str, value: Any):
+        """Replace a user's value for `kind`."""
+
+    @abstractmethod
+    def delete(self, user_id: str, kind: str):
+        """Remove a user's value for `kind`."""
+
+    @abstractmethod
+    def count_users(self, kind: str) -> int:
+        """Count users that have a value for `kind`."""
+
+    @abstractmethod
+    def update(self, user_id: str, kind: str, func: Callable[[Any], Any], default: Any = None) -> Any:
+        """Atomically replace a user's value with `func(current or default)`. Returns the new value."""
+
+    def append(self, user_id: str, kind: str, item: Any, max_items: Optional[int] = None) -> list:
+        """Append to a list value, keeping only the newest `max_items`. Returns the new list."""
+        def add(items):
+            items = list(items) + [item]
+            if max_items is not None and len(items) > max_items:
+                items = items[-max_items:]
+            return items
+
+        return self.update(user_id, kind, add, [])
+
+    def close(self):
+        """Release any resources held by the store."""
+
+
+class SQLiteUserStateStore(UserStateStore):
+    """Durable user state in a single SQLite table, shared by all workers."""
+
+    def __init__(self, db_path: str = USER_STATE_DB_PATH):
+        """Open the database and create the user_state table if needed."""
+        self.db_path = db_path
+        self._lock = threading.Lock()
+        self.connection = sqlite3.connect(db_path, check_same_thread=False)
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.execute("PRAGMA synchronous=NORMAL")
+        self.connection.execute("""
+            CREATE TABLE IF NOT EXISTS user_state (
+                user_id TEXT NOT NULL,
+                kind TEXT NOT NULL,
+                payload JSON NOT NULL,
+                updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                PRIMARY KEY (user_id, kind)
+            )
+        """)
+        self.connection.commit()
+
+    def get(self, user_id: str, kind: str, default: Any = None) -> Any:
+        with self._lock:
+            row = self.connection.execute(
+                "SELECT payload FROM user_state WHERE user_id = ? AND kind = ?",
+                (user_id, kind)
+            ).fetchone()
+        return json.loads(row[0]) if row else default
+
+    def set(self, user_id: str, kind: str, value: Any):
+        payload = json.dumps(value)
+        with self._lock:
+            self.connection.execute("""
+                INSERT INTO user_state (user_id, kind, payload, updated_at)
+                VALUES (?, ?, ?, CURRENT_TIMESTAMP)
+                ON CONFLICT (user_id, kind) DO UPDATE SET
+                    payload = excluded.payload,
+                    updated_at = excluded.updated_at
+            """, (user_id, kind, payload))
+            self.connection.commit()
+
+    def delete(self, user_id: str, kind: str):
+        with self._lock:
+            self.connection.execute(
+                "DELETE FROM user_state WHERE user_id = ? AND kind = ?", (user_id, kind)
+            )
+            self.connection.commit()
+
+    def count_users(self, kind: str) -> int:
+        with self._lock:
+            return self.connection.execute(
+                "SELECT COUNT(*) FROM user_state WHERE kind = ?", (kind,)
+            ).fetchone()[0]
+
+    def update(self, user_id: str, kind: str, func: Callable[[Any], Any], default: Any = None) -> Any:
+        # BEGIN IMMEDIATE takes the write lock before the read, so concurrent
+        # updates from other workers queue instead of overwriting each other
+        with self._lock:
+            self.connection.execute("BEGIN IMMEDIATE")
+            try:
+                row = self.connection.execute(
+                    "SELECT payload FROM user_state WHERE user_id = ? AND kind = ?",
+                    (user_id, kind)
+                ).fetchone()
+                value = func(json.loads(row[0]) if row else default)
+                self.connection.execute("""
+                    INSERT INTO user_state (user_id, kind, payload, updated_at)
+                    VALUES (?, ?, ?, CURRENT_TIMESTAMP)
+                    ON CONFLICT (user_id, kind) DO UPDATE SET
+                        payload = excluded.payload,
+                        updated_at = excluded.updated_at
+                """, (user_id, kind, json.dumps(value)))
+                self.connection.commit()
+            except BaseException:
+                self.connection.rollback()
+                raise
+        return value
+
+    def close(self):
+        with self._lock:
+            self.connection.close()
+
+
+class LRUUserStateStore(UserStateStore):
+    """Bounded in-memory LRU of hot users in front of a durable backend.
+
+    Reads are served from memory for up to `ttl` seconds; writes go through
+    to the backend so state survives restarts and is shared across workers.
+    """
+
+    _MISSING = object()
+
+    def __init__(self, backend: UserStateStore, max_entries: int = USER_STATE_CACHE_SIZE,
+                 ttl: float = USER_STATE_CACHE_TTL):
+        """Wrap `backend` with an LRU holding at most `max_entries` values."""
+        self.backend = backend
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self._entries: "OrderedDict[Tuple[str, str], Tuple[Any, float]]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def _remember(self, key: Tuple[str, str], value: Any):
+        """Insert or refresh an entry, evicting the least recently used."""
+        with self._lock:
+            self._entries[key] = (value, time.monotonic())
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def get(self, user_id: str, kind: str, default: Any = None) -> Any:
+        key = (user_id, kind)
+        value = self._MISSING
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and time.monotonic() - entry[1] < self.ttl:
+                value = entry[0]
+                self._entries.move_to_end(key)
+        if value is self._MISSING:
+            value = self.backend.get(user_id, kind, self._MISSING)
+            if value is self._MISSING:
+                return default
+            self._remember(key, value)
+        return value
+
+    def set(self, user_id: str, kind: str, value: Any):
+        self.backend.set(user_id, kind, value)
+        self._remember((user_id, kind), value)
+
+    def delete(self, user_id: str, kind: str):
+        self.backend.delete(user_id, kind)
+        with self._lock:
+            self._entries.pop((user_id, kind), None)
+
+    def count_users(self, kind: str) -> int:
+        return self.backend.count_users(kind)
+
+    def update(self, user_id: str, kind: str, func: Callable[[Any], Any], default: Any = None) -> Any:
+        # The backend reads the current value itself; drop ours so the next
+        # get() re-reads rather than trusting a copy older than the write
+        value = self.backend.update(user_id, kind, func, default)
+        with self._lock:
+            self._entries.pop((user_id, kind), None)
+        return value
+
+    def close(self):
+        self.backend.close()
+
+
+class AsyncUserStateStore:
+    """Awaitable facade over a UserStateStore for use inside async request handlers.
+
+    Calls run on a dedicated, bounded thread pool, like AsyncHistoryDatabase,
+    so SQLite reads, writes and lock waits never block the event loop.
+    """
+
+    def __init__(self, store: UserStateStore, max_workers: int = USER_STATE_WORKERS):
+        """Wrap `store` with an executor of `max_workers` threads."""
+        self.store = store
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="user-state")
+
+    async def _run(self, method_name: str, *args, **kwargs) -> Any:
+        """Schedule a store method on the executor and await its result."""
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(
+            self._executor,
+            functools.partial(getattr(self.store, method_name), *args, **kwargs)
+        )
+
+    async def get(self, user_id: str, kind: str, default: Any = None) -> Any:
+        """Get a user's value for `kind`, or `default` if unset."""
+        return await self._run("get", user_id, kind, default)
+
+    async def set(self, user_id: str, kind: str, value: Any):
+        """Replace a user's value for `kind`."""
+        return await self._run("set", user_id, kind, value)
+
+    async def delete(self, user_id: str, kind: str):
+        """Remove a user's value for `kind`."""
+        return await self._run("delete", user_id, kind)
+
+    async def count_users(self, kind: str) -> int:
+        """Count users that have a value for `kind`."""
+        return await self._run("count_users", kind)
+
+    async def update(self, user_id: str, kind: str, func: Callable[[Any], Any], default: Any = None) -> Any:
+        """Atomically replace a user's value with `func(current or default)`."""
+        return await self._run("update", user_id, kind, func, default)
+
+    async def append(self, user_id: str, kind: str, item: Any, max_items: Optional[int] = None) -> list:
+        """Append to a list value, keeping only the newest `max_items`."""
+        return await self._run("append", user_id, kind, item, max_items)
+
+    async def close(self):
+        """Drain pending calls, then close the store."""
+        loop = asyncio.get_running_loop()
+        await loop.run_in_executor(None, functools.partial(self._executor.shutdown, wait=True))
+        self.store.close()
+
+
+def create_user_state_store(db_path: str = USER_STATE_DB_PATH,
+                            max_entries: int = USER_STATE_CACHE_SIZE) -> UserStateStore:
+    """Build the default store: an in-memory LRU backed by SQLite."""
+    return LRUUserStateStore(SQLiteUserStateStore(db_path), max_entries)
+
+
+def create_async_user_state_store(db_path: str = USER_STATE_DB_PATH,
+                                  max_entries: int = USER_STATE_CACHE_SIZE) -> AsyncUserStateStore:
+    """Build the default store behind an executor, for async servers."""
+    return AsyncUserStateStore(create_user_state_store(db_path, max_entries))
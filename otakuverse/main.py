@@ -19,7 +19,7 @@ sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
 from orchestrator.agent import create_orchestrator_agent, create_recommendation_session
 from mood_agent.agent import create_mood_agent
 from history_agent.agent import create_history_agent
-from history_agent.db import HistoryDatabase
+from history_agent.db import HistoryDatabase, set_catalog_lookup
 from catalog_agent.agent import create_catalog_agent, CatalogManager
 from ranking_agent.agent import create_ranking_agent
 
@@ -30,6 +30,7 @@ class OtakuVerseCLI:
     def __init__(self):
         self.db = HistoryDatabase()
         self.catalog_manager = CatalogManager()
+        set_catalog_lookup(self.catalog_manager.get_item)
         self.current_user = None
         self.session = None
     